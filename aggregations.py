@@ -0,0 +1,162 @@
+'''Fleet-wide aggregation of processor results in bounded memory.
+
+A processor with an aggregator (see dashboard_processors.make_aggregator)
+is the map step: it returns the partial result of its dashboard, already
+combined over the dashboard's panels and targets, e.g. {metric: number
+of targets using it}. Children send it to the parent as one json line
+and the parent combines the partials into the aggregator as children
+finish, so neither the messages nor the parent grow with the number of
+targets:
+
+Count     sums numbers.
+CountBy   sums {key: count}, keeping at most capacity keys.
+TopK      CountBy reporting its k largest keys.
+Distinct  counts the distinct values in lists, estimated past capacity.
+
+CountBy past capacity drops its smallest counts in batches. A key coming
+back starts from the largest count dropped so far (error), so counts
+are upper bounds off by at most error and no key whose true count is
+over error is missing (as in the space saving algorithm).
+
+Distinct past capacity keeps the capacity smallest hashes of the values
+and estimates the count from the largest of them (k minimum values).
+
+merge combines another aggregator of the same type into this one, for
+aggregators filled on different nodes.
+
+'''
+import hashlib
+import heapq
+
+
+class Count(object):
+    def __init__(self):
+        self.total = 0
+
+    def combine(self, partial):
+        self.total += partial
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+    def format(self):
+        return 'Total: %s' % self.total
+
+
+class CountBy(object):
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def combine(self, partial):
+        for key, count in partial.items():
+            if key in self.counts:
+                self.counts[key] += count
+            else:
+                self.counts[key] = self.error + count
+        if len(self.counts) > 2 * self.capacity:
+            self._prune()
+
+    def merge(self, other):
+        # Keys other dropped may have counted up to other.error there.
+        for key in self.counts:
+            if key not in other.counts:
+                self.counts[key] += other.error
+        self.combine(other.counts)
+        self.error += other.error
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda x: -x[1])
+        self.error = max(self.error, ranked[self.capacity][1])
+        self.counts = dict(ranked[:self.capacity])
+
+    def result(self):
+        '''Return [(key, count)] by decreasing count.
+
+        '''
+        return sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+
+    def format(self):
+        lines = ['%10s  %s' % (count, key) for key, count in self.result()]
+        if self.error:
+            lines.append('Counts are upper bounds, off by at most %s.' % self.error)
+        return '\n'.join(lines)
+
+
+class TopK(CountBy):
+    def __init__(self, k=100, capacity=None):
+        super(TopK, self).__init__(capacity or 10 * k)
+        self.k = k
+
+    def result(self):
+        return super(TopK, self).result()[:self.k]
+
+
+def _hash(value):
+    '''Uniform hash of value in [0, 1).
+
+    '''
+    digest = hashlib.md5(repr(value).encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) / float(16 ** 15)
+
+
+class Distinct(object):
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.values = set()
+        self.hashes = None  # Max heap, as negated hashes, once over capacity.
+        self._hash_set = set()
+
+    def combine(self, partial):
+        # Json turns tuples into lists, which aren't hashable.
+        partial = [tuple(x) if isinstance(x, list) else x for x in partial]
+        if self.hashes is None:
+            self.values.update(partial)
+            if len(self.values) <= self.capacity:
+                return
+            partial = self.values
+            self.values = set()
+            self.hashes = []
+        for value in partial:
+            self._add_hash(_hash(value))
+
+    def _add_hash(self, value_hash):
+        if value_hash in self._hash_set:
+            return
+        if len(self.hashes) < self.capacity:
+            heapq.heappush(self.hashes, -value_hash)
+        elif value_hash < -self.hashes[0]:
+            self._hash_set.discard(-heapq.heappushpop(self.hashes, -value_hash))
+        else:
+            return
+        self._hash_set.add(value_hash)
+
+    def merge(self, other):
+        if other.hashes is None:
+            self.combine(list(other.values))
+            return
+        if self.hashes is None:
+            values = self.values
+            self.values = set()
+            self.hashes = []
+            for value in values:
+                self._add_hash(_hash(value))
+        for value_hash in other.hashes:
+            self._add_hash(-value_hash)
+
+    def result(self):
+        '''Return the number of distinct values, estimated past capacity.
+
+        '''
+        if self.hashes is None:
+            return len(self.values)
+        return int(round((self.capacity - 1) / -self.hashes[0]))
+
+    def format(self):
+        if self.hashes is None:
+            return '%s distinct: %s' % (len(self.values), ', '.join(sorted(map(str, self.values))))
+        return 'About %s distinct.' % self.result()
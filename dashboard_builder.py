@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+'''Build grafana dashboards in bulk from declarative specs.
+
+A spec is a dict; either rows are given explicitly:
+
+    {'title': 'Broker delivery',
+     'datasource': 'Datasource1',
+     'tags': ['generated'],
+     'template_variables': {'colo': ['ca', 'lc', 'xa']},
+     'rows': [{'title': 'Requests',
+               'panels': [{'title': 'total', 'targets': ['ssrtb.agg.total_req.*'],
+                           'fill': 0}]}]}
+
+or a list of metrics is grouped into one panel per value of a node:
+
+    {'title': 'Hosts', 'metrics': ['a.md.cpu.host.h1.gauge.value', ...],
+     'group_by_node': 4}
+
+Panel keys other than title and targets override the panel_layout
+defaults. Panel ids and target refIds are assigned automatically.
+
+The layouts are serialized once per builder: the default of every
+layout key is kept as a json fragment shared by all panels, only the
+values a panel overrides are serialized for it, and dashboards are
+produced as a stream of json chunks that can go straight to a file or
+to sql_connector.set_dashboards_json.
+
+'''
+from collections import OrderedDict
+import json_codec
+import layouts
+from lazy_import import lazy_module
+import os
+import triconf
+
+sql_connector = lazy_module('sql_connector')
+
+CONFIGS = None
+GRID_WIDTH = 12
+ROWS_PLACEHOLDER = '"\0rows\0"'
+
+
+class DashboardBuilderException(Exception):
+    def __init__(self, msg=''):
+        super(DashboardBuilderException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('dashboard_builder', conf_file_names=['conf.ini'],
+                                      **kargs)
+    return CONFIGS
+
+
+def ref_ids():
+    '''Yield grafana target refIds: A to Z, then AA, AB, ...
+
+    '''
+    letters = [chr(x) for x in range(ord('A'), ord('Z') + 1)]
+    for letter in letters:
+        yield letter
+    for first in letters:
+        for second in letters:
+            yield first + second
+
+
+class LayoutTemplate(object):
+    '''Serialized form of a layout from layouts. Every default is
+    serialized once; render only serializes what it is given.
+
+    '''
+    def __init__(self, layout):
+        self.keys = list(layout)
+        self.quoted = dict((key, json_codec.dumps(key)) for key in self.keys)
+        self.fragments = dict((key, '%s: %s' % (self.quoted[key], json_codec.dumps(value)))
+                              for key, value in layout.items())
+
+    def render(self, raw_values):
+        '''Return the layout as a json string with the serialized json in
+        raw_values in place of the defaults of those keys. Keys the layout
+        doesn't have are appended.
+
+        '''
+        parts = []
+        for key in self.keys:
+            if key in raw_values:
+                parts.append('%s: %s' % (self.quoted[key], raw_values[key]))
+            else:
+                parts.append(self.fragments[key])
+        for key in raw_values:
+            if key not in self.quoted:
+                parts.append('%s: %s' % (json_codec.dumps(key), raw_values[key]))
+        return '{%s}' % ', '.join(parts)
+
+
+class DashboardBuilder(object):
+    '''Turns dashboard specs into grafana dashboard json.
+
+    panels_per_row is used when grouping metrics into panels, it
+    defaults to graphs_per_panel from conf.ini. hooks are callables
+    taking and returning the list of (row title, [panel spec, ...])
+    before the dashboard is rendered, e.g. to split heavy panels.
+
+    '''
+    def __init__(self, datasource='', panels_per_row=None, hooks=None):
+        if panels_per_row is None:
+            if CONFIGS is None:
+                initialize()
+            panels_per_row = int(getattr(CONFIGS, 'graphs_per_panel', 2))
+        self.datasource = datasource
+        self.panels_per_row = panels_per_row
+        self.hooks = list(hooks or [])
+        self.main_template = LayoutTemplate(layouts.main_layout())
+        self.row_template = LayoutTemplate(layouts.row_layout())
+        self.panel_template = LayoutTemplate(layouts.panel_layout())
+        self.target_template = LayoutTemplate(layouts.graph_target_layout())
+        self.variable_template = LayoutTemplate(layouts.template_layout()['list'][0])
+
+    def _group_metrics(self, spec):
+        '''Return rows of panels for spec['metrics'], one panel per value
+        of node group_by_node (one per metric without it), in order of
+        first appearance.
+
+        '''
+        node = spec.get('group_by_node')
+        groups = OrderedDict()
+        for metric in spec['metrics']:
+            key = metric.split('.')[node] if node is not None else metric
+            groups.setdefault(key, []).append(metric)
+        panels = [{'title': title, 'targets': targets} for title, targets in groups.items()]
+        return [('', panels[x:x + self.panels_per_row])
+                for x in range(0, len(panels), self.panels_per_row)]
+
+    def expand_rows(self, spec):
+        '''Return the rows of spec as [(row title, [panel spec, ...])],
+        after the hooks have been applied.
+
+        '''
+        if 'rows' in spec:
+            rows = [(row.get('title', ''), [dict(x) for x in row.get('panels', [])])
+                    for row in spec['rows']]
+        elif 'metrics' in spec:
+            rows = self._group_metrics(spec)
+        else:
+            raise DashboardBuilderException('Spec %s has neither rows nor metrics.'
+                                            % spec.get('title'))
+        for hook in self.hooks:
+            rows = hook(rows)
+        return rows
+
+    def _render_targets(self, targets):
+        rendered = []
+        ref_id = ref_ids()
+        for target in targets:
+            if not isinstance(target, dict):
+                target = {'target': target}
+            raw_values = dict((key, json_codec.dumps(value)) for key, value in target.items())
+            raw_values['refId'] = json_codec.dumps(target.get('refId') or next(ref_id))
+            rendered.append(self.target_template.render(raw_values))
+        return '[%s]' % ', '.join(rendered)
+
+    def _render_panel(self, panel, panel_id, datasource):
+        raw_values = dict((key, json_codec.dumps(value)) for key, value in panel.items()
+                          if key != 'targets')
+        raw_values['id'] = str(panel_id)
+        raw_values['targets'] = self._render_targets(panel.get('targets', []))
+        if 'datasource' not in panel:
+            raw_values['datasource'] = json_codec.dumps(datasource)
+        if 'span' not in panel:
+            raw_values['span'] = str(GRID_WIDTH // max(1, min(self.panels_per_row, 12)))
+        return self.panel_template.render(raw_values)
+
+    def _render_templating(self, variables):
+        rendered = []
+        for name, values in variables.items():
+            values = list(values)
+            options = [OrderedDict((('selected', x == 0), ('text', value), ('value', value)))
+                       for x, value in enumerate(values)]
+            current = OrderedDict((('tags', []), ('text', values[0] if values else ''),
+                                   ('value', values[0] if values else '')))
+            rendered.append(self.variable_template.render({
+                'name': json_codec.dumps(name),
+                'options': json_codec.dumps(options),
+                'current': json_codec.dumps(current),
+                'query': json_codec.dumps(','.join(values)),
+                'type': '"custom"'}))
+        return '{"list": [%s]}' % ', '.join(rendered)
+
+    def iter_json(self, spec):
+        '''Yield the dashboard json for spec in chunks, one per row plus
+        the surrounding dashboard.
+
+        '''
+        title = spec['title']
+        raw_values = {'title': json_codec.dumps(title),
+                      'originalTitle': json_codec.dumps(title),
+                      'rows': ROWS_PLACEHOLDER}
+        for key in ('tags', 'refresh', 'time', 'timezone', 'style'):
+            if key in spec:
+                raw_values[key] = json_codec.dumps(spec[key])
+        if spec.get('template_variables'):
+            raw_values['templating'] = self._render_templating(spec['template_variables'])
+        prefix, suffix = self.main_template.render(raw_values).split(ROWS_PLACEHOLDER)
+        datasource = spec.get('datasource', self.datasource)
+        yield prefix + '['
+        panel_id = 1
+        for row_number, (row_title, panels) in enumerate(self.expand_rows(spec)):
+            rendered_panels = []
+            for panel in panels:
+                rendered_panels.append(self._render_panel(panel, panel_id, datasource))
+                panel_id += 1
+            row = self.row_template.render({'title': json_codec.dumps(row_title),
+                                            'panels': '[%s]' % ', '.join(rendered_panels)})
+            yield row if row_number == 0 else ', ' + row
+        yield ']' + suffix
+
+    def to_json(self, spec):
+        return ''.join(self.iter_json(spec))
+
+    def write(self, spec, json_file):
+        for chunk in self.iter_json(spec):
+            json_file.write(chunk)
+
+
+def dashboard_file_name(spec):
+    return '%s.json' % spec['title'].replace(' ', '-').replace('/', '-')
+
+
+def write_dashboards(specs, directory, builder=None):
+    '''Write a json file per spec into directory, returns the paths
+    written.
+
+    '''
+    builder = builder or DashboardBuilder()
+    paths = []
+    for spec in specs:
+        path = os.path.join(directory, dashboard_file_name(spec))
+        with open(path, 'w') as json_file:
+            builder.write(spec, json_file)
+        paths.append(path)
+    return paths
+
+
+def import_dashboards(specs, builder=None, chunk_size=100):
+    '''Build every spec and bulk insert it into the grafana database.
+    Returns the number of dashboards inserted.
+
+    '''
+    builder = builder or DashboardBuilder()
+    return sql_connector.set_dashboards_json(((x['title'], x['title'], builder.to_json(x))
+                                              for x in specs), chunk_size=chunk_size)
+
+
+if __name__ == '__main__':
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS,
+                                         description='Build grafana dashboards from specs.')
+    PARSER.add_argument('specs', help='Json file with a list of dashboard specs.')
+    PARSER.add_argument('--datasource', default='', help='Default datasource for panels.')
+    PARSER.add_argument('--output-dir', help='Write dashboards as json files into this directory.')
+    PARSER.add_argument('--import', action='store_true', dest='import_dashboards',
+                        help='Insert the dashboards into the grafana database.')
+    PARSER.add_argument('--limit-series', action='store_true',
+                        help='Split panels and rows over the series limits (see panel_limits).')
+    CONFIGS(PARSER.parse_args())
+    SPECS = json_codec.load(open(CONFIGS.specs, 'rb'), ordered=True)
+    HOOKS = []
+    if CONFIGS.limit_series:
+        import panel_limits
+        HOOKS.append(panel_limits.PanelLimits().builder_hook())
+    BUILDER = DashboardBuilder(datasource=CONFIGS.datasource, hooks=HOOKS)
+    if CONFIGS.output_dir:
+        print('wrote %s dashboards' % len(write_dashboards(SPECS, CONFIGS.output_dir, BUILDER)))
+    if CONFIGS.import_dashboards:
+        print('imported %s dashboards' % import_dashboards(SPECS, BUILDER))
@@ -0,0 +1,82 @@
+'''Compact dashboard handles loading their data on first access.
+
+A DASHBOARD_RECORD carries the data blob of its dashboard, so gathering
+the fleet to schedule or filter it holds every blob at once. A
+DashboardHandle holds the metadata columns only, with __slots__, plus
+the data length and target count computed by the source. Its data is
+loaded on first access by a BatchLoader, together with the data of the
+next handles in load order (the order of the handles given to the
+loader), in one fetch by id. Only the data of the last batch is kept,
+handles of older batches load theirs again when accessed.
+
+'''
+
+
+class DashboardHandle(object):
+    __slots__ = ('id', 'slug', 'title', 'version', 'updated', 'data_length', 'target_count',
+                 '_data', '_loader')
+
+    def __init__(self, id, slug, title, version, updated, data_length, target_count=None,
+                 loader=None):
+        self.id = id
+        self.slug = slug
+        self.title = title
+        self.version = version
+        self.updated = updated
+        self.data_length = data_length
+        self.target_count = target_count
+        self._data = None
+        self._loader = loader
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._loader.load(self)
+        return self._data
+
+    def __repr__(self):
+        return 'DashboardHandle(id=%r, slug=%r)' % (self.id, self.slug)
+
+
+class BatchLoader(object):
+    '''Loads the data of handles batch_size at a time with fetch(ids),
+    returning (id, data) rows.
+
+    '''
+    def __init__(self, fetch, batch_size=100):
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.order = []
+        self.positions = {}
+        self.batch = []
+
+    def track(self, handles):
+        '''Set the load order to handles, which now load through this
+        loader. Returns handles.
+
+        '''
+        self.order = list(handles)
+        self.positions = dict([(x.id, number) for number, x in enumerate(self.order)])
+        for handle in self.order:
+            handle._loader = self
+        return handles
+
+    def load(self, handle):
+        start = self.positions.get(handle.id)
+        batch = [handle] if start is None else self.order[start:start + self.batch_size]
+        for old in self.batch:
+            old._data = None
+        data = dict(self.fetch([x.id for x in batch]))
+        for loaded in batch:
+            loaded._data = data.get(loaded.id)
+        self.batch = batch
+        if handle._data is None:
+            raise KeyError('Dashboard %s (%s) is gone.' % (handle.slug, handle.id))
+
+
+def make_handles(rows, fetch, batch_size=100):
+    '''Return the DashboardHandles of rows, tuples of the handle fields
+    but the loader, loading through a new BatchLoader.
+
+    '''
+    return BatchLoader(fetch, batch_size).track([DashboardHandle(*x) for x in rows])
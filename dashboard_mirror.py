@@ -0,0 +1,183 @@
+'''Local mirror of the grafana dashboard table.
+
+Read-only processors (see processor_registry) can run against the
+mirror instead of the live database. The mirror is a sqlite file
+keyed by dashboard id holding each row zlib compressed, and is synced
+incrementally by selecting only the rows updated since the last
+sync. Writes always go to MySQL.
+
+'''
+from collections import namedtuple
+import dashboard_handle
+import dashboard_scheduler
+from lazy_import import lazy_module
+import sqlite3
+import triconf
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+sql_connector = lazy_module('sql_connector')
+
+CONFIGS = None
+DASHBOARD_RECORD = None
+MIRROR_CONNECTION = None
+UPDATED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class DashboardMirrorException(Exception):
+    def __init__(self, msg=''):
+        super(DashboardMirrorException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('dashboard_mirror', conf_file_names=['conf.ini'],
+                                      **kargs)
+    return CONFIGS
+
+
+def _get_mirror_connection():
+    '''Return the sqlite connection to the mirror, creating the tables
+    on first use.
+
+    '''
+    global MIRROR_CONNECTION
+    if MIRROR_CONNECTION is None:
+        if CONFIGS is None:
+            initialize()
+        MIRROR_CONNECTION = sqlite3.connect(CONFIGS.mirror_path, timeout=60)
+        MIRROR_CONNECTION.execute('CREATE TABLE IF NOT EXISTS meta '
+                                  '(key TEXT PRIMARY KEY, value TEXT)')
+        MIRROR_CONNECTION.execute('CREATE TABLE IF NOT EXISTS dashboard '
+                                  '(id INTEGER PRIMARY KEY, slug TEXT, version INTEGER, '
+                                  'updated TEXT, data_length INTEGER, record BLOB)')
+        MIRROR_CONNECTION.execute('CREATE INDEX IF NOT EXISTS dashboard_slug '
+                                  'ON dashboard (slug)')
+        MIRROR_CONNECTION.commit()
+    return MIRROR_CONNECTION
+
+
+def _get_meta(key, default=None):
+    row = _get_mirror_connection().execute('SELECT value FROM meta WHERE key = ?',
+                                           (key,)).fetchone()
+    return row[0] if row else default
+
+
+def _set_meta(key, value):
+    _get_mirror_connection().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                     (key, value))
+
+
+def _get_record_type():
+    '''Return the namedtuple for mirrored rows, built from the columns
+    recorded at the last sync.
+
+    '''
+    global DASHBOARD_RECORD
+    if DASHBOARD_RECORD is None:
+        columns = _get_meta('columns')
+        if not columns:
+            raise DashboardMirrorException('Mirror %s is empty, run --sync-mirror first.'
+                                           % CONFIGS.mirror_path)
+        DASHBOARD_RECORD = namedtuple('DashboardRecord', columns)
+    return DASHBOARD_RECORD
+
+
+def _decode_row(record):
+    return _get_record_type()(*pickle.loads(zlib.decompress(bytes(record))))
+
+
+def sync():
+    '''Bring the mirror up to date with the dashboard table. Only rows
+    updated since the previous sync are transferred, dashboards removed
+    from the database are removed from the mirror. Returns a tuple of
+    (rows fetched, rows deleted).
+
+    '''
+    connection = _get_mirror_connection()
+    last_updated = _get_meta('last_updated')
+    # >= rather than > since updated only has second resolution; rows
+    # written in the same second as the last sync are fetched again.
+    rows = sql_connector.get_dashboards_updated_since(last_updated)
+    record_type = sql_connector.DASHBOARD_RECORD
+    for row in rows:
+        dashboard = record_type(*row)
+        updated = dashboard.updated.strftime(UPDATED_FORMAT)
+        if last_updated is None or updated > last_updated:
+            last_updated = updated
+        connection.execute('INSERT OR REPLACE INTO dashboard '
+                           '(id, slug, version, updated, data_length, record) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (dashboard.id, dashboard.slug, dashboard.version, updated,
+                            len(dashboard.data),
+                            sqlite3.Binary(zlib.compress(pickle.dumps(tuple(row), 2)))))
+    live_ids = set(sql_connector.get_dashboard_ids())
+    mirrored_ids = [x[0] for x in connection.execute('SELECT id FROM dashboard')]
+    deleted = [x for x in mirrored_ids if x not in live_ids]
+    connection.executemany('DELETE FROM dashboard WHERE id = ?', [(x,) for x in deleted])
+    _set_meta('columns', ' '.join(record_type._fields))
+    if last_updated is not None:
+        _set_meta('last_updated', last_updated)
+    connection.commit()
+    return len(rows), len(deleted)
+
+
+def get_dashboard(dashboard_slug):
+    '''Find the dashboard with dashboard_slug in the mirror and return
+    it.
+
+    '''
+    ret = []
+    row = _get_mirror_connection().execute('SELECT record FROM dashboard WHERE slug = ?',
+                                           (dashboard_slug,)).fetchone()
+    if row:
+        ret = _decode_row(row[0])
+    return ret
+
+
+def get_dashboard_handles(required_terms=None, batch_size=100):
+    '''Return a dashboard_handle.DashboardHandle of every mirrored
+    dashboard, like sql_connector.get_dashboard_handles. Records are
+    decoded one at a time to count targets and match required_terms,
+    data is decoded again batch_size dashboards at a time on access.
+
+    '''
+    rows = []
+    for dashboard in get_dashboards(required_terms):
+        dashboard = _get_record_type()(*dashboard)
+        rows.append((dashboard.id, dashboard.slug, getattr(dashboard, 'title', None),
+                     dashboard.version, dashboard.updated, len(dashboard.data),
+                     dashboard_scheduler.target_count(dashboard.data)))
+    return dashboard_handle.make_handles(rows, get_dashboards_data, batch_size)
+
+
+def get_dashboards_data(dashboard_ids):
+    '''Return (id, data) of the mirrored dashboards with the given ids.
+
+    '''
+    if not dashboard_ids:
+        return []
+    rows = _get_mirror_connection().execute(
+        'SELECT record FROM dashboard WHERE id IN (%s)' % ', '.join(['?'] * len(dashboard_ids)),
+        tuple(dashboard_ids))
+    return [(x.id, x.data) for x in [_decode_row(row[0]) for row in rows]]
+
+
+def get_dashboards(required_terms=None):
+    '''Yield all mirrored dashboards as row tuples, like
+    sql_connector.get_dashboards. With required_terms only dashboards
+    whose data contains every term are yielded.
+
+    '''
+    _get_record_type()
+    for row in _get_mirror_connection().execute('SELECT record FROM dashboard ORDER BY id'):
+        dashboard = _decode_row(row[0])
+        if required_terms and not all(x in dashboard.data for x in required_terms):
+            continue
+        yield tuple(dashboard)
@@ -0,0 +1,97 @@
+'''Run a processor with a transform over every dashboard as a pipeline.
+
+The child per dashboard of iterate_grafana_dashboards fetches, decodes,
+transforms and writes its dashboard in sequence, leaving the database,
+the cpus and graphite idle most of the time. Here each step is a stage
+of a pipeline.Pipeline, all running at once:
+
+read       dashboards fetched by id in batches, one thread.
+decode     json decoded in a pool of pipeline_decode_processes.
+transform  the processor transform, pipeline_transform_threads threads
+           as transforms mostly wait on graphite finds.
+write      changed dashboards written in batches, one thread.
+
+The stages are connected by queues of pipeline_queue_size dashboards
+and the stage statistics are logged every report_interval seconds.
+sql_connector uses one connection at a time, read and write take turns
+on it.
+
+    python manip_grafana_db.py --iterator limit_panel_series --processor-argument lookup --pipeline
+
+'''
+import dashboard_processors
+from lazy_import import lazy_module
+import json_codec
+import multiprocessing
+import pipeline
+import threading
+
+sql_connector = lazy_module('sql_connector')
+
+LOGGER = None
+
+
+def _decode(data):
+    return json_codec.loads(data, ordered=True)
+
+
+def _chunks(items, chunk_size):
+    return [items[x:x + chunk_size] for x in range(0, len(items), chunk_size)]
+
+
+def run(processor_name, processor_arg=None, configs=None, dry_run=False, report_interval=10.0):
+    '''Run the transform of processor_name over every dashboard. configs
+    holds the pipeline_* settings. Returns the number of dashboards
+    changed.
+
+    '''
+    transform = dashboard_processors.get_transform(processor_name, processor_arg)
+    if transform is None:
+        raise dashboard_processors.ProcessorException('%s has no transform, it can not run in a '
+                                                      'pipeline.' % processor_name)
+    batch_size = int(getattr(configs, 'pipeline_batch_size', 100))
+    queue_size = int(getattr(configs, 'pipeline_queue_size', 200))
+    decode_processes = int(getattr(configs, 'pipeline_decode_processes', 4))
+    transform_threads = int(getattr(configs, 'pipeline_transform_threads', 16))
+    db_lock = threading.Lock()
+    decode_pool = multiprocessing.Pool(decode_processes)
+
+    def read(dashboard_ids):
+        with db_lock:
+            rows = sql_connector.get_dashboards_by_id(dashboard_ids)
+        return [sql_connector.DASHBOARD_RECORD(*x) for x in rows]
+
+    def decode(dashboard):
+        return dashboard, decode_pool.apply(_decode, (dashboard.data,))
+
+    def apply_transform(decoded):
+        dashboard, dashboard_obj = decoded
+        changes = transform(dashboard.slug, dashboard_obj)
+        if not changes:
+            return None
+        for change in changes:
+            LOGGER.info('%s: %s', dashboard.slug, change)
+        return json_codec.dumps(dashboard_obj), dashboard.id
+
+    def write(updates):
+        if dry_run:
+            return len(updates)
+        with db_lock:
+            return sum(sql_connector.update_dashboards_data(updates, chunk_size=batch_size))
+
+    pipe = pipeline.Pipeline(
+        [pipeline.Stage('read', read, queue_size=queue_size, expand=True),
+         pipeline.Stage('decode', decode, workers=decode_processes, queue_size=queue_size),
+         pipeline.Stage('transform', apply_transform, workers=transform_threads,
+                        queue_size=queue_size),
+         pipeline.Stage('write', write, queue_size=queue_size, batch_size=batch_size)],
+        on_error=lambda stage, error: LOGGER.error('%s stage failed: %s', stage, error))
+    with db_lock:
+        dashboard_ids = sql_connector.get_dashboard_ids()
+    try:
+        changed = sum(pipe.run(_chunks(list(dashboard_ids), batch_size), report=LOGGER.info,
+                               report_interval=report_interval))
+    finally:
+        decode_pool.terminate()
+    LOGGER.info('Pipeline done: %s', pipe.format_stats())
+    return changed
@@ -1,15 +1,43 @@
 '''Processors to be used by manip_grafana_db
 
 '''
-import simplejson as json
+import aggregations
+import difflib
+import json_codec
 import re
-import rpn
-import sql_connector
-import validate_metrics
-
+from lazy_import import lazy_module
+import panel_stream
+import processor_registry
+import sre_parse
+import target_ast
+import target_consolidation
+from time import time
+
+metric_renames = lazy_module('metric_renames')
+multiprocessing_pool = lazy_module('multiprocessing.pool')
+panel_limits = lazy_module('panel_limits')
+query_cost = lazy_module('query_cost')
+refresh_governor = lazy_module('refresh_governor')
+rpn = lazy_module('rpn')
+sql_connector = lazy_module('sql_connector')
+target_memo = lazy_module('target_memo')
+validate_metrics = lazy_module('validate_metrics')
+
+AGGREGATORS = {}
+BUILT_TRANSFORMS = {}  # (processor name, argument): transform, see get_transform.
+CHILDLESS_PARAMS = ('avg', 'count', 'max', 'min', 'sum', 'value')  # Context names without a value.
+COST_ESTIMATORS = {}  # Namespace snapshot path: query_cost estimator, see _get_cost_estimator.
+DASHBOARD_DEADLINE = None  # time() after which processors give up on the dashboard.
+DRY_RUN = False  # Log a diff of the changes instead of writing dashboards.
 LOGGER = None
 METRIC_CATEGORIES = ('md', 'agg', 'collectd')
+MIN_PREFILTER_TERM_LENGTH = 3
+PREFILTERS = {}
 PROCESSORS = {}
+TRANSFORMS = {}
+TARGET_CONCURRENCY = 8  # Targets of a dashboard update_old_paths looks up at once.
+TARGET_LOOKUP_LIMIT = 50  # Graphite lookups update_old_paths may make per target.
+TARGET_TIMEOUT = 60  # Seconds update_old_paths may spend per target, None for no limit.
 
 
 class ProcessorException(Exception):
@@ -17,14 +45,50 @@ class ProcessorException(Exception):
         super(ProcessorException, self).__init__(msg)
 
 
+class DeadlineExceeded(ProcessorException):
+    def __init__(self, msg=''):
+        super(DeadlineExceeded, self).__init__(msg)
+
+
 def initialize(**kargs):
     validate_metrics.initialize(**kargs)
+    target_memo.initialize(**kargs)
 
 
 def list_processors():
-    return '\n\n'.join(['%s - %s'
-                        % (i, PROCESSORS[i].__doc__.strip())
-                        for i in PROCESSORS])
+    return processor_registry.list_processors()
+
+
+def get_prefilter_terms(processor_name, processor_arg=None):
+    '''Return the substrings the data of every dashboard processor_name
+    can act on contains, or None if every dashboard has to be processed.
+
+    '''
+    if processor_name not in PREFILTERS:
+        return None
+    terms = [x for x in PREFILTERS[processor_name](processor_arg) or []
+             if len(x) >= MIN_PREFILTER_TERM_LENGTH]
+    return terms or None
+
+
+def _regex_literals(pattern):
+    '''Return the literal runs at the top level of regex pattern, each
+    of which is part of every string the regex matches. Returns an
+    empty list if the pattern is case insensitive.
+
+    '''
+    if re.compile(pattern).flags & re.IGNORECASE:
+        return []
+    literals = []
+    run = []
+    for op_code, value in list(sre_parse.parse(pattern)) + [(None, None)]:
+        if op_code == sre_parse.LITERAL and value < 128:
+            run.append(chr(value))
+        else:
+            if run:
+                literals.append(''.join(run))
+            run = []
+    return literals
 
 
 def _get_path(grafana_metric_path):
@@ -44,14 +108,14 @@ def _get_target_panel_title(data, search_target):
 
     '''
     graph_matches = []
-    for panel in _yield_panels(data):
-        if 'targets' not in panel:
-            continue
-        for target in panel['targets']:
-            target_path = _get_path(target['target'])
+    for panel in panel_stream.iter_panels(data):
+        for target in panel.targets or ():
+            if target.target is None:
+                continue
+            target_path = _get_path(target.target)
             if search_target in target_path:
-                panel_title = panel['title'] if panel['title'] \
-                              else 'panelId=%s' % panel['id']
+                panel_title = panel.title if panel.title \
+                              else 'panelId=%s' % panel.id
                 graph_matches.append(panel_title)
     return graph_matches
 
@@ -61,10 +125,7 @@ def _get_template_variable_value(data, variable_name):
     variable_name.
 
     '''
-    try:
-        json_data = json.loads(data)
-    except Exception:
-        json_data = json.loads(data, encoding="latin-1")
+    json_data = json_codec.loads(data)
     variable_name = variable_name.strip('$')
     for template in json_data['templating']['list']:
         if template['name'] == variable_name:
@@ -73,16 +134,101 @@ def _get_template_variable_value(data, variable_name):
                     return option['value']
 
 
-def _yield_panels(data):
-    try:
-        json_data = json.loads(data)
-    except Exception:
-        json_data = json.loads(data, encoding="latin-1")
-    for rows in json_data['rows']:
-        for panel in rows['panels']:
-            if'targets' not in panel:
-                continue
-            yield panel
+def _check_deadline(dashboard):
+    if DASHBOARD_DEADLINE is not None and time() > DASHBOARD_DEADLINE:
+        raise DeadlineExceeded('Deadline exceeded processing %s.' % dashboard.slug)
+
+
+def _write_dashboard(dashboard, new_data):
+    '''Write new_data as the data of dashboard. With DRY_RUN only log
+    the diff between the two.
+
+    '''
+    if not DRY_RUN:
+        return sql_connector.update_dashboard_data(new_data, dashboard.id)
+    old_lines, new_lines = [json_codec.dumps(json_codec.loads(x, ordered=True),
+                                             indent=2).splitlines()
+                            for x in (dashboard.data, new_data)]
+    LOGGER.info('dry run, not updating %s:\n%s', dashboard.slug,
+                '\n'.join(difflib.unified_diff(old_lines, new_lines, dashboard.slug,
+                                                dashboard.slug, lineterm='')))
+    return new_data
+
+
+def make_prefilter(processor_name):
+    '''Register the decorated function as the prefilter of
+    processor_name. A prefilter takes the processor argument and returns
+    a list of substrings the dashboard data has to contain for the
+    processor to match anything. The iterator pushes them down to the
+    database so only candidate dashboards are transferred; processors
+    still do their exact matching on the candidates.
+
+    '''
+    def decorator(fun):
+        PREFILTERS[processor_name] = fun
+        return fun
+    return decorator
+
+
+def make_aggregator(processor_name):
+    '''Register the decorated function as the aggregator of
+    processor_name. It takes the processor argument and returns the
+    aggregations object (see aggregations) the results processor_name
+    returns for every dashboard are combined into. Processors without
+    one return nothing and only log.
+
+    '''
+    def decorator(fun):
+        AGGREGATORS[processor_name] = fun
+        return fun
+    return decorator
+
+
+def get_aggregator(processor_name, processor_arg=None):
+    '''Return a new aggregator for the results of processor_name, None if
+    it has none.
+
+    '''
+    if processor_name not in AGGREGATORS:
+        return None
+    return AGGREGATORS[processor_name](processor_arg)
+
+
+def make_transform(processor_name):
+    '''Register the decorated function as the transform of
+    processor_name. It takes the processor argument and returns a
+    function changing a dashboard dict in place, called with the slug
+    and the dict and returning the list of changes made. Processors
+    with a transform can also run in a dashboard_pipeline.
+
+    '''
+    def decorator(fun):
+        TRANSFORMS[processor_name] = fun
+        return fun
+    return decorator
+
+
+def get_transform(processor_name, processor_arg=None):
+    '''Return the transform of processor_name, None if it has none. It
+    is built once per processor_arg, the mapping and policy files
+    transforms load are read for the first dashboard only.
+
+    '''
+    if processor_name not in TRANSFORMS:
+        return None
+    key = (processor_name, processor_arg)
+    if key not in BUILT_TRANSFORMS:
+        BUILT_TRANSFORMS[key] = TRANSFORMS[processor_name](processor_arg)
+    return BUILT_TRANSFORMS[key]
+
+
+def _transform_dashboard(processor_name, dashboard, processor_arg=None):
+    dashboard_obj = json_codec.loads(dashboard.data, ordered=True)
+    changes = get_transform(processor_name, processor_arg)(dashboard.slug, dashboard_obj)
+    for change in changes:
+        LOGGER.info('%s: %s', dashboard.slug, change)
+    if changes:
+        _write_dashboard(dashboard, json_codec.dumps(dashboard_obj))
 
 
 def make_db_processor(fun):
@@ -107,29 +253,19 @@ def find_dashboard_with_metric(dashboard, search_metric=None):
         LOGGER.error(('find_dashboard_with_metric requires a search metric, '
                       'use --processor-argument from the cli.'))
         exit(0)
-    target_regex = re.compile('target":\s*"([^"]*)"')
+    memo = target_memo.get_memo('find_dashboard_with_metric')
     matches_in_dashboard = []
-    for match in target_regex.findall(dashboard.data):
-        path = _get_path(match)
-        program_id, _, working = path.partition('.')
-        metric_name, _, working = working.partition('.')
-        if path == search_metric:
-            graph_matches = _get_target_panel_title(dashboard.data, path)
-            matches_in_dashboard.append((dashboard.slug,
-                                         ', '.join(graph_matches),
-                                         'MATCH', search_metric))
-        else:
-            program_id_search_metric, _, working = search_metric.partition('.')
-            metric_name_search_metric, _, working = working.partition('.')
-            if program_id_search_metric == program_id \
-               and metric_name_search_metric == metric_name:
-                partial_path = '.'.join([program_id_search_metric,
-                                         metric_name_search_metric])
-                graph_matches = _get_target_panel_title(dashboard.data,
-                                                        partial_path)
-                matches_in_dashboard.append((dashboard.slug,
-                                             ', '.join(graph_matches),
-                                             'SIMILAR', path))
+    panel_titles = {}
+    for target in panel_stream.iter_targets(dashboard.data):
+        match, path, search_path = memo.get([target.target, search_metric],
+                                            lambda: _match_metric(target.target, search_metric))
+        if not match:
+            continue
+        if search_path not in panel_titles:
+            panel_titles[search_path] = ', '.join(_get_target_panel_title(dashboard.data,
+                                                                          search_path))
+        matches_in_dashboard.append((dashboard.slug, panel_titles[search_path], match,
+                                     search_metric if match == 'MATCH' else path))
     if matches_in_dashboard:
         [LOGGER.info('"%s" graph "%s" contains %s: %s', *x)
          for x in matches_in_dashboard]
@@ -137,6 +273,32 @@ def find_dashboard_with_metric(dashboard, search_metric=None):
         LOGGER.debug('No matches for "%s" found.' % search_metric)
 
 
+def _match_metric(grafana_target, search_metric):
+    '''Return (match, path, search path) of a target for
+    find_dashboard_with_metric, match is 'MATCH', 'SIMILAR' (same
+    program_id.metric_name) or None.
+
+    '''
+    path = _get_path(grafana_target)
+    if path == search_metric:
+        return 'MATCH', path, path
+    program_id, _, working = path.partition('.')
+    metric_name = working.partition('.')[0]
+    program_id_search_metric, _, working = search_metric.partition('.')
+    metric_name_search_metric = working.partition('.')[0]
+    if program_id_search_metric == program_id and metric_name_search_metric == metric_name:
+        return 'SIMILAR', path, '.'.join([program_id_search_metric, metric_name_search_metric])
+    return None, path, None
+
+
+@make_prefilter('find_dashboard_with_metric')
+def _find_dashboard_with_metric_prefilter(search_metric=None):
+    # Exact and SIMILAR matches both start with program_id.metric_name.
+    if not search_metric:
+        return None
+    return ['.'.join(search_metric.split('.')[:2])]
+
+
 @make_db_processor
 def find_dashboards_with_datasource(dashboard, processor_arg=None):
     '''Find dashboards with the specified datasource.
@@ -147,6 +309,11 @@ def find_dashboards_with_datasource(dashboard, processor_arg=None):
         LOGGER.info('Dashboard %s uses %s' % (dashboard.slug, processor_arg))
 
 
+@make_prefilter('find_dashboards_with_datasource')
+def _find_dashboards_with_datasource_prefilter(processor_arg=None):
+    return _regex_literals('datasource":\s*"%s"' % processor_arg)
+
+
 @make_db_processor
 def find_dashboard_with_regex(dashboard, search_regex=None):
     '''Find the given metric in the dashboard.
@@ -168,6 +335,13 @@ def find_dashboard_with_regex(dashboard, search_regex=None):
         LOGGER.debug('No matches for "%s" found.' % search_regex)
 
 
+@make_prefilter('find_dashboard_with_regex')
+def _find_dashboard_with_regex_prefilter(search_regex=None):
+    if not search_regex:
+        return None
+    return _regex_literals(search_regex)
+
+
 @make_db_processor
 def update_datasource(dashboard, processor_arg=None):
     '''Updates current datasource in dashboards to the specified
@@ -187,7 +361,7 @@ datasource. processor_arg is expected to be a two element tuple as
     # Don't update if there's no change
     if new_data != dashboard.data:
         LOGGER.info('updating %s', dashboard.slug)
-        sql_connector.update_dashboard_data(new_data, dashboard.id)
+        _write_dashboard(dashboard, new_data)
     else:
         LOGGER.info('skipping %s, no change.', dashboard.slug)
 
@@ -197,17 +371,22 @@ def update_old_paths(dashboard, processor_arg=None):
     '''Try to modify the target path to the updated path.
 
     '''
-    childless_params = ['avg', 'count', 'max', 'min', 'sum', 'value']
-    new_data = dashboard.data
-    for panel in _yield_panels(new_data):
-        if panel['datasource'] in ['null', 'Aggregate All Global']:
+    # Cloned dashboards share their targets, the new path of a target is
+    # looked up once across dashboards and children, see target_memo.
+    memo = target_memo.get_memo('update_old_paths', persistent=True,
+                                keep=lambda x: x[0] != 'failed')
+    rewrites = target_memo.get_memo('rewrite_target')
+    program_values = {}
+    dashboard_obj = json_codec.loads(dashboard.data, ordered=True)
+    work = []
+    for panel in _iter_panel_dicts(dashboard_obj):
+        if 'targets' not in panel:
+            continue
+        if panel.get('datasource') in ['null', 'Aggregate All Global']:
             LOGGER.warn('In %s, skipping %s, global metric.', dashboard.slug,
                         ' and skipping '.join([x['target']
                                                for x in panel['targets']]))
             continue
-        if 'targets' not in panel:
-            continue
-        ref_id = 'A'
         for target in panel['targets']:
             if 'datasource' in target:
                 if target['datasource'] in ['null', 'Aggregate All Global']:
@@ -215,163 +394,381 @@ def update_old_paths(dashboard, processor_arg=None):
                                 dashboard.slug, target['target'])
                     continue
             path = _get_path(target['target'])
-            new_path = None
-            program_id, _, working = path.partition('.')
-            update_able = False
-            if '_rt' in program_id or 'collectd' in program_id:
-                continue
+            program_id = path.partition('.')[0]
+            program_value = None
+            if '.' in path and program_id.startswith('$'):
+                if program_id not in program_values:
+                    program_values[program_id] = 'riak_adquality_prod' \
+                        if 'Riak Multiview' in dashboard.slug \
+                        else _get_template_variable_value(dashboard.data, program_id)
+                program_value = program_values[program_id]
+            work.append((panel, target, path, program_value))
+
+    # The targets are independent, their new paths are looked up
+    # TARGET_CONCURRENCY at a time; the results are applied below in
+    # document order.
+    def resolve(key):
+        _check_deadline(dashboard)
+        return memo.get(list(key), lambda: _new_metric_path(dashboard, key[0], key[1]))
+    keys = sorted(set([(x[2], x[3]) for x in work]),
+                  key=lambda x: (x[0], x[1] or ''))
+    resolved = dict(zip(keys, _map_concurrently(resolve, keys, TARGET_CONCURRENCY)))
+
+    changed = False
+    for panel, target, path, program_value in work:
+        state, new_path = resolved[(path, program_value)]
+        if state == 'star':
+            LOGGER.warn('In %s, original metric good %s, just using * instead of md.',
+                        dashboard.slug, path)
+        elif state == 'unusual':
+            LOGGER.info('not update-able metric %s, unusual metric.', path)
+        elif state == 'missing':
+            LOGGER.warn('In %s: not update-able: orginal metric %s does not exist.',
+                        dashboard.slug, path)
+        elif state in ('stuck', 'failed'):
+            LOGGER.info('In %s: not update-able: %s -- %s', dashboard.title, path, new_path)
+        elif state == 'update':
+            LOGGER.info('update-able metric: %s for %s', new_path, path)
+            target['target'] = rewrites.get([target['target'], path, new_path],
+                                            lambda: _process_target(target, path, new_path))
+            if not target.get('refId'):
+                # Existing refIds stay, other targets may refer to them (#A).
+                target['refId'] = _free_ref_id(panel['targets'])
+            changed = True
+        elif state == 'good':
+            LOGGER.info('Already good %s', path)
+
+    if changed:
+        _write_dashboard(dashboard, json_codec.dumps(dashboard_obj))
+
+
+def _iter_panel_dicts(node):
+    '''Yield the dicts in every panels list of the dashboard dict node,
+    in document order, as panel_stream.iter_panel_objects does for its
+    json.
+
+    '''
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'panels' and isinstance(value, list):
+                for panel in value:
+                    if isinstance(panel, dict):
+                        yield panel
+            else:
+                for panel in _iter_panel_dicts(value):
+                    yield panel
+    elif isinstance(node, list):
+        for item in node:
+            for panel in _iter_panel_dicts(item):
+                yield panel
+
+
+def _free_ref_id(targets):
+    '''Return the first refId, A to Z then AA..., no target of targets
+    uses.
+
+    '''
+    used = set([x.get('refId') for x in targets])
+    letters = [chr(x) for x in range(ord('A'), ord('Z') + 1)]
+    for ref_id in letters + [x + y for x in letters for y in letters]:
+        if ref_id not in used:
+            return ref_id
+
+
+def _map_concurrently(fun, items, concurrency):
+    '''Return [fun(x) for x in items], with at most concurrency calls
+    at once in threads. The first exception of fun is raised.
+
+    '''
+    if concurrency <= 1 or len(items) <= 1:
+        return [fun(x) for x in items]
+    pool = multiprocessing_pool.ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(fun, items, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+def _new_metric_path(dashboard, path, program_value=None):
+    '''Return (state, new path) of the metric path of an update_old_paths
+    target of dashboard. program_value is the value of a templated
+    program_id. state is one of:
+
+    skip      realtime and collectd metrics, not updated.
+    star      a good metric, using * instead of md.
+    unusual   a single node.
+    good      already in one of METRIC_CATEGORIES.
+    update    the new path exists.
+    missing   not update-able, the metric does not exist.
+    stuck     not update-able, no new path matches.
+    failed    not update-able, matching gave up or failed.
+
+    '''
+    new_path = None
+    program_id, _, working = path.partition('.')
+    update_able = False
+    failed = False
+    if '_rt' in program_id or 'collectd' in program_id:
+        return 'skip', None
+    metric_name, _, working = working.partition('.')
+    # Check if * has been used to indicate 'md'
+    if metric_name == '*' and working[0] != '*':
+        if validate_metrics.metric_exists('%s.md.%s'
+                                          % (program_id,
+                                             working.split('.')[0]))[-1]\
+           and validate_metrics.metric_exists('%s.md.%s'
+                                              % (program_id, working)):
+            return 'star', None
+    if len(path.split('.')) == 1:
+        return 'unusual', None
+    program_id_changed = False
+    if program_id.startswith('$'):
+        program_id_changed = program_id
+        program_id = program_value
+    metric_name_changed = False
+    if metric_name not in METRIC_CATEGORIES:
+        metric_type = 'md'
+        if metric_name == 'quorra-conv':
+            metric_type = 'agg'
             metric_name, _, working = working.partition('.')
-            # Check if * has been used to indicate 'md'
-            if metric_name == '*' and working[0] != '*':
-                if validate_metrics.metric_exists('%s.md.%s'
-                                                  % (program_id,
-                                                     working.split('.')[0]))[-1]\
-                   and validate_metrics.metric_exists('%s.md.%s'
-                                                      % (program_id, working)):
-                    LOGGER.warn('In %s, original metric good %s, just using * instead of md.',
-                                dashboard.slug, path)
-                    continue
-            if len(path.split('.')) == 1:
-                LOGGER.info('not update-able metric %s, unusual metric.', path)
-                continue
-            program_id_changed = False
-            if program_id.startswith('$'):
-                program_id_changed = program_id
-                if 'Riak Multiview' in dashboard.slug:
-                    program_id = 'riak_adquality_prod'
-                else:
-                    program_id = _get_template_variable_value(new_data,
-                                                              program_id)
-            metric_name_changed = False
-            if metric_name not in METRIC_CATEGORIES:
-                metric_type = 'md'
-                if metric_name == 'quorra-conv':
-                    metric_type = 'agg'
-                    metric_name, _, working = working.partition('.')
-                if metric_name.startswith('$'):
-                    metric_name_changed = metric_name
-                    metric_name = '*'
-                # Old metric path was
-                #   program_id.metric_name.<context_name_context_value>.<host>.<type>.value
-                # New metric path is
-                #   program_id.md.metric_name.<context_name>.<context_value>.host.<host>.<type>.value
-                rest_of_path = working.split('.')
-                if len(rest_of_path) == 3:  # If only three, just host, type value are being used
-                    if rest_of_path[0].startswith('$') or rest_of_path[0].startswith('{'):
-                        host_value = '*'
-                    else:
-                        host_value = rest_of_path[0]
-                    new_path = '%s.%s.%s.host.%s.%s.%s' % (program_id, metric_type,
-                                                           metric_name, host_value,
-                                                           rest_of_path[1], rest_of_path[2])
-                    if validate_metrics.metric_exists(new_path)[-1]:
-                        update_able = True
-                    # Have to put the templating back in after we test
-                    # that the metric exists and is correct.
-                    if rest_of_path[0].startswith('$') or rest_of_path[0].startswith('{'):
-                        new_path = '%s.%s.%s.host.%s.%s.%s' % (program_id, metric_type, metric_name,
-                                                               rest_of_path[0],
-                                                               rest_of_path[1],
-                                                               rest_of_path[2])
-                else:  # If more than 3 left, contexts are being used
-                    new_path = '%s.%s.%s' % (program_id, metric_type, metric_name)
-                    children = validate_metrics.metric_children(new_path)
-                    try:
-                        # Go through children and attempt to match
-                        # children to values in the path.
-                        while children:
-                            if len(children) == 1:  # context name
-                                if children[0] in working:
-                                    for context in rest_of_path:
-                                        if children[0] in context:
-                                            # If not a childless_param and '_' in param, it is
-                                            # possibly a joined context_name_context_value
-                                            if children[0] not in childless_params \
-                                               and '_' in context:
-                                                new_path += '.%s.%s' \
-                                                            % (children[0],
-                                                               context.split(children[0]+'_')[-1])
-                                                rest_of_path.remove(context)
-                                            else:
-                                                rest_of_path.remove(context)
-                                                new_path += '.%s' % children[0]
-                                            break
-                                elif '*' in rest_of_path:
-                                    context_name = children[0]
-                                    if context_name in rest_of_path:
-                                        context_value \
-                                            = rest_of_path.pop(rest_of_path.index(context_name)+1)
-                                    elif '*' == rest_of_path[0]:
-                                        rest_of_path.pop(0)  # Remove * for context name
-                                    if rest_of_path:
-                                        if rest_of_path[0] != context_name:  # Context out of place
-                                            if '*' in rest_of_path:
-                                                # Remove another *,
-                                                # hoping context_value
-                                                # is also represented
-                                                # as *
-                                                rest_of_path.remove('*')
-                                                context_value = '*'
-                                            else:
-                                                context_value = '*'
-                                    else:  # Out of rest of path options.. assume * mismatch
-                                        context_value = '*'
-                                    if context_name not in childless_params:
-                                        new_path += '.%s.%s' % (context_name, context_value)
+        if metric_name.startswith('$'):
+            metric_name_changed = metric_name
+            metric_name = '*'
+        # Old metric path was
+        #   program_id.metric_name.<context_name_context_value>.<host>.<type>.value
+        # New metric path is
+        #   program_id.md.metric_name.<context_name>.<context_value>.host.<host>.<type>.value
+        rest_of_path = working.split('.')
+        if len(rest_of_path) == 3:  # If only three, just host, type value are being used
+            if rest_of_path[0].startswith('$') or rest_of_path[0].startswith('{'):
+                host_value = '*'
+            else:
+                host_value = rest_of_path[0]
+            new_path = '%s.%s.%s.host.%s.%s.%s' % (program_id, metric_type,
+                                                   metric_name, host_value,
+                                                   rest_of_path[1], rest_of_path[2])
+            if validate_metrics.metric_exists(new_path)[-1]:
+                update_able = True
+            # Have to put the templating back in after we test
+            # that the metric exists and is correct.
+            if rest_of_path[0].startswith('$') or rest_of_path[0].startswith('{'):
+                new_path = '%s.%s.%s.host.%s.%s.%s' % (program_id, metric_type, metric_name,
+                                                       rest_of_path[0],
+                                                       rest_of_path[1],
+                                                       rest_of_path[2])
+        else:  # If more than 3 left, contexts are being used
+            new_path = '%s.%s.%s' % (program_id, metric_type, metric_name)
+            children = validate_metrics.metric_children(new_path)
+            matched = True
+            lookups = 1
+            target_deadline = time() + TARGET_TIMEOUT if TARGET_TIMEOUT else None
+            try:
+                # Go through children and attempt to match
+                # children to values in the path.
+                while children:
+                    _check_deadline(dashboard)
+                    if lookups >= TARGET_LOOKUP_LIMIT \
+                       or (target_deadline and time() > target_deadline):
+                        LOGGER.warn('In %s: gave up matching %s after %s lookups at %s.',
+                                    dashboard.slug, path, lookups, new_path)
+                        matched = False
+                        failed = True
+                        break
+                    if len(children) == 1:  # context name
+                        if children[0] in working:
+                            for context in rest_of_path:
+                                if children[0] in context:
+                                    # If not a childless param and '_' in param, it is
+                                    # possibly a joined context_name_context_value
+                                    if children[0] not in CHILDLESS_PARAMS \
+                                       and '_' in context:
+                                        new_path += '.%s.%s' \
+                                                    % (children[0],
+                                                       context.split(children[0]+'_')[-1])
+                                        rest_of_path.remove(context)
                                     else:
-                                        new_path += '.%s' % context_name
-                                        # remove whatever is being
-                                        # used to represent the
-                                        # childless param
-                                        rest_of_path.pop()
-                                elif children[0] == 'host':
-                                    new_path += '.host.%s' % rest_of_path.pop(0)
-                                else:
-                                    # Mismatched placeholders
-                                    if len(children) == 1:
-                                        new_path = '%s.%s' % (new_path, children[0])
-                                    if len(children) > 1:  # If we're dealing with a context
-                                        new_path += '.*'
+                                        rest_of_path.remove(context)
+                                        new_path += '.%s' % children[0]
+                                    break
+                        elif '*' in rest_of_path:
+                            context_name = children[0]
+                            if context_name in rest_of_path:
+                                context_value \
+                                    = rest_of_path.pop(rest_of_path.index(context_name)+1)
+                            elif '*' == rest_of_path[0]:
+                                rest_of_path.pop(0)  # Remove * for context name
+                            if rest_of_path:
+                                if rest_of_path[0] != context_name:  # Context out of place
+                                    if '*' in rest_of_path:
+                                        # Remove another *,
+                                        # hoping context_value
+                                        # is also represented
+                                        # as *
+                                        rest_of_path.remove('*')
+                                        context_value = '*'
                                     else:
-                                        machine, resp = validate_metrics.metric_exists(new_path)
+                                        context_value = '*'
+                            else:  # Out of rest of path options.. assume * mismatch
+                                context_value = '*'
+                            if context_name not in CHILDLESS_PARAMS:
+                                new_path += '.%s.%s' % (context_name, context_value)
                             else:
+                                new_path += '.%s' % context_name
+                                # remove whatever is being
+                                # used to represent the
+                                # childless param
+                                rest_of_path.pop()
+                        elif children[0] == 'host':
+                            new_path += '.host.%s' % rest_of_path.pop(0)
+                        else:
+                            # Mismatched placeholders
+                            if len(children) == 1:
+                                new_path = '%s.%s' % (new_path, children[0])
+                            if len(children) > 1:  # If we're dealing with a context
                                 new_path += '.*'
-                            children = validate_metrics.metric_children(new_path)
-                    except Exception:
-                        import pdb; pdb.set_trace()
-                    if rest_of_path:
-                        update_able = False
-                    else:
-                        update_able = True
-                if metric_name_changed:
-                    # Metric was a variable and was changed to *, so
-                    # need to replace the * with the original variable.
-                    metric_name = metric_name_changed
-                    new_path = new_path.replace('%s.*' % metric_type,
-                                                '%s.%s' % (metric_type, metric_name_changed))
-                if program_id_changed:
-                    # Program id was a variable and changed to a
-                    # particular value, need to replace it with the
-                    # original variable.
-                    new_path = new_path.replace(program_id, program_id_changed, 1)
-                if not update_able:
-                    if not validate_metrics.metric_exists(path)[-1]:
-                        LOGGER.warn('In %s: not update-able: orginal metric %s does not exist.',
-                                    dashboard.slug, path)
+                            else:
+                                machine, resp = validate_metrics.metric_exists(new_path)
                     else:
-                        LOGGER.info('In %s: not update-able: %s -- %s', dashboard.title, path,
-                                    new_path)
-                else:
-                    LOGGER.info('update-able metric: %s for %s', new_path, path)
-                    new_target = _process_target(target, path, new_path)
-                    new_target['refId'] = ref_id
-                    new_data = new_data.replace(target['target'], new_target)
-                    ref_id = chr(ord(ref_id) + 1)
+                        new_path += '.*'
+                    children = validate_metrics.metric_children(new_path)
+                    lookups += 1
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                LOGGER.exception('In %s: failed matching %s at %s.', dashboard.slug, path,
+                                 new_path)
+                matched = False
+                failed = True
+            if rest_of_path or not matched:
+                update_able = False
             else:
-                LOGGER.info('Already good %s', path)
+                update_able = True
+        if metric_name_changed:
+            # Metric was a variable and was changed to *, so
+            # need to replace the * with the original variable.
+            metric_name = metric_name_changed
+            new_path = new_path.replace('%s.*' % metric_type,
+                                        '%s.%s' % (metric_type, metric_name_changed))
+        if program_id_changed:
+            # Program id was a variable and changed to a
+            # particular value, need to replace it with the
+            # original variable.
+            new_path = new_path.replace(program_id, program_id_changed, 1)
+        if update_able:
+            return 'update', new_path
+        if failed:
+            return 'failed', new_path
+        if not validate_metrics.metric_exists(path)[-1]:
+            return 'missing', new_path
+        return 'stuck', new_path
+    return 'good', None
 
-    if new_data != dashboard.data:
-        sql_connector.update_dashboard_data(new_data, dashboard.id)
+
+@make_db_processor
+def limit_panel_series(dashboard, processor_arg=None):
+    '''Split panels and rows over the series limits in conf.ini, render
+heavy dashboards as png and cap the data points of panels that can't
+be split. With processor_arg "lookup" glob fan-out is counted with
+graphite finds, otherwise every glob counts as one series.
+
+    '''
+    _transform_dashboard('limit_panel_series', dashboard, processor_arg)
+
+
+@make_transform('limit_panel_series')
+def _limit_panel_series_transform(processor_arg=None):
+    count_glob = validate_metrics.count_series if processor_arg == 'lookup' else None
+    limits = panel_limits.PanelLimits(count_glob=count_glob)
+    return lambda slug, dashboard_obj: limits.apply_to_dashboard(dashboard_obj)
+
+
+def _get_cost_estimator(snapshot_path=None):
+    '''Return the query_cost estimator of snapshot_path, built once so
+    the snapshot is read and every glob counted once for all dashboards.
+
+    '''
+    if snapshot_path not in COST_ESTIMATORS:
+        COST_ESTIMATORS[snapshot_path] = query_cost.get_estimator(snapshot_path)
+    return COST_ESTIMATORS[snapshot_path]
+
+
+@make_db_processor
+def estimate_query_cost(dashboard, processor_arg=None):
+    '''Estimate the graphite load of the dashboard and of its heaviest
+panels, see query_cost. processor_arg is an optional namespace
+snapshot file to count glob fan-out with instead of graphite finds.
+
+    '''
+    cost = _get_cost_estimator(processor_arg).dashboard_cost(
+        dashboard.slug, json_codec.loads(dashboard.data))
+    LOGGER.info('%s costs %.0f series hours per hour: %s series fetched, %s returned, '
+                '%.1f refreshes per hour, %.1f hours range', cost.slug, cost.cost, cost.fetched,
+                cost.series, cost.refreshes_per_hour, cost.range_hours)
+    for panel in cost.panels[:5]:
+        LOGGER.info('%s panel "%s" costs %.0f: %s series fetched, %s returned', panel.slug,
+                    panel.title, panel.cost, panel.fetched, panel.series)
+
+
+@make_db_processor
+def govern_refresh(dashboard, processor_arg=None):
+    '''Clamp the refresh interval, refresh options and time range of the
+dashboard to the policy file given as processor_arg, see
+refresh_governor.
+
+    '''
+    _transform_dashboard('govern_refresh', dashboard, processor_arg)
+
+
+@make_transform('govern_refresh')
+def _govern_refresh_transform(processor_arg=None):
+    if not processor_arg:
+        raise ProcessorException('govern_refresh requires a policy file as processor argument.')
+    return refresh_governor.RefreshGovernor.from_file(
+        processor_arg, get_estimator=_get_cost_estimator).apply
+
+
+@make_db_processor
+def consolidate_targets(dashboard, processor_arg=None):
+    '''Fold targets of a panel differing in one path node only into one
+target with a brace glob, e.g. a.ca.b and a.lc.b into a.{ca,lc}.b,
+see target_consolidation.
+
+    '''
+    _transform_dashboard('consolidate_targets', dashboard, processor_arg)
+
+
+def _consolidate_dashboard_targets(slug, dashboard_obj):
+    changes = []
+    for row in dashboard_obj.get('rows') or []:
+        for panel in row.get('panels') or []:
+            targets, panel_removed = target_consolidation.consolidate(panel.get('targets') or [])
+            if panel_removed:
+                changes.append('panel "%s": %s targets folded into %s'
+                               % (panel.get('title'), len(panel['targets']), len(targets)))
+                panel['targets'] = targets
+    return changes
+
+
+@make_transform('consolidate_targets')
+def _consolidate_targets_transform(processor_arg=None):
+    return _consolidate_dashboard_targets
+
+
+@make_db_processor
+def rename_metrics(dashboard, processor_arg=None):
+    '''Rename the metric paths of the targets from the old to new mapping
+file given as processor_arg, keeping functions and aliases and moving
+aliasByNode node numbers with the nodes, see metric_renames.
+
+    '''
+    _transform_dashboard('rename_metrics', dashboard, processor_arg)
+
+
+@make_transform('rename_metrics')
+def _rename_metrics_transform(processor_arg=None):
+    if not processor_arg:
+        raise ProcessorException('rename_metrics requires a mapping file as processor argument.')
+    return metric_renames.MetricRenamer.from_file(processor_arg).apply
 
 
 def _update_node_alias(grafana_target):
@@ -401,17 +798,108 @@ def _process_target(target, path, new_path):
     return new_grafana_target
 
 
+@make_db_processor
+def count_datasources(dashboard, processor_arg=None):
+    '''Count the dashboards using every datasource, panels without one
+use the default datasource.
+
+    '''
+    datasources = set()
+    for panel in panel_stream.iter_panels(dashboard.data):
+        datasources.add(panel.datasource or 'default')
+        datasources.update([x.datasource for x in panel.targets or () if x.datasource])
+    return dict([(x, 1) for x in datasources])
+
+
+@make_aggregator('count_datasources')
+def _count_datasources_aggregator(processor_arg=None):
+    return aggregations.CountBy()
+
+
+@make_db_processor
+def top_metrics(dashboard, processor_arg=None):
+    '''List the metric paths used by the most targets across dashboards,
+processor_arg is the number of paths to list, 100 by default.
+
+    '''
+    metrics = {}
+    for target in panel_stream.iter_targets(dashboard.data):
+        if not target.target:
+            continue
+        try:
+            paths = [x.path for x in target_ast.iter_paths(target_ast.parse(target.target))]
+        except target_ast.TargetParseException:
+            paths = [_get_path(target.target)]
+        for path in set(paths):
+            metrics[path] = metrics.get(path, 0) + 1
+    return metrics
+
+
+@make_aggregator('top_metrics')
+def _top_metrics_aggregator(processor_arg=None):
+    return aggregations.TopK(int(processor_arg or 100))
+
+
+@make_db_processor
+def find_stale_targets(dashboard, processor_arg=None):
+    '''Report the targets without datapoints since processor_arg, a
+graphite from= value (stale_series_window by default), per panel. Targets
+are checked with render requests of many targets each, templated ones
+are not checked.
+
+    '''
+    panels = [(x, [y.target for y in x.targets or () if y.target])
+              for x in panel_stream.iter_panels(dashboard.data)]
+    checked = set([x for _, targets in panels for x in targets
+                   if '$' not in x and '#' not in x])
+    has_data = validate_metrics.series_have_data(sorted(checked), processor_arg) \
+        if checked else {}
+    counts = {'live': 0, 'stale': 0, 'failed': 0, 'unchecked': 0}
+    for panel, targets in panels:
+        panel_title = panel.title if panel.title else 'panelId=%s' % panel.id
+        for target in targets:
+            if target not in has_data:
+                counts['unchecked'] += 1
+            elif has_data[target]:
+                counts['live'] += 1
+            elif has_data[target] is None:
+                counts['failed'] += 1
+                LOGGER.warn('In %s graph "%s": could not render %s', dashboard.slug, panel_title,
+                            target)
+            else:
+                counts['stale'] += 1
+                LOGGER.info('In %s graph "%s": stale target %s', dashboard.slug, panel_title,
+                            target)
+    return counts
+
+
+@make_aggregator('find_stale_targets')
+def _find_stale_targets_aggregator(processor_arg=None):
+    return aggregations.CountBy()
+
+
 @make_db_processor
 def list_dashboards_with_old_metric_paths(dashboard, processor_arg=None):
     '''Search the whole dashboard for potential old metrics (metrics that
 do not have the md or agg namespace).
 
     '''
-    target_regex = re.compile('target":\s*"([^"]*)"')
-    for match in target_regex.findall(dashboard.data):
-        working = _get_path(match)
-        working = working.split('.')
-        if 'collectd' in working[0]:
-            continue
-        if len(working) > 1 and working[1] not in METRIC_CATEGORIES:
-            LOGGER.info('Old metric %s in %s' % (_get_path(match), dashboard.slug))
+    memo = target_memo.get_memo('list_dashboards_with_old_metric_paths')
+    for target in panel_stream.iter_targets(dashboard.data):
+        old_path = memo.get(target.target, lambda: _old_metric_path(target.target))
+        if old_path:
+            LOGGER.info('Old metric %s in %s' % (old_path, dashboard.slug))
+
+
+def _old_metric_path(grafana_target):
+    '''Return the metric path of grafana_target if it is an old one,
+    otherwise None.
+
+    '''
+    path = _get_path(grafana_target)
+    working = path.split('.')
+    if 'collectd' in working[0]:
+        return None
+    if len(working) > 1 and working[1] not in METRIC_CATEGORIES:
+        return path
+    return None
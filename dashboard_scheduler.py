@@ -0,0 +1,93 @@
+'''Order dashboards so the most expensive are processed first.
+
+Dispatched in table order, the few huge dashboards landing near the end
+of an iteration keep it running long after the other workers are idle.
+Started first (longest processing time first) they overlap with the
+many small ones and the pool stays busy until the end.
+
+The cost of a dashboard is the seconds it took in a previous run of the
+same processor when known. Otherwise it is estimated from its number of
+targets, the bulk of the work of the lookup processors, scaled by the
+seconds per target measured on the timed dashboards, and from its size
+for dashboards without targets. Target counts and sizes of
+dashboard_handle handles are used as is, without loading their data.
+
+'''
+import json_codec
+import os
+
+
+def target_count(data):
+    '''Number of targets in the dashboard json text, counted without
+    parsing it.
+
+    '''
+    return data.count('"target"')
+
+
+def load_timings(timings_path, processor):
+    '''Return {slug: seconds} of the last runs of processor.
+
+    '''
+    if not timings_path or not os.path.isfile(timings_path):
+        return {}
+    with open(timings_path, 'rb') as timings_file:
+        return json_codec.load(timings_file).get(processor) or {}
+
+
+def save_timings(timings_path, processor, timings):
+    '''Merge {slug: seconds} into the timings of processor.
+
+    '''
+    all_timings = {}
+    if os.path.isfile(timings_path):
+        with open(timings_path, 'rb') as timings_file:
+            all_timings = json_codec.load(timings_file)
+    all_timings.setdefault(processor, {}).update(timings)
+    with open(timings_path, 'w') as timings_file:
+        timings_file.write(json_codec.dumps(all_timings, indent=2, sort_keys=True))
+
+
+def _size(dashboard):
+    if getattr(dashboard, 'data_length', None) is not None:
+        return dashboard.data_length
+    return len(dashboard.data)
+
+
+def _target_count(dashboard):
+    if getattr(dashboard, 'target_count', None) is not None:
+        return dashboard.target_count
+    return target_count(dashboard.data)
+
+
+def expected_seconds(dashboards, timings=None):
+    '''Return the expected cost of every DASHBOARD_RECORD or
+    DashboardHandle of dashboards, in seconds when some of them are
+    timed.
+
+    '''
+    timings = timings or {}
+    targets = [_target_count(x) for x in dashboards]
+    timed = [(timings[x.slug], count) for x, count in zip(dashboards, targets)
+             if x.slug in timings]
+    timed_targets = sum([x[1] for x in timed])
+    per_target = float(sum([x[0] for x in timed])) / timed_targets if timed_targets else 1.0
+    costs = []
+    for dashboard, count in zip(dashboards, targets):
+        if dashboard.slug in timings:
+            costs.append(timings[dashboard.slug])
+        else:
+            # Size only breaks ties, it is far below a target's cost.
+            costs.append(count * per_target + _size(dashboard) * per_target * 1e-6)
+    return costs
+
+
+def largest_first(rows, record_type=None, timings=None):
+    '''Return the dashboard rows sorted by decreasing expected cost. Rows
+    are records or handles already without record_type.
+
+    '''
+    rows = list(rows)
+    costs = expected_seconds([record_type(*x) for x in rows] if record_type else rows, timings)
+    order = sorted(range(len(rows)), key=lambda x: -costs[x])
+    return [rows[x] for x in order]
@@ -0,0 +1,203 @@
+'''Run processors on dashboards as they change.
+
+An iteration starts cold: it connects, gathers the whole table and every
+child builds its caches again, so what the processors enforce only
+catches up with an edit at the next sweep. watch() runs in one process
+and polls the table every watch_interval seconds for the dashboards
+updated since the previous poll, selecting their metadata columns
+only, and runs the watch_processors on each changed dashboard in turn.
+The database connection, the target_memo memos and a lookup broker,
+caching graphite answers for lookup_broker_ttl seconds, stay warm
+between polls; the memos are dropped every target_memo_ttl seconds as
+their results never expire in memory.
+
+A dashboard changed when its version or updated column differs from
+the last seen. Only dashboards changing while watching are processed,
+the sweep covers the rest of the table. The versions of the processed
+dashboards are read again afterwards, so the writes of the processors
+are not changes.
+
+watch_processors is a ; separated list of processor or
+processor:argument, run in that order:
+
+    watch_processors = update_old_paths; find_stale_targets:-6h
+    python manip_grafana_db.py --watch
+
+'''
+import dashboard_processors
+import json_codec
+from lazy_import import lazy_module
+import processor_registry
+import target_memo
+from time import sleep, time
+
+lookup_broker = lazy_module('lookup_broker')
+sql_connector = lazy_module('sql_connector')
+validate_metrics = lazy_module('validate_metrics')
+
+LOGGER = None
+
+
+class DashboardWatchException(Exception):
+    def __init__(self, msg=''):
+        super(DashboardWatchException, self).__init__(msg)
+
+
+def parse_processors(text):
+    '''Return [(processor name, argument or None)] of the
+    watch_processors setting text.
+
+    '''
+    processors = []
+    for entry in (text or '').split(';'):
+        name, _, argument = entry.strip().partition(':')
+        if not name:
+            continue
+        if name not in processor_registry.PROCESSORS:
+            raise DashboardWatchException('Unknown processor "%s" in watch_processors.' % name)
+        processors.append((name, argument.strip() or None))
+    if not processors:
+        raise DashboardWatchException('watch_processors lists no processor.')
+    return processors
+
+
+class Watcher(object):
+    '''Runs processors, [(name, argument)], on the dashboards of source,
+    sql_connector by default, changed since the previous poll. Every
+    processor has dashboard_timeout seconds per dashboard.
+
+    '''
+    def __init__(self, processors, source=None, dashboard_timeout=None):
+        self.processors = [(name, argument, processor_registry.get_processor(name),
+                            processor_registry.PROCESSORS[name].read_only)
+                           for name, argument in processors]
+        self.source = source or sql_connector
+        self.dashboard_timeout = dashboard_timeout
+        self.since = None
+        self.seen = {}
+        self.counts = {'polls': 0, 'processed': 0, 'failed': 0}
+
+    def _see(self, rows, advance=True):
+        '''Record the versions of rows, (id, slug, version, updated), as
+        seen. advance moves since to the latest updated of rows.
+
+        '''
+        for dashboard_id, _, version, updated in rows:
+            self.seen[dashboard_id] = (version, updated)
+            if advance and (self.since is None or updated > self.since):
+                self.since = updated
+        # updated has second resolution, the next poll selects the rows
+        # updated in the second of since again; the others are not.
+        self.seen = dict([(x, y) for x, y in self.seen.items() if y[1] >= self.since])
+
+    def poll(self):
+        '''Process the dashboards changed since the previous poll; the
+        first poll only sees the table. Returns the number of dashboards
+        processed.
+
+        '''
+        self.counts['polls'] += 1
+        rows = self.source.get_dashboard_versions(self.since)
+        if self.since is None:
+            self._see(rows)
+            return 0
+        changed = [x for x in rows if self.seen.get(x[0]) != (x[2], x[3])]
+        for dashboard_id, slug, _, _ in changed:
+            self.process(dashboard_id, slug)
+        # Seen once all are processed, a poll failing midway is repeated.
+        self._see(rows)
+        self._see(self.source.get_dashboard_versions(dashboard_ids=[x[0] for x in changed]),
+                  advance=False)
+        return len(changed)
+
+    def process(self, dashboard_id, slug):
+        '''Run the processors on the dashboard, each on the data the
+        previous one left. Returns False if one failed.
+
+        '''
+        dashboard = None
+        for name, argument, processor, read_only in self.processors:
+            if dashboard is None:
+                rows = self.source.get_dashboards_by_id([dashboard_id])
+                if not rows:
+                    LOGGER.info('%s was deleted before it was processed.', slug)
+                    return True
+                dashboard = self.source.DASHBOARD_RECORD(*rows[0])
+            if self.dashboard_timeout:
+                dashboard_processors.DASHBOARD_DEADLINE = time() + self.dashboard_timeout
+            try:
+                result = processor(dashboard, argument)
+            except Exception as exc:
+                # One dashboard must not stop the watch, the processors
+                # run on it again when it changes next.
+                self.counts['failed'] += 1
+                LOGGER.error('%s failed on %s: %s', name, slug, exc)
+                return False
+            finally:
+                dashboard_processors.DASHBOARD_DEADLINE = None
+            if result is not None and name in dashboard_processors.AGGREGATORS:
+                LOGGER.info('%s of %s: %s', name, slug, json_codec.dumps(result))
+            if not read_only:
+                dashboard = None
+        self.counts['processed'] += 1
+        return True
+
+
+def _expire_caches():
+    '''Drop the results this process keeps without expiry.
+
+    '''
+    memo_stats = target_memo.stats()
+    if memo_stats:
+        LOGGER.info('target memo: %s', target_memo.format_stats(memo_stats))
+    target_memo.reset()
+    # Transforms and estimators read their files once, edits are
+    # picked up here.
+    dashboard_processors.BUILT_TRANSFORMS.clear()
+    dashboard_processors.COST_ESTIMATORS.clear()
+    validate_metrics.KNOWN_METRICS.clear()
+    validate_metrics.SERIES_COUNTS.clear()
+
+
+def run(watcher, interval, cache_ttl=None, polls=None, clock=time, wait=sleep):
+    '''Poll with watcher every interval seconds, polls times or until
+    interrupted. Caches are dropped every cache_ttl seconds.
+
+    '''
+    caches_since = clock()
+    while polls is None or watcher.counts['polls'] < polls:
+        start = clock()
+        if cache_ttl and start - caches_since > cache_ttl:
+            _expire_caches()
+            caches_since = start
+        try:
+            processed = watcher.poll()
+        except Exception as exc:
+            # The database or graphite may be restarting, the next poll
+            # reconnects.
+            LOGGER.error('poll failed: %s', exc)
+            processed = 0
+        if processed:
+            LOGGER.info('%s changed dashboards processed in %.1fs, %s processed and %s failed '
+                        'since start', processed, clock() - start, watcher.counts['processed'],
+                        watcher.counts['failed'])
+        wait(max(interval - (clock() - start), 0))
+
+
+def watch(configs):
+    '''Process the dashboards changing, with the watch_processors of
+    configs, until interrupted. Graphite lookups go through a lookup
+    broker kept for the duration.
+
+    '''
+    processors = parse_processors(configs.watch_processors)
+    watcher = Watcher(processors, dashboard_timeout=float(configs.dashboard_timeout))
+    socket_path = getattr(configs, 'lookup_broker_socket', None)
+    with lookup_broker.sidecar(socket_path,
+                               report=lambda stats: LOGGER.info('lookup broker: %s', stats)):
+        if socket_path and lookup_broker.is_serving(socket_path):
+            validate_metrics.BROKER = lookup_broker.BrokerClient(socket_path)
+        LOGGER.info('watching for changed dashboards every %ss: %s', configs.watch_interval,
+                    ', '.join([x[0] for x in processors]))
+        ttl = getattr(configs, 'target_memo_ttl', None)
+        run(watcher, float(configs.watch_interval), float(ttl) if ttl else None)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''Rename a datasource in every dashboard, set based.
+
+Unlike iterating update_datasource over the dashboards, the new
+datasource is validated once, only the ids of the dashboards referring
+to the old one are selected, and most of them are rewritten by the
+server: when every reference in a dashboard reads exactly
+"datasource": "<old>", a REPLACE() of that text in chunks of
+dashboards does the rename without transferring the data. The other
+dashboards (other spacing) are fetched, the datasource fields
+rewritten in the parsed json and written back in chunks.
+
+    python datasource_migration.py "Old name" "New name" --chunk-size 500
+
+'''
+from lazy_import import lazy_module
+import json_codec
+import triconf
+
+sql_connector = lazy_module('sql_connector')
+
+CONFIGS = None
+
+
+class DatasourceMigrationException(Exception):
+    def __init__(self, msg=''):
+        super(DatasourceMigrationException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('datasource_migration', conf_file_names=['conf.ini'],
+                                      **kargs)
+    return CONFIGS
+
+
+def _chunks(items, chunk_size):
+    return [items[x:x + chunk_size] for x in range(0, len(items), chunk_size)]
+
+
+def rename_datasource_fields(obj, old, new):
+    '''Set every "datasource" field equal to old in the json object obj
+    to new, in place. Returns the number of fields changed.
+
+    '''
+    changed = 0
+    if isinstance(obj, dict):
+        if obj.get('datasource') == old:
+            obj['datasource'] = new
+            changed += 1
+        values = obj.values()
+    elif isinstance(obj, list):
+        values = obj
+    else:
+        return 0
+    for value in values:
+        if isinstance(value, (dict, list)):
+            changed += rename_datasource_fields(value, old, new)
+    return changed
+
+
+def _parsed_updates(dashboard_ids, old, new):
+    for row in sql_connector.get_dashboards_by_id(dashboard_ids):
+        dashboard = sql_connector.DASHBOARD_RECORD(*row)
+        dashboard_obj = json_codec.loads(dashboard.data, ordered=True)
+        if rename_datasource_fields(dashboard_obj, old, new):
+            yield json_codec.dumps(dashboard_obj), dashboard.id
+
+
+def migrate(old, new, chunk_size=500, dry_run=False, report=None):
+    '''Rename datasource old to new in every dashboard. report is called
+    with a line per chunk. Returns the number of dashboards updated.
+
+    '''
+    report = report or (lambda line: None)
+    if not [x for x in sql_connector.get_datasources() if x.name == new]:
+        raise DatasourceMigrationException('%s is an unknown datasource.' % new)
+    references = sql_connector.get_datasource_references(old)
+    replaceable = [x[0] for x in references if x[2]]
+    parsed = [x[0] for x in references if not x[2]]
+    report('%s dashboards refer to %s: %s rewritten by the server, %s parsed.'
+           % (len(references), old, len(replaceable), len(parsed)))
+    if dry_run:
+        return 0
+    updated = 0
+    old_reference = '"datasource": %s' % json_codec.dumps(old)
+    new_reference = '"datasource": %s' % json_codec.dumps(new)
+    for number, chunk in enumerate(_chunks(replaceable, chunk_size), 1):
+        affected = sql_connector.replace_in_dashboards_data(chunk, old_reference, new_reference)
+        updated += affected
+        report('server chunk %s: %s dashboards updated' % (number, affected))
+    for number, chunk in enumerate(_chunks(parsed, chunk_size), 1):
+        affected = sum(sql_connector.update_dashboards_data(_parsed_updates(chunk, old, new),
+                                                            chunk_size=chunk_size))
+        updated += affected
+        report('parsed chunk %s: %s dashboards updated' % (number, affected))
+    return updated
+
+
+if __name__ == '__main__':
+    import sys
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS,
+                                         description='Rename a datasource in every dashboard.')
+    PARSER.add_argument('old_datasource')
+    PARSER.add_argument('new_datasource')
+    PARSER.add_argument('--chunk-size', type=int, default=500,
+                        help='Dashboards updated per transaction.')
+    PARSER.add_argument('--dry-run', action='store_true',
+                        help='Only count the dashboards to update.')
+    CONFIGS(PARSER.parse_args())
+    try:
+        UPDATED = migrate(CONFIGS.old_datasource, CONFIGS.new_datasource, CONFIGS.chunk_size,
+                          CONFIGS.dry_run, report=lambda line: sys.stdout.write(line + '\n'))
+    except DatasourceMigrationException as exc:
+        print(exc)
+        exit(1)
+    print('%s dashboards updated.' % UPDATED)
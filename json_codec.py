@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+'''Single place to decode and encode dashboard json.
+
+Dashboard data may be utf-8 or latin-1. sql_connector sets
+DATA_ENCODING from the charset of the data column when that guarantees
+one encoding, and every blob is then parsed as such. Otherwise the
+encoding of a blob is detected once before it is parsed, which is a
+check for ascii and a utf-8 decode of non ascii blobs; ascii and utf-8
+blobs are handed to the json backend as bytes, never parsed twice.
+
+The fastest available backend is picked at import time for decoding.
+Encoding always uses simplejson (or json) so the output keeps the
+format and key order the rest of the code, notably rpn, relies on.
+
+Run as a script to benchmark against plain simplejson with a latin-1
+retry, the decoding used before this module existed.
+
+'''
+from collections import OrderedDict
+import sys
+
+try:
+    import simplejson as _dump_json
+except ImportError:
+    import json as _dump_json
+
+DATA_ENCODING = None
+DecodeError = ValueError  # Decode errors of every backend derive from ValueError.
+# Dicts only keep insertion order from 3.7 on.
+PLAIN_DICTS_ORDERED = sys.version_info >= (3, 7)
+_ASCII_BYTES = bytes(bytearray(range(128)))
+
+
+def _select_loads():
+    '''Return the name and loads function of the fastest available
+    backend.
+
+    '''
+    try:
+        import orjson
+        return 'orjson', orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return 'ujson', ujson.loads
+    except ImportError:
+        pass
+    return _dump_json.__name__, _dump_json.loads
+
+
+BACKEND, _loads = _select_loads()
+# Plain int keeps integer parsing in C for every backend version.
+_RAW_DECODER = _dump_json.JSONDecoder(parse_int=int)
+# The scanner itself, raw_decode only adds a whitespace and bom check
+# costing as much as decoding a small value.
+_SCAN_ONCE = _RAW_DECODER.scan_once
+
+
+def _ordered_loads(text):
+    if PLAIN_DICTS_ORDERED:
+        return _loads(text)
+    return _dump_json.loads(text, object_pairs_hook=OrderedDict)
+
+
+def _is_ascii(blob):
+    if hasattr(blob, 'isascii'):
+        return blob.isascii()
+    # Deleting every ascii byte leaves nothing, without decoding the blob.
+    return not blob.translate(None, _ASCII_BYTES)
+
+
+def detect_encoding(blob):
+    '''Return the encoding of the bytes blob: 'ascii', 'utf-8' or
+    'latin-1' for anything that isn't valid utf-8.
+
+    '''
+    if DATA_ENCODING:
+        return DATA_ENCODING
+    if _is_ascii(blob):
+        return 'ascii'
+    try:
+        blob.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+
+def _decoded_loads(blob, encoding, ordered):
+    # simplejson decodes the strings of other encodings itself,
+    # otherwise the blob is decoded once here.
+    if BACKEND == 'simplejson' and not ordered:
+        return _loads(blob, encoding=encoding)
+    return _ordered_loads(blob.decode(encoding)) if ordered else _loads(blob.decode(encoding))
+
+
+def loads(data, ordered=False):
+    '''Parse the json in data (bytes or text). With ordered, objects keep
+    their key order, use it when the result is going to be written back.
+
+    '''
+    if isinstance(data, bytes):
+        encoding = detect_encoding(data)
+        if encoding.replace('-', '').lower() not in ('ascii', 'utf8'):
+            return _decoded_loads(data, encoding, ordered)
+    if ordered:
+        return _ordered_loads(data)
+    return _loads(data)
+
+
+def to_text(data):
+    '''Return data in a form str regexes and raw_decode accept: text,
+    or on python 2 ascii and utf-8 bytes as they are.
+
+    '''
+    if not isinstance(data, bytes):
+        return data
+    if bytes is str:
+        encoding = detect_encoding(data)
+        return data if encoding.replace('-', '').lower() in ('ascii', 'utf8') \
+            else data.decode(encoding)
+    if DATA_ENCODING:
+        return data.decode(DATA_ENCODING)
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def raw_decode(text, index=0):
+    '''Decode the json value starting at index of text (see to_text),
+    returns the value and the index just past it. index must be at the
+    value, not at whitespace before it.
+
+    '''
+    try:
+        return _SCAN_ONCE(text, index)
+    except StopIteration:
+        raise DecodeError('Expecting value at %s.' % index)
+
+
+def load(json_file, ordered=False):
+    return loads(json_file.read(), ordered=ordered)
+
+
+def dumps(obj, **kargs):
+    return _dump_json.dumps(obj, **kargs)
+
+
+def _legacy_loads(data):
+    '''Decoding as done before this module, for the benchmark.
+
+    '''
+    try:
+        return _dump_json.loads(data)
+    except Exception:
+        return _dump_json.loads(data, encoding='latin-1')
+
+
+def sample_dashboards():
+    '''Generate an ascii, a utf-8 and a latin-1 dashboard to benchmark
+    with when no files are given.
+
+    '''
+    import layouts
+    dashboard = layouts.main_layout()
+    for row_number in range(20):
+        row = layouts.row_layout()
+        for panel_number in range(10):
+            panel = layouts.panel_layout()
+            panel['title'] = 'Panel %s.%s' % (row_number, panel_number)
+            for target_number in range(5):
+                target = layouts.graph_target_layout()
+                target['target'] = ('aliasByNode(program.md.metric_%s.host.*.gauge.value, 4)'
+                                    % target_number)
+                panel['targets'].append(target)
+            row['panels'].append(panel)
+        dashboard['rows'].append(row)
+    ascii_blob = dumps(dashboard).encode('ascii')
+    dashboard['title'] = u'D\xe9bit'
+    utf8_blob = dumps(dashboard, ensure_ascii=False).encode('utf-8')
+    latin1_blob = dumps(dashboard, ensure_ascii=False).encode('latin-1')
+    return [('ascii', ascii_blob), ('utf-8', utf8_blob), ('latin-1', latin1_blob)]
+
+
+def _best_time(fun, number):
+    from timeit import repeat
+    return min(repeat(fun, number=number, repeat=5)) / number
+
+
+def benchmark(samples, number=20):
+    '''Print the time per decode of the legacy path and of loads, with
+    DATA_ENCODING unset and set to the encoding of the blob, for each
+    (name, blob) in samples. Best of 5 runs of number decodes.
+
+    '''
+    global DATA_ENCODING
+    print('json backend: %s' % BACKEND)
+    data_encoding = DATA_ENCODING
+    for name, blob in samples:
+        DATA_ENCODING = None
+        try:
+            codec = _best_time(lambda: loads(blob), number)
+            DATA_ENCODING = detect_encoding(blob)
+            known = _best_time(lambda: loads(blob), number)
+        finally:
+            DATA_ENCODING = data_encoding
+        try:
+            legacy = _best_time(lambda: _legacy_loads(blob), number)
+        except Exception as exc:
+            print('%-30s %8d bytes  legacy failed (%s)  codec %8.2fms  known encoding %8.2fms'
+                  % (name, len(blob), exc.__class__.__name__, codec * 1000, known * 1000))
+            continue
+        print('%-30s %8d bytes  legacy %8.2fms  codec %8.2fms  %5.2fx  known encoding %8.2fms'
+              '  %5.2fx' % (name, len(blob), legacy * 1000, codec * 1000, legacy / codec,
+                            known * 1000, legacy / known))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        benchmark([(x, open(x, 'rb').read()) for x in sys.argv[1:]])
+    else:
+        benchmark(sample_dashboards())
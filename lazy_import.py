@@ -0,0 +1,48 @@
+'''Deferred module imports.
+
+Heavy dependencies (MySQLdb, requests, ...) are only needed once a
+processor actually runs, not to parse arguments or to list
+processors. Modules bound with lazy_module are imported the first time
+one of their attributes is used.
+
+'''
+import importlib
+import sys
+
+
+class LazyModule(object):
+    '''Stand-in for a module which is imported on first attribute
+    access. Setting an attribute sets it on the real module, so mocking
+    through the stand-in behaves as it would on the module itself.
+
+    '''
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] else 'not loaded'
+        return '<lazy module %r (%s)>' % (self.__dict__['_lazy_name'], state)
+
+
+def lazy_module(name):
+    '''Return module name if it is already imported, otherwise a
+    LazyModule that imports it on first use.
+
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+'''Coalesce the graphite finds of many processes.
+
+Every child of an iteration has its own validate_metrics.KNOWN_METRICS,
+so children processing similar dashboards send the same finds to
+graphite at the same moment. The broker is a sidecar process serving
+validate_metrics lookups on the unix socket lookup_broker_socket.
+Identical lookups in flight are sent upstream once and the answer is
+fanned out to every caller waiting on it (single flight); answers are
+then cached for lookup_broker_ttl seconds. validate_metrics sends its
+lookups to the broker when the socket exists, process_dashboards of
+manip_grafana_db starts one for the duration of an iteration.
+
+    python lookup_broker.py            # serve
+    python lookup_broker.py --stats    # statistics of the running broker
+
+Requests and answers are json lines.
+
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+from lazy_import import lazy_module
+import json_codec
+import os
+import socket
+from subprocess import Popen
+import threading
+from time import sleep, time
+import triconf
+
+try:
+    from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+except ImportError:
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+validate_metrics = lazy_module('validate_metrics')
+
+CONFIGS = None
+
+
+class LookupBrokerException(Exception):
+    def __init__(self, msg=''):
+        super(LookupBrokerException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('lookup_broker', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''Calls fun once for all the concurrent calls with the same key,
+    caching results for ttl seconds, at most cache_size of them.
+
+    '''
+    def __init__(self, ttl=600, cache_size=100000, clock=time):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.clock = clock
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.counts = {'requests': 0, 'hits': 0, 'coalesced': 0, 'upstream': 0, 'errors': 0}
+        self.lock = threading.Lock()
+
+    def call(self, key, fun):
+        with self.lock:
+            self.counts['requests'] += 1
+            if key in self.cache:
+                expires, result = self.cache[key]
+                if expires > self.clock():
+                    self.counts['hits'] += 1
+                    return result
+                del self.cache[key]
+            leader = key not in self.in_flight
+            if leader:
+                self.counts['upstream'] += 1
+                self.in_flight[key] = _Flight()
+            else:
+                self.counts['coalesced'] += 1
+            flight = self.in_flight[key]
+        if leader:
+            try:
+                flight.result = fun()
+            except Exception as exc:
+                flight.error = exc
+            with self.lock:
+                del self.in_flight[key]
+                if flight.error is None:
+                    self.cache[key] = (self.clock() + self.ttl, flight.result)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                else:
+                    self.counts['errors'] += 1
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats.update(cached=len(self.cache), in_flight=len(self.in_flight))
+        return stats
+
+
+def _metric_exists_all(metric, fetch_response, query):
+    try:
+        return validate_metrics.metric_exists_all(metric, fetch_response, query)
+    finally:
+        # The broker caches with a ttl, KNOWN_METRICS never expires.
+        validate_metrics.KNOWN_METRICS.pop(metric, None)
+
+
+LOOKUPS = {'metric_exists': lambda *args: validate_metrics.metric_exists(*args),
+           'metric_exists_all': _metric_exists_all}
+
+
+class LookupBroker(object):
+    def __init__(self, ttl=600, cache_size=100000):
+        self.flights = SingleFlight(ttl, cache_size)
+
+    def handle(self, request):
+        '''Return the answer to a request, {"function": name, "args":
+        [...]}, as {"result": ...} or {"error": message}.
+
+        '''
+        function = request.get('function')
+        if function == 'stats':
+            return {'result': self.flights.stats()}
+        if function not in LOOKUPS:
+            return {'error': 'Unknown function %s.' % function}
+        args = request.get('args') or []
+        key = json_codec.dumps([function, args], sort_keys=True)
+        try:
+            return {'result': self.flights.call(key, lambda: LOOKUPS[function](*args))}
+        except Exception as exc:
+            return {'error': '%s: %s' % (type(exc).__name__, exc)}
+
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            answer = self.server.broker.handle(json_codec.loads(line))
+            self.wfile.write((json_codec.dumps(answer) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def make_server(socket_path, broker):
+    '''Return the server of broker on socket_path, replacing a stale
+    socket file.
+
+    '''
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = ThreadingUnixStreamServer(socket_path, _Handler)
+    server.daemon_threads = True
+    server.broker = broker
+    return server
+
+
+class BrokerClient(object):
+    '''Client of the broker on socket_path, one connection per thread.
+
+    '''
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _files(self):
+        if not hasattr(self._local, 'files'):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.socket_path)
+            self._local.files = connection.makefile('rb'), connection.makefile('wb')
+        return self._local.files
+
+    def call(self, function, *args):
+        '''Return the result of the lookup. Raises LookupBrokerException
+        if it failed upstream, socket.error if the broker is gone.
+
+        '''
+        reader, writer = self._files()
+        writer.write((json_codec.dumps({'function': function, 'args': args}) + '\n')
+                     .encode('utf-8'))
+        writer.flush()
+        line = reader.readline()
+        if not line:
+            del self._local.files
+            raise socket.error('Lookup broker at %s closed the connection.' % self.socket_path)
+        answer = json_codec.loads(line)
+        if 'error' in answer:
+            raise LookupBrokerException(answer['error'])
+        return answer['result']
+
+
+def is_serving(socket_path):
+    try:
+        BrokerClient(socket_path).call('stats')
+    except (socket.error, IOError, LookupBrokerException):
+        return False
+    return True
+
+
+def format_stats(stats):
+    return ('%(requests)s lookups: %(hits)s cached, %(coalesced)s coalesced, %(upstream)s sent '
+            'upstream, %(errors)s failed' % stats)
+
+
+@contextmanager
+def sidecar(socket_path, report=None):
+    '''Run a broker on socket_path for the duration of the block, unless
+    one already serves there. report is called with its format_stats()
+    at the end.
+
+    '''
+    if not socket_path or is_serving(socket_path):
+        yield
+        return
+    proc = Popen(['python', 'lookup_broker.py'])
+    start = time()
+    while not is_serving(socket_path) and proc.poll() is None and time() - start < 10:
+        sleep(0.05)
+    try:
+        yield
+    finally:
+        if report and is_serving(socket_path):
+            report(format_stats(BrokerClient(socket_path).call('stats')))
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS, description='Coalesce graphite finds.')
+    PARSER.add_argument('--stats', action='store_true',
+                        help='Print the statistics of the running broker.')
+    CONFIGS(PARSER.parse_args())
+    if CONFIGS.stats:
+        print(format_stats(BrokerClient(CONFIGS.lookup_broker_socket).call('stats')))
+        exit(0)
+    validate_metrics.initialize()
+    validate_metrics.BROKER = None
+    SERVER = make_server(CONFIGS.lookup_broker_socket,
+                         LookupBroker(float(CONFIGS.lookup_broker_ttl),
+                                      int(CONFIGS.lookup_broker_cache_size)))
+    try:
+        SERVER.serve_forever()
+    finally:
+        os.remove(CONFIGS.lookup_broker_socket)
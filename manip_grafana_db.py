@@ -4,19 +4,34 @@
 '''
 
 import dashboard_processors
+import dashboard_scheduler
+from lazy_import import lazy_module
 import os
 from pipes import quote
+import processor_registry
 import shlex
-import simplejson as json
-import sql_connector
-from subprocess import Popen, PIPE
+from subprocess import Popen
 import sys
+from tempfile import TemporaryFile
 from time import gmtime, sleep, strftime, time
 import triconf
 from simple_logger import configure_file_and_console
 
+dashboard_mirror = lazy_module('dashboard_mirror')
+dashboard_pipeline = lazy_module('dashboard_pipeline')
+dashboard_watch = lazy_module('dashboard_watch')
+json_codec = lazy_module('json_codec')
+lookup_broker = lazy_module('lookup_broker')
+sql_connector = lazy_module('sql_connector')
+sweep_coordinator = lazy_module('sweep_coordinator')
+target_memo = lazy_module('target_memo')
+
 CONFIGS = None
+DEADLINE_EXIT = 2  # Exit code of a child stopping itself at dashboard_timeout.
+KILL_GRACE = 10  # Seconds past dashboard_timeout before a child is killed.
 LOGGER = None
+MEMO_PREFIX = 'target memo: '  # Children write their target_memo stats on such a line.
+RESULT_PREFIX = 'processor result: '  # Children write their processor result on such a line.
 
 
 class GrafanaDataManipulationException(Exception):
@@ -46,46 +61,263 @@ def initialize_logger():
     dashboard_processors.LOGGER = LOGGER
 
 
+def get_dashboard_source(processor_name):
+    '''Return the module to read dashboards from for processor_name;
+    the local mirror with --use-mirror, otherwise the database.
+
+    '''
+    if not CONFIGS.use_mirror:
+        return sql_connector
+    if not processor_registry.PROCESSORS[processor_name].read_only:
+        raise GrafanaDataManipulationException('%s writes dashboards, it can not use the mirror.'
+                                               % processor_name)
+    return dashboard_mirror
+
+
+def _reap(proc_pool, timed_out, timings, aggregator=None, memo_stats=None):
+    '''Remove the finished children from proc_pool, killing those past
+    their deadline. The slugs of the killed ones and of those exiting
+    with DEADLINE_EXIT are appended to timed_out. The seconds
+    every child took until its poll() here found it done are set in
+    timings, it is called on every pass of the dispatch loop for them to
+    be accurate. Their results are combined into aggregator and their
+    target_memo stats into memo_stats. Returns the output of the removed
+    children.
+
+    '''
+    output = ''
+    # The child stops itself at dashboard_timeout, the kill is for
+    # children stuck where it doesn't check.
+    kill_after = float(CONFIGS.dashboard_timeout) + KILL_GRACE
+    for entry in list(proc_pool):
+        slug, proc, start, output_file, result_file = entry
+        finished = time()
+        if proc.poll() is None:
+            if finished - start < kill_after:
+                continue
+            proc.kill()
+            proc.wait()
+            timed_out.append(slug)
+            output += 'Killed %s after %ss.\n' % (slug, CONFIGS.dashboard_timeout)
+        elif proc.returncode == DEADLINE_EXIT:
+            timed_out.append(slug)
+        output_file.seek(0)
+        for line in output_file:
+            if not line.startswith(MEMO_PREFIX):
+                output += line
+            elif memo_stats is not None:
+                target_memo.combine_stats(memo_stats, json_codec.loads(line[len(MEMO_PREFIX):]))
+        output_file.close()
+        if result_file:
+            result_file.seek(0)
+            for line in result_file:
+                if line.startswith(RESULT_PREFIX):
+                    aggregator.combine(json_codec.loads(line[len(RESULT_PREFIX):]))
+            result_file.close()
+        timings[slug] = round(finished - start, 3)
+        proc_pool.remove(entry)
+    return output
+
+
+def read_retry_file():
+    '''Return the slugs of the dashboards that timed out in the last
+    run.
+
+    '''
+    if not os.path.isfile(CONFIGS.retry_file):
+        return []
+    with open(CONFIGS.retry_file) as retry_file:
+        return [x.strip() for x in retry_file if x.strip()]
+
+
+def _local_job():
+    '''Return the settings children are run with, from the cli.
+
+    '''
+    return {'processor': CONFIGS.db_iterator, 'processor_argument': CONFIGS.processor_argument,
+            'use_mirror': CONFIGS.use_mirror, 'dry_run': CONFIGS.dry_run}
+
+
+def gather_dashboards():
+    '''Return the slugs of the dashboards to run the --iterator
+    processor on, most expensive first, see dashboard_scheduler.
+
+    '''
+    dashboard_source = get_dashboard_source(CONFIGS.db_iterator)
+    g_start = time()
+    if CONFIGS.use_mirror:
+        LOGGER.info('syncing mirror')
+        LOGGER.info('mirror synced, %s updated, %s deleted', *dashboard_mirror.sync())
+    prefilter_terms = dashboard_processors.get_prefilter_terms(CONFIGS.db_iterator,
+                                                               CONFIGS.processor_argument)
+    if prefilter_terms:
+        LOGGER.info('gathering dashboards containing %s', ', '.join(prefilter_terms))
+    else:
+        LOGGER.info('gathering dashboards')
+    # Handles leave the data in the database, the children fetch it.
+    dashboards = dashboard_source.get_dashboard_handles(prefilter_terms)
+    if CONFIGS.retry:
+        retry_slugs = set(read_retry_file())
+        dashboards = [x for x in dashboards if x.slug in retry_slugs]
+    dashboards = dashboard_scheduler.largest_first(
+        dashboards, timings=dashboard_scheduler.load_timings(CONFIGS.timings_file,
+                                                             CONFIGS.db_iterator))
+    LOGGER.info('gathering done in %ss', time()-g_start)
+    return [x.slug for x in dashboards]
+
+
+def process_dashboards(job, slugs, aggregator=None, heartbeat=None):
+    '''Run the processor of job on every dashboard of slugs, each in a
+    child process, killed if it runs longer than dashboard_timeout.
+    Results are combined into aggregator, heartbeat is called while
+    waiting for children. The graphite lookups of the children go
+    through a lookup_broker. Returns (output, timed out slugs, timings).
+
+    '''
+    memo_stats = {}
+    with lookup_broker.sidecar(getattr(CONFIGS, 'lookup_broker_socket', None),
+                               report=lambda stats: LOGGER.info('lookup broker: %s', stats)):
+        result = _run_children(job, slugs, aggregator, heartbeat, memo_stats)
+    if memo_stats:
+        LOGGER.info('target memo: %s', target_memo.format_stats(memo_stats))
+    return result
+
+
+def _compact_memo():
+    '''Compact the memo file once a whole sweep or worker is done, not
+    after every lease; appends of other processes wait meanwhile.
+
+    '''
+    LOGGER.debug('target memo file compacted, %s results kept, %s dropped',
+                 *target_memo.compact())
+
+
+def _run_children(job, slugs, aggregator, heartbeat, memo_stats):
+    count = 0
+    proc_pool = []
+    proc_pool_output = ''
+    timed_out = []
+    timings = {}
+    # Children write to files rather than pipes; a pipe only read once
+    # the child exits blocks a child writing more than the pipe holds.
+    devnull = open(os.devnull, 'w')
+    try:
+        for slug in slugs:
+            sys.stdout.write('%s\r' % {0: '|', 1: '/', 2: '-', 3: '\\'}[count % 4])
+            sys.stdout.flush()
+            count += 1
+            # Every pass, not only once the pool is full, for the timings
+            # and kills of the children finished or stuck meanwhile.
+            proc_pool_output += _reap(proc_pool, timed_out, timings, aggregator, memo_stats)
+            while len(proc_pool) >= int(CONFIGS.process_count_limit):
+                if heartbeat:
+                    heartbeat()
+                sleep(0.05)
+                proc_pool_output += _reap(proc_pool, timed_out, timings, aggregator, memo_stats)
+            cmd_string = 'python manip_grafana_db.py --processor %s --dashboard %s' \
+                         % (quote(job['processor']), quote(slug))
+            if job['processor_argument']:
+                cmd_string += ' --processor-arg %s ' % quote(job['processor_argument'])
+            if job['use_mirror']:
+                cmd_string += ' --use-mirror'
+            if job['dry_run']:
+                cmd_string += ' --dry-run'
+            output_file = TemporaryFile()
+            result_file = TemporaryFile() if aggregator else None
+            proc_pool.append((slug, Popen(shlex.split(cmd_string), stdout=result_file or devnull,
+                                          stderr=output_file), time(), output_file, result_file))
+        while proc_pool:
+            proc_pool_output += _reap(proc_pool, timed_out, timings, aggregator, memo_stats)
+            if proc_pool:
+                if heartbeat:
+                    heartbeat()
+                sleep(0.05)
+    except BaseException:
+        # heartbeat raises once the lease is lost, its children stop too.
+        for _, proc, _, _, _ in proc_pool:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        raise
+    finally:
+        devnull.close()
+    return proc_pool_output, timed_out, timings
+
+
+def _finish_iteration(aggregator, timed_out, timings):
+    dashboard_scheduler.save_timings(CONFIGS.timings_file, CONFIGS.db_iterator, timings)
+    with open(CONFIGS.retry_file, 'w') as retry_file:
+        retry_file.write(''.join(['%s\n' % x for x in timed_out]))
+    if timed_out:
+        LOGGER.warn('%s dashboards timed out, written to %s for --retry: %s', len(timed_out),
+                    CONFIGS.retry_file, ', '.join(timed_out))
+    if aggregator:
+        print(aggregator.format())
+
+
 def iterate_grafana_dashboards(fun):
     '''Iterate through grafana dashboards and run the given callable fun on
     the results. Object passed to fun is a named_tuple with the field
     names corresponding to the row names.
 
+    Every dashboard is processed by a child process, killed if it runs
+    longer than dashboard_timeout. The slugs of the ones timing out are
+    written to retry_file, --retry processes only those. Dashboards are
+    dispatched most expensive first, see dashboard_scheduler, and the
+    time each took is saved to timings_file for the next run.
+
     '''
     global CONFIGS
     if not hasattr(fun, '__call__'):
         raise GrafanaDataManipulationException('"fun" is not callable.')
-    g_start = time()
-    LOGGER.info('gathering dashboards')
-    dashboards = sql_connector.get_dashboards()
-    LOGGER.info('gathering done in %ss', time()-g_start)
+    slugs = gather_dashboards()
     LOGGER.info('iterating')
     iter_start = time()
-    count = 0
-    proc_pool = []
-    proc_pool_output = ''
-    for dash in dashboards:
-        slug = sql_connector.DASHBOARD_RECORD(*dash).slug
-        sys.stdout.write('%s\r' % {0: '|', 1: '/', 2: '-', 3: '\\'}[count % 4])
-        sys.stdout.flush()
-        count += 1
-        while len(proc_pool) >= int(CONFIGS.process_count_limit):
-            for proc in proc_pool:
-                if not proc[1].poll() is None:
-                    proc_pool_output += proc[1].communicate()[1]
-                    proc_pool.remove(proc)
-                else:
-                    sleep(0.05)
-        cmd_string = 'python manip_grafana_db.py --processor %s --dashboard %s' \
-                     % (quote(CONFIGS.db_iterator), quote(slug))
-        if CONFIGS.processor_argument:
-            cmd_string += ' --processor-arg %s ' % quote(CONFIGS.processor_argument)
-        proc_pool.append((slug, Popen(shlex.split(cmd_string), stdout=PIPE, stderr=PIPE)))
-    for _, proc in proc_pool:
-        _, stderr = proc.communicate()
-        if stderr:
-            proc_pool_output += stderr
-    LOGGER.info("%s\nIterating done in %ss." % (''.join(proc_pool_output), time()-iter_start))
+    aggregator = dashboard_processors.get_aggregator(CONFIGS.db_iterator,
+                                                     CONFIGS.processor_argument)
+    output, timed_out, timings = process_dashboards(_local_job(), slugs, aggregator)
+    LOGGER.info("%s\nIterating done in %ss." % (output, time()-iter_start))
+    _finish_iteration(aggregator, timed_out, timings)
+    _compact_memo()
+
+
+def coordinate_dashboards(address):
+    '''Serve the dashboards to run the --iterator processor on as leases
+    to workers, see sweep_coordinator, until all are processed.
+
+    '''
+    slugs = gather_dashboards()
+    table = sweep_coordinator.LeaseTable(
+        _local_job(), slugs,
+        dashboard_processors.get_aggregator(CONFIGS.db_iterator, CONFIGS.processor_argument),
+        int(CONFIGS.lease_size), float(CONFIGS.lease_timeout))
+    served_at = sweep_coordinator.serve(table, sweep_coordinator.parse_address(address),
+                                        (CONFIGS.coordinator_authkey or '').encode('utf-8'))
+    LOGGER.info('serving %s dashboards in %s leases at %s:%s', len(slugs), len(table.leases),
+                *served_at)
+    iter_start = time()
+    sweep_coordinator.wait(table, report=lambda status: LOGGER.debug(
+        'leases: %s done, %s claimed, %s pending, %s expired', *status))
+    LOGGER.info('Sweep done in %ss, %s leases expired.', time()-iter_start, table.expired)
+    _finish_iteration(table.aggregator, table.timed_out, table.timings)
+
+
+def work_dashboards(address):
+    '''Process leases of the coordinator at address until the sweep is
+    done.
+
+    '''
+    def process_lease(job, slugs, heartbeat):
+        aggregator = dashboard_processors.get_aggregator(job['processor'],
+                                                         job['processor_argument'])
+        output, timed_out, timings = process_dashboards(job, slugs, aggregator, heartbeat)
+        LOGGER.info('%s\nProcessed %s dashboards.', output, len(slugs))
+        return aggregator, timed_out, timings
+    processed = sweep_coordinator.run_worker(sweep_coordinator.parse_address(address),
+                                             (CONFIGS.coordinator_authkey or '').encode('utf-8'),
+                                             process_lease)
+    LOGGER.info('Worker done, %s leases processed.', processed)
+    _compact_memo()
 
 
 def main():
@@ -94,14 +326,41 @@ def main():
 
     '''
     if CONFIGS.dry_run:
-        print('dry run')
-        print(CONFIGS)
-        exit(0)
+        if not (CONFIGS.db_iterator or CONFIGS.db_processor or CONFIGS.watch):
+            print('dry run')
+            print(CONFIGS)
+            exit(0)
+        dashboard_processors.DRY_RUN = True
     if CONFIGS.list_processors:
-        print(dashboard_processors.list_processors())
+        print(processor_registry.list_processors())
+        exit(0)
+    if CONFIGS.sync_mirror:
+        LOGGER.info('mirror synced, %s updated, %s deleted', *dashboard_mirror.sync())
+        exit(0)
+    if CONFIGS.worker:
+        work_dashboards(CONFIGS.worker)
+        exit(0)
+    if CONFIGS.watch:
+        dashboard_watch.LOGGER = LOGGER
+        dashboard_processors.TARGET_CONCURRENCY = int(CONFIGS.target_concurrency)
+        dashboard_processors.TARGET_LOOKUP_LIMIT = int(CONFIGS.target_lookup_limit)
+        dashboard_processors.TARGET_TIMEOUT = float(CONFIGS.target_timeout)
+        dashboard_watch.watch(CONFIGS)
         exit(0)
     if CONFIGS.db_iterator:
-        iterate_grafana_dashboards(getattr(dashboard_processors, CONFIGS.db_iterator))
+        try:
+            processor = processor_registry.get_processor(CONFIGS.db_iterator)
+        except KeyError:
+            print('Unknown processor "%s"' % CONFIGS.db_iterator)
+            exit(1)
+        if CONFIGS.pipeline:
+            dashboard_pipeline.LOGGER = LOGGER
+            LOGGER.info('%s dashboards changed.', dashboard_pipeline.run(
+                CONFIGS.db_iterator, CONFIGS.processor_argument, CONFIGS, CONFIGS.dry_run))
+        elif CONFIGS.coordinator:
+            coordinate_dashboards(CONFIGS.coordinator)
+        else:
+            iterate_grafana_dashboards(processor)
         exit(0)
     if CONFIGS.db_processor:
         if not CONFIGS.dashboard:
@@ -113,12 +372,25 @@ def main():
         processor_arg = None if not hasattr(CONFIGS, 'processor_argument') \
             else CONFIGS.processor_argument
         try:
-            getattr(dashboard_processors,
-                    CONFIGS.db_processor)(sql_connector.get_dashboard(CONFIGS.dashboard),
-                                          processor_arg)
+            processor = processor_registry.get_processor(CONFIGS.db_processor)
         except KeyError:
             print('Unknown processor "%s"' % CONFIGS.db_processor)
             exit(1)
+        dashboard_source = get_dashboard_source(CONFIGS.db_processor)
+        dashboard_processors.DASHBOARD_DEADLINE = time() + float(CONFIGS.dashboard_timeout)
+        dashboard_processors.TARGET_CONCURRENCY = int(CONFIGS.target_concurrency)
+        dashboard_processors.TARGET_LOOKUP_LIMIT = int(CONFIGS.target_lookup_limit)
+        dashboard_processors.TARGET_TIMEOUT = float(CONFIGS.target_timeout)
+        try:
+            result = processor(dashboard_source.get_dashboard(CONFIGS.dashboard), processor_arg)
+        except dashboard_processors.DeadlineExceeded as exc:
+            LOGGER.error('%s', exc)
+            exit(DEADLINE_EXIT)
+        finally:
+            if target_memo.stats():
+                sys.stderr.write('%s%s\n' % (MEMO_PREFIX, json_codec.dumps(target_memo.stats())))
+        if result is not None and CONFIGS.db_processor in dashboard_processors.AGGREGATORS:
+            sys.stdout.write('%s%s\n' % (RESULT_PREFIX, json_codec.dumps(result)))
         exit(0)
     if CONFIGS.delete:
         sql_connector.delete_dashboards()
@@ -133,7 +405,7 @@ def main():
         exit(0)
 
     for dashboard in dashboards:
-        if sql_connector.set_dashboard(json.load(open(dashboard))):
+        if sql_connector.set_dashboard(json_codec.load(open(dashboard, 'rb'), ordered=True)):
             LOGGER.info('Saved dashboard %s to database.', dashboard.slug)
 
     sql_connector.close()
@@ -149,11 +421,17 @@ if __name__ == '__main__':
     ARG_PARSER.add_argument('-d', dest='dashboards',
                             help='Grafana json dashboard (file or directory) to push into database.')
     ARG_PARSER.add_argument('--dry-run', action='store_true',
-                            help='Don\'t actually do anything.')
+                            help=('Don\'t actually do anything. With --iterator, --processor or '
+                                  '--watch, log a diff of the changes instead of writing them.'))
+    ARG_PARSER.add_argument('--coordinator', metavar='HOST:PORT',
+                            help='With --iterator, serve the dashboards to --worker processes.')
     ARG_PARSER.add_argument('--delete', action='store_true',
                             help='Delete quorra graphs explicitly from grafana_test database.')
     ARG_PARSER.add_argument('--iterator', dest='db_iterator',
                             help='Specify processor function to iterate over per dashboard in db.')
+    ARG_PARSER.add_argument('--pipeline', action='store_true',
+                            help=('With --iterator, run the processor in a staged pipeline in '
+                                  'this process, see dashboard_pipeline.'))
     ARG_PARSER.add_argument('--processor', dest='db_processor',
                             help='Specify processor function to operate on a specified dashboard.')
     ARG_PARSER.add_argument('--processor-argument', default=None,
@@ -161,6 +439,17 @@ if __name__ == '__main__':
     ARG_PARSER.add_argument('--dashboard', help='Specific Grafana dashboard to use with --processor.')
     ARG_PARSER.add_argument('--list-processors', action='store_true', dest='list_processors',
                             help='List possible database iterators to use with --iterator or --processor.')
+    ARG_PARSER.add_argument('--retry', action='store_true',
+                            help='With --iterator, only process the dashboards that timed out last run.')
+    ARG_PARSER.add_argument('--sync-mirror', action='store_true',
+                            help='Incrementally sync the local dashboard mirror and exit.')
+    ARG_PARSER.add_argument('--use-mirror', action='store_true',
+                            help='Read dashboards from the local mirror (read-only processors only).')
+    ARG_PARSER.add_argument('--watch', action='store_true',
+                            help=('Run the watch_processors on dashboards as they change, '
+                                  'see dashboard_watch.'))
+    ARG_PARSER.add_argument('--worker', metavar='HOST:PORT',
+                            help='Process dashboards served by the --coordinator at HOST:PORT.')
     CONFIGS(ARG_PARSER.parse_args())
     initialize_logger()
     try:
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+'''Fuzzy search over the metric paths of every dashboard target.
+
+find_dashboard_with_metric scans the fleet for every search and its
+SIMILAR matches need the program_id and metric_name to be equal, typos
+and renamed nodes are missed. The index is a sqlite file (metric_index_path)
+holding every distinct path of the targets, the dashboards and panels
+using it, and the character trigrams of every node of the path. A search
+takes the metric_index_candidates paths sharing the most trigrams with
+the query, trigrams weighted by their rarity and common ones (md, host,
+...) left out once POSTINGS_BUDGET paths are read, and ranks them by
+node level edit distance: nodes are
+inserted or deleted at cost 1 and substituted at their character edit
+distance relative to their length, so prog.requets.count is 0.125 from
+prog.requests.count.
+
+refresh() only indexes the dashboards whose version changed since the
+last refresh and drops the removed ones.
+
+    python metric_index.py --refresh [--use-mirror]
+    python metric_index.py prog.requets.count --top 10
+
+'''
+from collections import namedtuple
+import dashboard_handle
+from lazy_import import lazy_module
+import math
+import panel_stream
+import sqlite3
+import target_ast
+import triconf
+
+dashboard_mirror = lazy_module('dashboard_mirror')
+sql_connector = lazy_module('sql_connector')
+
+CONFIGS = None
+INDEX_CONNECTION = None
+CANDIDATES = 200  # Default paths sharing the most trigrams ranked by edit distance.
+POSTINGS_BUDGET = 20000  # Paths of trigrams a search reads at most, rarest trigrams first.
+MATCH = namedtuple('Match', 'path distance uses')  # uses: [(slug, panel title)].
+
+
+class MetricIndexException(Exception):
+    def __init__(self, msg=''):
+        super(MetricIndexException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('metric_index', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+def _get_index_connection():
+    '''Return the sqlite connection to the index, creating the tables on
+    first use.
+
+    '''
+    global INDEX_CONNECTION
+    if INDEX_CONNECTION is None:
+        if CONFIGS is None:
+            initialize()
+        INDEX_CONNECTION = sqlite3.connect(CONFIGS.metric_index_path, timeout=60)
+        for statement in ('CREATE TABLE IF NOT EXISTS dashboard '
+                          '(id INTEGER PRIMARY KEY, slug TEXT, version INTEGER)',
+                          'CREATE TABLE IF NOT EXISTS path '
+                          '(id INTEGER PRIMARY KEY, path TEXT UNIQUE)',
+                          'CREATE TABLE IF NOT EXISTS gram (gram TEXT, path_id INTEGER)',
+                          'CREATE INDEX IF NOT EXISTS gram_gram ON gram (gram)',
+                          'CREATE TABLE IF NOT EXISTS gram_frequency '
+                          '(gram TEXT PRIMARY KEY, paths INTEGER)',
+                          'CREATE TABLE IF NOT EXISTS use '
+                          '(dashboard_id INTEGER, panel TEXT, path_id INTEGER)',
+                          'CREATE INDEX IF NOT EXISTS use_dashboard ON use (dashboard_id)',
+                          'CREATE INDEX IF NOT EXISTS use_path ON use (path_id)'):
+            INDEX_CONNECTION.execute(statement)
+        INDEX_CONNECTION.commit()
+    return INDEX_CONNECTION
+
+
+def node_grams(path):
+    '''Return the set of character trigrams of the nodes of path, nodes
+    padded with ^ and $.
+
+    '''
+    grams = set()
+    for node in path.split('.'):
+        padded = '^%s$' % node
+        grams.update([padded[x:x + 3] for x in range(max(len(padded) - 2, 1))])
+    return grams
+
+
+def _edit_distance(first, second, cost):
+    '''Levenshtein distance of the sequences first and second, inserts
+    and deletes costing 1, substitutions cost(a, b).
+
+    '''
+    previous = list(range(len(second) + 1))
+    for row, item in enumerate(first):
+        current = [row + 1]
+        for column, other in enumerate(second):
+            current.append(min(previous[column + 1] + 1, current[column] + 1,
+                               previous[column] + (cost(item, other) if item != other else 0)))
+        previous = current
+    return previous[-1]
+
+
+def _node_cost(first, second):
+    return float(_edit_distance(first, second, lambda x, y: 1)) / max(len(first), len(second))
+
+
+def path_distance(first, second):
+    '''Node level edit distance of the paths first and second.
+
+    '''
+    return _edit_distance(first.split('.'), second.split('.'), _node_cost)
+
+
+def _target_paths(data):
+    '''Yield (panel title, path) of every path of the targets in the
+    dashboard json data.
+
+    '''
+    for panel in panel_stream.iter_panels(data):
+        panel_title = panel.title if panel.title else 'panelId=%s' % panel.id
+        for target in panel.targets or ():
+            if not target.target:
+                continue
+            try:
+                tree = target_ast.parse(target.target)
+            except target_ast.TargetParseException:
+                continue
+            for path in set([x.path for x in target_ast.iter_paths(tree)]):
+                yield panel_title, path
+
+
+def _path_id(connection, path, new_grams):
+    '''Return the id of path, indexing it if it is new. The counts of
+    the grams of new paths are added to new_grams.
+
+    '''
+    row = connection.execute('SELECT id FROM path WHERE path = ?', (path,)).fetchone()
+    if row:
+        return row[0]
+    path_id = connection.execute('INSERT INTO path (path) VALUES (?)', (path,)).lastrowid
+    grams = node_grams(path)
+    connection.executemany('INSERT INTO gram (gram, path_id) VALUES (?, %s)' % path_id,
+                           [(x,) for x in grams])
+    for gram in grams:
+        new_grams[gram] = new_grams.get(gram, 0) + 1
+    return path_id
+
+
+def _add_gram_frequencies(connection, new_grams):
+    connection.executemany('INSERT OR IGNORE INTO gram_frequency (gram, paths) VALUES (?, 0)',
+                           [(x,) for x in new_grams])
+    connection.executemany('UPDATE gram_frequency SET paths = paths + ? WHERE gram = ?',
+                           [(y, x) for x, y in new_grams.items()])
+
+
+def refresh(handles, fetch=None):
+    '''Bring the index up to date with the dashboards of handles, see
+    dashboard_handle, only loading the data of the dashboards whose
+    version changed, with fetch(ids) if given. Returns (dashboards
+    indexed, dashboards dropped).
+
+    '''
+    connection = _get_index_connection()
+    indexed = dict(connection.execute('SELECT id, version FROM dashboard'))
+    changed = [x for x in handles if indexed.get(x.id) != x.version]
+    live_ids = set([x.id for x in handles])
+    dropped = [x for x in indexed if x not in live_ids]
+    for dashboard_id in dropped + [x.id for x in changed]:
+        connection.execute('DELETE FROM use WHERE dashboard_id = ?', (dashboard_id,))
+        connection.execute('DELETE FROM dashboard WHERE id = ?', (dashboard_id,))
+    if fetch:
+        # Batches of changed dashboards only, rather than of all handles.
+        dashboard_handle.BatchLoader(fetch).track(changed)
+    new_grams = {}
+    for dashboard in changed:
+        try:
+            data = dashboard.data
+        except KeyError:
+            continue  # Deleted since the handles were gathered.
+        uses = set([(panel_title, _path_id(connection, path, new_grams))
+                    for panel_title, path in _target_paths(data)])
+        connection.executemany('INSERT INTO use (dashboard_id, panel, path_id) VALUES (?, ?, ?)',
+                               [(dashboard.id, x, y) for x, y in uses])
+        connection.execute('INSERT INTO dashboard (id, slug, version) VALUES (?, ?, ?)',
+                           (dashboard.id, dashboard.slug, dashboard.version))
+    _add_gram_frequencies(connection, new_grams)
+    if dropped or changed:
+        connection.execute('DELETE FROM path WHERE id NOT IN (SELECT path_id FROM use)')
+        orphans = connection.execute('SELECT gram, COUNT(*) FROM gram WHERE path_id NOT IN '
+                                     '(SELECT id FROM path) GROUP BY gram').fetchall()
+        connection.executemany('UPDATE gram_frequency SET paths = paths - ? WHERE gram = ?',
+                               [(y, x) for x, y in orphans])
+        connection.execute('DELETE FROM gram WHERE path_id NOT IN (SELECT id FROM path)')
+        connection.execute('DELETE FROM gram_frequency WHERE paths <= 0')
+    connection.commit()
+    return len(changed), len(dropped)
+
+
+def search(query, top=10, candidates=None):
+    '''Return the MATCHes of the top paths nearest to the path query,
+    nearest first.
+
+    '''
+    candidates = candidates or int(getattr(CONFIGS, 'metric_index_candidates', 0) or CANDIDATES)
+    connection = _get_index_connection()
+    if not connection.execute('SELECT 1 FROM dashboard LIMIT 1').fetchone():
+        raise MetricIndexException('Index %s is empty, run --refresh first.'
+                                   % CONFIGS.metric_index_path)
+    grams = sorted(node_grams(query))
+    frequencies = dict(connection.execute(
+        'SELECT gram, paths FROM gram_frequency WHERE gram IN (%s)'
+        % ', '.join(['?'] * len(grams)), tuple(grams)))
+    total = connection.execute('SELECT COUNT(*) FROM path').fetchone()[0]
+    selected = []
+    postings = 0
+    for gram in sorted(frequencies, key=frequencies.get):
+        if selected and postings + frequencies[gram] > POSTINGS_BUDGET:
+            break
+        selected.append(gram)
+        postings += frequencies[gram]
+    scores = {}
+    for gram, path_id in connection.execute('SELECT gram, path_id FROM gram WHERE gram IN (%s)'
+                                            % ', '.join(['?'] * len(selected)),
+                                            tuple(selected)):
+        scores[path_id] = scores.get(path_id, 0) + math.log(float(total) / frequencies[gram])
+    best = sorted(scores, key=scores.get, reverse=True)[:candidates]
+    rows = connection.execute('SELECT path, id FROM path WHERE id IN (%s)'
+                              % ', '.join(['?'] * len(best)), tuple(best)).fetchall()
+    node_costs = {}
+
+    def node_cost(first, second):
+        if (first, second) not in node_costs:
+            node_costs[(first, second)] = _node_cost(first, second)
+        return node_costs[(first, second)]
+    query_nodes = query.split('.')
+    ranked = sorted([(_edit_distance(query_nodes, path.split('.'), node_cost), path, path_id)
+                     for path, path_id in rows])[:top]
+    matches = []
+    for distance, path, path_id in ranked:
+        uses = connection.execute('SELECT dashboard.slug, use.panel FROM use '
+                                  'JOIN dashboard ON dashboard.id = use.dashboard_id '
+                                  'WHERE use.path_id = ? ORDER BY dashboard.slug, use.panel',
+                                  (path_id,)).fetchall()
+        matches.append(MATCH(path, round(distance, 3), [tuple(x) for x in uses]))
+    return matches
+
+
+if __name__ == '__main__':
+    from time import time
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS, description='Fuzzy search over metric paths.')
+    PARSER.add_argument('query', nargs='?', help='Metric path to find the nearest paths of.')
+    PARSER.add_argument('--refresh', action='store_true',
+                        help='Index the dashboards changed since the last refresh.')
+    PARSER.add_argument('--top', type=int, default=10, help='Number of paths to list.')
+    PARSER.add_argument('--use-mirror', action='store_true',
+                        help='Refresh from the local mirror, synced first, see dashboard_mirror.')
+    CONFIGS(PARSER.parse_args())
+    START = time()
+    if CONFIGS.refresh:
+        if CONFIGS.use_mirror:
+            dashboard_mirror.sync()
+            SOURCE = dashboard_mirror
+        else:
+            SOURCE = sql_connector
+        print('%s dashboards indexed, %s dropped in %.1fs.'
+              % (refresh(SOURCE.get_dashboard_handles(), SOURCE.get_dashboards_data)
+                 + (time() - START,)))
+    elif CONFIGS.query:
+        for match in search(CONFIGS.query, CONFIGS.top):
+            print('%.3f %s' % (match.distance, match.path))
+            for slug, panel_title in match.uses:
+                print('    %s graph "%s"' % (slug, panel_title))
+        print('Searched in %.0fms.' % (1000 * (time() - START)))
+    else:
+        PARSER.print_help()
@@ -0,0 +1,193 @@
+'''Rename metric paths in targets from an old to new mapping file.
+
+The mapping file has one "old.path new.path" pair per line, blank lines
+and lines starting with # are skipped. An old path also renames the
+paths it is a prefix of, node wise, the longest old prefix wins:
+
+    prog.metric.host.count    prog.md.metric.host.h.count
+    prog.old_name             prog.md.new_name
+
+renames prog.old_name.ctx.value to prog.md.new_name.ctx.value. The
+mapping is loaded into a trie of path nodes, so a path is renamed in
+one walk over its nodes whatever the size of the mapping. A node with a
+glob or template variable only matches an old path having the same
+text, paths are renamed when the nodes before them match.
+
+Targets are parsed with target_ast and only their paths change. The
+node numbers of aliasByNode, groupByNode(s) and the *WithWildcards
+functions follow the nodes of the renamed path they refer to: nodes
+after the renamed prefix shift by the difference in length, nodes in it
+move to where the same node is in the new prefix if it is there once,
+and its last node to the last node of the new prefix otherwise.
+
+The trie is cached next to the mapping file (mapping file + .trie) and
+rebuilt when the mapping changes, every child of an iteration loads it
+instead of parsing the mapping again.
+
+'''
+import marshal
+import os
+import re
+import target_ast
+
+# Arguments holding node numbers of the first argument's series, as
+# (first, last + 1 or None for all the rest).
+NODE_ARGUMENTS = {'aliasByNode': (1, None), 'groupByNode': (1, 2), 'groupByNodes': (2, None),
+                  'aggregateWithWildcards': (2, None), 'averageSeriesWithWildcards': (1, None),
+                  'multiplySeriesWithWildcards': (1, None), 'sumSeriesWithWildcards': (1, None)}
+_INTEGER = re.compile(r'^-?\d+$')
+
+
+class MetricRenameException(Exception):
+    def __init__(self, msg=''):
+        super(MetricRenameException, self).__init__(msg)
+
+
+def build_trie(lines):
+    '''Return the trie of the mapping lines, nested {node: {...}} where
+    the key None holds the new path of the old path ending there.
+
+    '''
+    trie = {}
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise MetricRenameException('Line %s of the mapping is not "old.path new.path": %s'
+                                        % (number + 1, line))
+        node = trie
+        for part in fields[0].split('.'):
+            node = node.setdefault(part, {})
+        node[None] = fields[1]
+    return trie
+
+
+def load_trie(mapping_path):
+    '''Return the trie of the mapping file, from its cache if it is up to
+    date, otherwise building and caching it.
+
+    '''
+    stat = os.stat(mapping_path)
+    version = (int(stat.st_mtime), stat.st_size)
+    cache_path = mapping_path + '.trie'
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_version, trie = marshal.load(cache_file)
+        if tuple(cached_version) == version:
+            return trie
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(mapping_path) as mapping_file:
+        trie = build_trie(mapping_file)
+    try:
+        with open(cache_path + '.tmp', 'wb') as cache_file:
+            marshal.dump((version, trie), cache_file)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError):
+        pass  # A read-only mapping directory, the trie is built every time.
+    return trie
+
+
+def _shift_node(arg, old_prefix, new_prefix):
+    if not isinstance(arg, target_ast.Literal) or not _INTEGER.match(arg.text):
+        return arg
+    index = int(arg.text)
+    if index < 0:
+        return arg  # Counted from the end, the end of the path is kept.
+    if index >= len(old_prefix):
+        return target_ast.Literal(str(index + len(new_prefix) - len(old_prefix)))
+    if new_prefix.count(old_prefix[index]) == 1:
+        return target_ast.Literal(str(new_prefix.index(old_prefix[index])))
+    if index == len(old_prefix) - 1:
+        return target_ast.Literal(str(len(new_prefix) - 1))
+    return arg
+
+
+class MetricRenamer(object):
+    def __init__(self, trie):
+        self.trie = trie
+
+    @classmethod
+    def from_file(cls, mapping_path):
+        return cls(load_trie(mapping_path))
+
+    def rename_path(self, path):
+        '''Return (new path, old prefix nodes, new prefix nodes) of the
+        longest old path path starts with, None if there is none.
+
+        '''
+        nodes = path.split('.')
+        trie = self.trie
+        match = None
+        for number, part in enumerate(nodes):
+            trie = trie.get(part)
+            if trie is None:
+                break
+            if None in trie:
+                match = number + 1, trie[None]
+        if match is None:
+            return None
+        length, new_prefix = match
+        return ('.'.join([new_prefix] + nodes[length:]), nodes[:length],
+                new_prefix.split('.'))
+
+    def _rename(self, node, renames):
+        if isinstance(node, target_ast.Path):
+            rename = self.rename_path(node.path)
+            if rename is None:
+                return node
+            renames.append(rename)
+            return target_ast.Path(rename[0])
+        if isinstance(node, target_ast.Keyword):
+            return target_ast.Keyword(node.name, self._rename(node.value, renames))
+        if not isinstance(node, target_ast.Call):
+            return node
+        args = []
+        series_renames = []
+        for number, arg in enumerate(node.args):
+            arg_renames = []
+            args.append(self._rename(arg, arg_renames))
+            renames.extend(arg_renames)
+            if number == 0:
+                series_renames = arg_renames
+        if node.name in NODE_ARGUMENTS and len(series_renames) == 1 \
+           and len(list(target_ast.iter_paths(node.args[0]))) == 1:
+            first, last = NODE_ARGUMENTS[node.name]
+            _, old_prefix, new_prefix = series_renames[0]
+            args = [_shift_node(x, old_prefix, new_prefix)
+                    if first <= number < (last or len(args)) else x
+                    for number, x in enumerate(args)]
+        return target_ast.Call(node.name, tuple(args))
+
+    def rename_target(self, target):
+        '''Return the target with its paths renamed, None if none is or it
+        can't be parsed.
+
+        '''
+        try:
+            tree = target_ast.parse(target)
+        except target_ast.TargetParseException:
+            return None
+        renames = []
+        tree = self._rename(tree, renames)
+        return target_ast.serialize(tree) if renames else None
+
+    def apply(self, slug, dashboard_obj):
+        '''Rename the paths of the targets of the dashboard dict in place,
+        returns the list of changes made.
+
+        '''
+        changes = []
+        panels = [x for row in dashboard_obj.get('rows') or [] for x in row.get('panels') or []]
+        for panel in panels + (dashboard_obj.get('panels') or []):
+            for target in panel.get('targets') or []:
+                if not target.get('target'):
+                    continue
+                new_target = self.rename_target(target['target'])
+                if new_target is not None and new_target != target['target']:
+                    changes.append('panel "%s": %s -> %s' % (panel.get('title'),
+                                                             target['target'], new_target))
+                    target['target'] = new_target
+        return changes
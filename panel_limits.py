@@ -0,0 +1,212 @@
+'''Keep dashboards within what browsers and graphite handle well.
+
+Series are counted per panel with target_ast.estimate_series, glob
+fan-out only where count_glob knows it. Over the limits from conf.ini:
+
+  - panels over max_series_per_panel are split, their targets packed
+    into as few panels as fit;
+  - rows over max_series_per_row are split into several rows;
+  - the graph panels of dashboards over too_many_graphs_for_flot are
+    switched to png, other panel types have no renderer;
+  - panels still over max_series_per_panel (a single heavy target) get
+    maxDataPoints and their targets wrapped in consolidateBy.
+
+The same limits apply to existing dashboards (apply_to_dashboard, used
+by the limit_panel_series processor) and to generated ones
+(builder_hook, a DashboardBuilder hook).
+
+'''
+import copy
+import target_ast
+import triconf
+
+CONFIGS = None
+CONSOLIDATE_FUNCTION = 'max'  # Keeps spikes visible when points are consolidated.
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('panel_limits', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+def _conf_int(name, default):
+    if CONFIGS is None:
+        initialize()
+    return int(getattr(CONFIGS, name, None) or default)
+
+
+def _target_string(target):
+    return target.get('target') if isinstance(target, dict) else target
+
+
+def _pack(items, sizes, limit):
+    '''Split items into consecutive chunks whose sizes sum to at most
+    limit, an item bigger than limit gets a chunk of its own.
+
+    '''
+    chunks = [[]]
+    total = 0
+    for item, size in zip(items, sizes):
+        if chunks[-1] and total + size > limit:
+            chunks.append([])
+            total = 0
+        chunks[-1].append(item)
+        total += size
+    return chunks
+
+
+def _numbered(title, number, count):
+    return '%s (%s/%s)' % (title or '', number, count)
+
+
+class PanelLimits(object):
+    '''Series limits, defaulting to conf.ini. count_glob(glob) returns
+    the number of series glob matches, or None if unknown.
+
+    '''
+    def __init__(self, max_series_per_panel=None, max_series_per_row=None,
+                 max_series_for_flot=None, max_data_points=None, count_glob=None):
+        self.max_series_per_panel = max_series_per_panel \
+            or _conf_int('max_series_per_panel', 30)
+        self.max_series_per_row = max_series_per_row or _conf_int('max_series_per_row', 120)
+        self.max_series_for_flot = max_series_for_flot \
+            or _conf_int('too_many_graphs_for_flot', 100)
+        self.max_data_points = max_data_points or _conf_int('max_data_points', 1000)
+        self.count_glob = count_glob
+        self._next_id = None
+
+    def target_series(self, target):
+        if isinstance(target, dict) and target.get('hide'):
+            return 0
+        target_string = _target_string(target)
+        if not target_string:
+            return 0
+        try:
+            return target_ast.estimate_series(target_ast.parse(target_string), self.count_glob)
+        except target_ast.TargetParseException:
+            return 1
+
+    def panel_series(self, panel):
+        return sum([self.target_series(x) for x in panel.get('targets') or []])
+
+    def _split_panel(self, panel, changes):
+        targets = panel.get('targets') or []
+        sizes = [self.target_series(x) for x in targets]
+        if sum(sizes) <= self.max_series_per_panel or len(targets) < 2:
+            return [panel]
+        # Targets referring to other targets (#A) have to stay together.
+        if any('#' in (_target_string(x) or '') for x in targets):
+            return [panel]
+        chunks = _pack(targets, sizes, self.max_series_per_panel)
+        if len(chunks) == 1:
+            return [panel]
+        changes.append('panel "%s": %s series split into %s panels'
+                       % (panel.get('title'), sum(sizes), len(chunks)))
+        panels = []
+        for number, chunk in enumerate(chunks, 1):
+            new_panel = copy.copy(panel)
+            new_panel['title'] = _numbered(panel.get('title'), number, len(chunks))
+            new_panel['targets'] = chunk
+            if number > 1 and new_panel.get('id') is not None:
+                new_panel['id'] = self._new_id()
+            panels.append(new_panel)
+        return panels
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _cap_data_points(self, panel, series, changes):
+        changed = False
+        if 'maxDataPoints' not in panel:
+            panel['maxDataPoints'] = self.max_data_points
+            changed = True
+        targets = []
+        for target in panel.get('targets') or []:
+            target_string = _target_string(target)
+            if target_string and 'consolidateBy' not in target_string:
+                target_string = "consolidateBy(%s, '%s')" % (target_string, CONSOLIDATE_FUNCTION)
+                if isinstance(target, dict):
+                    target = copy.copy(target)
+                    target['target'] = target_string
+                else:
+                    target = target_string
+                changed = True
+            targets.append(target)
+        panel['targets'] = targets
+        if changed:
+            changes.append('panel "%s": %s series, capped at %s data points'
+                           % (panel.get('title'), series, panel['maxDataPoints']))
+
+    def limit_rows(self, rows):
+        '''Apply the limits to rows, a list of (row title, [panel, ...]).
+        Returns the new rows as (index of the original row, title, panels)
+        and a list of the changes made. Panels are changed in place, their
+        targets lists are replaced rather than changed.
+
+        '''
+        changes = []
+        limited = []
+        total = 0
+        # Panels split off get ids after the largest id of the rows.
+        self._next_id = max([x.get('id') or 0 for _, panels in rows for x in panels] or [0])
+        for row_index, (title, panels) in enumerate(rows):
+            new_panels = []
+            for panel in panels:
+                new_panels.extend(self._split_panel(panel, changes))
+            sizes = [self.panel_series(x) for x in new_panels]
+            total += sum(sizes)
+            chunks = _pack(new_panels, sizes, self.max_series_per_row)
+            if len(chunks) > 1:
+                changes.append('row "%s": %s series split into %s rows'
+                               % (title, sum(sizes), len(chunks)))
+                limited.extend([(row_index, _numbered(title, number, len(chunks)), chunk)
+                                for number, chunk in enumerate(chunks, 1)])
+            else:
+                limited.append((row_index, title, new_panels))
+        for _, _, panels in limited:
+            for panel in panels:
+                series = self.panel_series(panel)
+                # Panel specs of DashboardBuilder have no type, they become graphs.
+                if total > self.max_series_for_flot and panel.get('type', 'graph') == 'graph' \
+                        and panel.get('renderer', 'flot') != 'png':
+                    panel['renderer'] = 'png'
+                    changes.append('panel "%s": renderer png, dashboard has %s series'
+                                   % (panel.get('title'), total))
+                if series > self.max_series_per_panel:
+                    self._cap_data_points(panel, series, changes)
+        return limited, changes
+
+    def apply_to_dashboard(self, dashboard):
+        '''Apply the limits to the dashboard dict in place and return the
+        list of changes made.
+
+        '''
+        rows = dashboard.get('rows') or []
+        limited, changes = self.limit_rows([(x.get('title'), x.get('panels', []))
+                                            for x in rows])
+        if changes:
+            new_rows = []
+            for row_index, title, panels in limited:
+                row = copy.copy(rows[row_index])
+                row['title'] = title
+                row['panels'] = panels
+                new_rows.append(row)
+            dashboard['rows'] = new_rows
+        return changes
+
+    def builder_hook(self, changes=None):
+        '''Return a DashboardBuilder hook applying the limits. The changes
+        made are appended to the list changes if given.
+
+        '''
+        def hook(rows):
+            limited, hook_changes = self.limit_rows(rows)
+            if changes is not None:
+                changes.extend(hook_changes)
+            return [(title, panels) for _, title, panels in limited]
+        return hook
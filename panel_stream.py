@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+'''Incremental extraction of panels and targets from dashboard json.
+
+Extraction-only processors need rows[].panels[].targets[] and a few
+panel fields, not the whole dashboard. Rather than loading the whole
+dashboard, the json text is searched for the "panels" and "targets"
+keys and only the values behind them are decoded, one panel or one
+targets list at a time, with the C decoder. A quoted key followed by
+a colon can't occur inside a json string (the quotes would be
+escaped), so the search never lands inside a value.
+
+iter_targets holds one targets list at a time and skips everything
+else in the panels. With simplejson on python 2 and the generated 300KB
+dashboards it is 1.3 to 1.5 times as fast as json_codec.loads for
+ascii and utf-8 blobs, 1.1 to 1.4 times for latin-1 ones; both detect
+the encoding the same way when json_codec.DATA_ENCODING is not set.
+orjson decodes a whole dashboard faster still, there the gain is
+bounded memory only.
+
+iter_panels holds one panel at a time but decodes all of it, it bounds
+memory at 1.1 to 1.8 times the time of loads. Use it for dashboards
+too large to load, or where panel fields are needed anyway.
+
+Run as a script to benchmark against json_codec.loads.
+
+'''
+from collections import namedtuple
+import json_codec
+import re
+import sys
+
+PANEL_RECORD = namedtuple('PanelRecord', 'row_index panel_index id title datasource targets')
+TARGET_RECORD = namedtuple('TargetRecord', 'panel_number target ref_id datasource hide')
+
+_AFTER_KEY = re.compile(r'\s*:\s*')
+_LIST_START = re.compile(r'\[\s*')
+_SEPARATOR = re.compile(r'\s*([,\]])\s*')
+_new_record = tuple.__new__
+
+
+class PanelStreamException(Exception):
+    def __init__(self, msg=''):
+        super(PanelStreamException, self).__init__(msg)
+
+
+def _find_value(text, quoted_key, pos):
+    '''Return the index of the value of the next quoted_key in text from
+    pos on, -1 if there is none.
+
+    '''
+    # str.find is several times faster than a regex search for the key.
+    while True:
+        pos = text.find(quoted_key, pos)
+        if pos < 0:
+            return pos
+        pos += len(quoted_key)
+        colon = _AFTER_KEY.match(text, pos)
+        if colon:
+            return colon.end()
+
+
+def _target_records(panel_number, targets):
+    if not isinstance(targets, list):
+        return ()
+    records = []
+    for target in targets:
+        if isinstance(target, dict):
+            get = target.get
+            # tuple.__new__ skips the python level namedtuple constructor,
+            # which costs as much as decoding the targets.
+            records.append(_new_record(TARGET_RECORD, (panel_number, get('target'), get('refId'),
+                                                       get('datasource'), get('hide'))))
+    return tuple(records)
+
+
+def iter_panel_objects(data):
+    '''Yield (row_index, panel_index, panel) for every panel object in
+    the dashboard json data, in document order. row_index counts the
+    panels lists, one per row. Only one panel is decoded at a time.
+
+    '''
+    text = json_codec.to_text(data)
+    pos = 0
+    row_index = -1
+    while True:
+        pos = _find_value(text, '"panels"', pos)
+        if pos < 0:
+            return
+        match = _LIST_START.match(text, pos)
+        if not match:
+            continue
+        row_index += 1
+        pos = match.end()
+        if text[pos:pos + 1] == ']':
+            pos += 1
+            continue
+        panel_index = -1
+        while True:
+            panel, pos = json_codec.raw_decode(text, pos)
+            panel_index += 1
+            if isinstance(panel, dict):
+                yield row_index, panel_index, panel
+            separator = _SEPARATOR.match(text, pos)
+            if not separator:
+                raise PanelStreamException('Invalid panels list at %s.' % pos)
+            pos = separator.end()
+            if separator.group(1) == ']':
+                break
+
+
+def iter_panels(data):
+    '''Yield a PANEL_RECORD for every panel in the dashboard json data,
+    in document order. targets is a tuple of TARGET_RECORDs, None if the
+    panel has no targets key.
+
+    '''
+    panel_number = -1
+    for row_index, panel_index, panel in iter_panel_objects(data):
+        targets = None
+        if 'targets' in panel:
+            panel_number += 1
+            targets = _target_records(panel_number, panel['targets'])
+        yield _new_record(PANEL_RECORD, (row_index, panel_index, panel.get('id'),
+                                         panel.get('title'), panel.get('datasource'), targets))
+
+
+def iter_targets(data):
+    '''Yield a TARGET_RECORD for every target with a target string in
+    the dashboard json data. panel_number counts the panels having
+    targets, in document order, the same as in iter_panels.
+
+    '''
+    text = json_codec.to_text(data)
+    pos = 0
+    panel_number = -1
+    while True:
+        pos = _find_value(text, '"targets"', pos)
+        if pos < 0:
+            return
+        targets, pos = json_codec.raw_decode(text, pos)
+        panel_number += 1
+        for target in _target_records(panel_number, targets):
+            if target.target is not None:
+                yield target
+
+
+def _loads_targets(data):
+    '''Target extraction by loading the whole dashboard, for the
+    benchmark.
+
+    '''
+    ret = []
+    for row in json_codec.loads(data)['rows']:
+        for panel in row['panels']:
+            for target in panel.get('targets', ()):
+                ret.append(target['target'])
+    return ret
+
+
+def _best_time(fun, number):
+    from timeit import repeat
+    return min(repeat(fun, number=number, repeat=5)) / number
+
+
+def benchmark(samples, number=20):
+    '''Time loads, iter_panels and iter_targets on samples, [(name,
+    blob)], with DATA_ENCODING unset and set to the encoding of the
+    blob. Best of 5 runs of number calls.
+
+    '''
+    print('json backend: %s' % json_codec.BACKEND)
+    data_encoding = json_codec.DATA_ENCODING
+    for name, blob in samples:
+        for encoding in (None, json_codec.detect_encoding(blob)):
+            json_codec.DATA_ENCODING = encoding
+            try:
+                loaded = _best_time(lambda: _loads_targets(blob), number)
+                panels = _best_time(lambda: [x.title for x in iter_panels(blob)], number)
+                targets = _best_time(lambda: [x.target for x in iter_targets(blob)], number)
+            finally:
+                json_codec.DATA_ENCODING = data_encoding
+            print('%-20s %-7s %8d bytes  loads %7.2fms  iter_panels %7.2fms (%.2fx)  '
+                  'iter_targets %7.2fms (%.2fx)'
+                  % (name, 'known' if encoding else '', len(blob), loaded * 1000,
+                     panels * 1000, loaded / panels, targets * 1000, loaded / targets))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        benchmark([(x, open(x, 'rb').read()) for x in sys.argv[1:]])
+    else:
+        benchmark(json_codec.sample_dashboards())
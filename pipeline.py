@@ -0,0 +1,157 @@
+'''Staged pipeline with bounded queues between the stages.
+
+Every stage has its own worker threads and an input queue of
+queue_size items. A full queue blocks the stage before it, so a slow
+stage throttles the ones feeding it instead of piling up items. A stage
+function returning None drops the item, with expand the items of the
+returned iterable are passed on one by one. Stages with a batch_size
+get lists of up to batch_size items, a batch is passed early when no
+item came for batch_wait seconds.
+
+stats() reports per stage the queue depth, the items processed and how
+busy the workers were. The stage with full input queue and busy workers
+is the bottleneck.
+
+    pipe = Pipeline([Stage('read', read, expand=True),
+                     Stage('decode', decode, workers=4),
+                     Stage('write', write, batch_size=100)])
+    pipe.run(id_chunks, report=LOGGER.info)
+
+'''
+from collections import namedtuple
+import threading
+from time import time
+import traceback
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+STAGE_STATS = namedtuple('StageStats',
+                         'name workers queue_depth queue_size processed errors busy throughput')
+_END = object()
+
+
+class Stage(object):
+    def __init__(self, name, fun, workers=1, queue_size=100, batch_size=None, batch_wait=1.0,
+                 expand=False):
+        self.name = name
+        self.fun = fun
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.expand = expand
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._running = workers
+        self._lock = threading.Lock()
+
+
+class Pipeline(object):
+    '''Runs items through stages. on_error(stage name, traceback text)
+    is called for every exception of a stage function, the item is
+    dropped.
+
+    '''
+    def __init__(self, stages, on_error=None):
+        self.stages = stages
+        self.on_error = on_error
+        self.results = []
+        self.start_time = None
+
+    def _pass_on(self, index, result):
+        if result is None:
+            return
+        results = result if self.stages[index].expand else [result]
+        for item in results:
+            if index + 1 < len(self.stages):
+                self.stages[index + 1].queue.put(item)
+            else:
+                self.results.append(item)
+
+    def _call(self, index, stage, item):
+        start = time()
+        try:
+            self._pass_on(index, stage.fun(item))
+        except Exception:
+            with stage._lock:
+                stage.errors += 1
+            if self.on_error:
+                self.on_error(stage.name, traceback.format_exc())
+        with stage._lock:
+            stage.processed += len(item) if stage.batch_size else 1
+            stage.busy_seconds += time() - start
+
+    def _work(self, index):
+        stage = self.stages[index]
+        batch = []
+        while True:
+            try:
+                item = stage.queue.get(timeout=stage.batch_wait if batch else None)
+            except Empty:
+                self._call(index, stage, batch)
+                batch = []
+                continue
+            if item is _END:
+                break
+            if not stage.batch_size:
+                self._call(index, stage, item)
+                continue
+            batch.append(item)
+            if len(batch) >= stage.batch_size:
+                self._call(index, stage, batch)
+                batch = []
+        if batch:
+            self._call(index, stage, batch)
+        with stage._lock:
+            stage._running -= 1
+            last = not stage._running
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self.stages[index + 1].queue.put(_END)
+
+    def _feed(self, items):
+        for item in items:
+            self.stages[0].queue.put(item)
+        for _ in range(self.stages[0].workers):
+            self.stages[0].queue.put(_END)
+
+    def stats(self):
+        '''Return the STAGE_STATS of every stage. busy is the fraction of
+        the time its workers spent in the stage function.
+
+        '''
+        elapsed = max(time() - self.start_time, 1e-6) if self.start_time else 1e-6
+        return [STAGE_STATS(x.name, x.workers, x.queue.qsize(), x.queue.maxsize, x.processed,
+                            x.errors, x.busy_seconds / (elapsed * x.workers),
+                            x.processed / elapsed) for x in self.stages]
+
+    def format_stats(self):
+        return ', '.join(['%s: queue %s/%s, %s done (%.1f/s), %.0f%% busy%s'
+                          % (x.name, x.queue_depth, x.queue_size, x.processed, x.throughput,
+                             100 * x.busy, ', %s errors' % x.errors if x.errors else '')
+                          for x in self.stats()])
+
+    def run(self, items, report=None, report_interval=10.0):
+        '''Run items through the stages, calling report with
+        format_stats() every report_interval seconds. Returns the
+        results of the last stage.
+
+        '''
+        self.start_time = time()
+        threads = [threading.Thread(target=self._feed, args=(items,))]
+        for index, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self._work, args=(index,))
+                        for _ in range(stage.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(report_interval)
+                if report and thread.is_alive():
+                    report(self.format_stats())
+        return self.results
@@ -0,0 +1,95 @@
+'''Lightweight registry of the available dashboard processors.
+
+Only names and descriptions live here so that listing processors, or
+validating a processor name given on the cli, does not import the
+modules implementing them (and MySQLdb, requests, ... with them).
+Processors are still defined with make_db_processor; every processor
+registered there needs an entry here with the same description as its
+docstring, tests/test_processor_registry.py keeps the two in sync.
+
+'''
+from collections import namedtuple, OrderedDict
+import importlib
+
+PROCESSOR_INFO = namedtuple('ProcessorInfo', 'name module read_only description')
+PROCESSORS = OrderedDict()
+
+
+def register(name, description, module='dashboard_processors', read_only=False):
+    '''Register processor name, implemented in module. read_only
+    processors never write to the database.
+
+    '''
+    PROCESSORS[name] = PROCESSOR_INFO(name, module, read_only, description.strip())
+    return PROCESSORS[name]
+
+
+def get_processor(name):
+    '''Import the module implementing processor name and return the
+    processor. Raises KeyError for unknown processors.
+
+    '''
+    info = PROCESSORS[name]
+    return getattr(importlib.import_module(info.module), name)
+
+
+def list_processors():
+    return '\n\n'.join(['%s - %s' % (info.name, info.description)
+                        for info in PROCESSORS.values()])
+
+
+register('find_dashboard_with_metric',
+         '''Find the given metric in the dashboard.''',
+         read_only=True)
+register('find_dashboards_with_datasource',
+         '''Find dashboards with the specified datasource.''',
+         read_only=True)
+register('find_dashboard_with_regex',
+         '''Find the given metric in the dashboard.''',
+         read_only=True)
+register('update_datasource',
+         '''Updates current datasource in dashboards to the specified
+datasource. processor_arg is expected to be a two element tuple as
+"old_datasource, new_datasource".''')
+register('update_old_paths',
+         '''Try to modify the target path to the updated path.''')
+register('limit_panel_series',
+         '''Split panels and rows over the series limits in conf.ini, render
+heavy dashboards as png and cap the data points of panels that can't
+be split. With processor_arg "lookup" glob fan-out is counted with
+graphite finds, otherwise every glob counts as one series.''')
+register('consolidate_targets',
+         '''Fold targets of a panel differing in one path node only into one
+target with a brace glob, e.g. a.ca.b and a.lc.b into a.{ca,lc}.b,
+see target_consolidation.''')
+register('estimate_query_cost',
+         '''Estimate the graphite load of the dashboard and of its heaviest
+panels, see query_cost. processor_arg is an optional namespace
+snapshot file to count glob fan-out with instead of graphite finds.''',
+         read_only=True)
+register('govern_refresh',
+         '''Clamp the refresh interval, refresh options and time range of the
+dashboard to the policy file given as processor_arg, see
+refresh_governor.''')
+register('rename_metrics',
+         '''Rename the metric paths of the targets from the old to new mapping
+file given as processor_arg, keeping functions and aliases and moving
+aliasByNode node numbers with the nodes, see metric_renames.''')
+register('count_datasources',
+         '''Count the dashboards using every datasource, panels without one
+use the default datasource.''',
+         read_only=True)
+register('top_metrics',
+         '''List the metric paths used by the most targets across dashboards,
+processor_arg is the number of paths to list, 100 by default.''',
+         read_only=True)
+register('find_stale_targets',
+         '''Report the targets without datapoints since processor_arg, a
+graphite from= value (stale_series_window by default), per panel. Targets
+are checked with render requests of many targets each, templated ones
+are not checked.''',
+         read_only=True)
+register('list_dashboards_with_old_metric_paths',
+         '''Search the whole dashboard for potential old metrics (metrics that
+do not have the md or agg namespace).''',
+         read_only=True)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+'''Estimate the load dashboards put on graphite.
+
+The cost of a panel is the number of series graphite reads for its
+targets times the hours of data fetched per hour:
+
+    fetched series * refreshes per hour * hours in the time range
+
+Fetched series are the fan-out of the globs of a target,
+target_ast.estimate_fetched, so sumSeries(a.*.cpu) over 10000 hosts
+costs 10000 although it returns one series. The series returned,
+target_ast.estimate_series, are reported alongside. Glob fan-out comes
+from a namespace snapshot (a file of metric paths, one per line) or
+from graphite finds. Every glob is counted once per run however many
+dashboards use it. Dashboards without auto refresh are counted as
+loaded LOADS_PER_HOUR times an hour.
+
+Run as a script to rank the whole fleet:
+
+    python query_cost.py --snapshot metrics.txt --top 20
+
+'''
+from collections import namedtuple
+from lazy_import import lazy_module
+import json_codec
+import re
+import target_ast
+import triconf
+
+dashboard_mirror = lazy_module('dashboard_mirror')
+sql_connector = lazy_module('sql_connector')
+validate_metrics = lazy_module('validate_metrics')
+
+CONFIGS = None
+DASHBOARD_COST = namedtuple('DashboardCost',
+                            'slug series fetched refreshes_per_hour range_hours cost panels')
+PANEL_COST = namedtuple('PanelCost', 'slug title series fetched cost')
+DEFAULT_RANGE_HOURS = 6.0  # main_layout's now-6h.
+LOADS_PER_HOUR = 1.0
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'M': 2592000,
+                  'y': 31536000}
+_INTERVAL = re.compile(r'^(\d+)([smhdwMy])$')
+_RELATIVE_TIME = re.compile(r'^now-(\d+)([smhdwMy])(/[smhdwMy])?$')
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('query_cost', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+def interval_seconds(interval):
+    '''Return the seconds in a grafana interval like 30s or 5m, None if
+    interval isn't one (refresh is false or empty without auto refresh).
+
+    '''
+    if not interval or interval is True:
+        return None
+    match = _INTERVAL.match(str(interval))
+    if not match:
+        return None
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def refreshes_per_hour(refresh):
+    seconds = interval_seconds(refresh)
+    if not seconds:
+        return LOADS_PER_HOUR
+    return 3600.0 / seconds
+
+
+def range_hours(time_range):
+    '''Return the hours in the dashboard time range ({"from": "now-6h",
+    "to": "now"}), DEFAULT_RANGE_HOURS for absolute ranges.
+
+    '''
+    match = _RELATIVE_TIME.match((time_range or {}).get('from') or '')
+    if not match:
+        return DEFAULT_RANGE_HOURS
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)] / 3600.0
+
+
+def _glob_regex(pattern):
+    '''Translate one node of a graphite glob to a regex.
+
+    '''
+    regex = []
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '[' and ']' in pattern[pos:]:
+            end = pattern.index(']', pos)
+            regex.append(pattern[pos:end + 1])
+            pos = end
+        elif char == '{' and '}' in pattern[pos:]:
+            end = pattern.index('}', pos)
+            regex.append('(?:%s)' % '|'.join([_glob_regex(x)
+                                              for x in pattern[pos + 1:end].split(',')]))
+            pos = end
+        else:
+            regex.append(re.escape(char))
+        pos += 1
+    return ''.join(regex)
+
+
+class MetricNamespace(object):
+    '''Tree of every metric path in a namespace snapshot, counting glob
+    matches the way graphite finds do.
+
+    '''
+    def __init__(self, paths):
+        self.root = {}
+        for path in paths:
+            node = self.root
+            for part in path.strip().split('.'):
+                if part:
+                    node = node.setdefault(part, {})
+
+    @classmethod
+    def from_file(cls, snapshot_path):
+        with open(snapshot_path) as snapshot:
+            return cls(x for x in snapshot if x.strip())
+
+    def count(self, glob):
+        nodes = [self.root]
+        for part in glob.split('.'):
+            if not target_ast.is_glob(part):
+                nodes = [x[part] for x in nodes if part in x]
+            else:
+                regex = re.compile(_glob_regex(part) + '$')
+                nodes = [child for x in nodes for name, child in x.items() if regex.match(name)]
+            if not nodes:
+                return 0
+        return len(nodes)
+
+
+class QueryCostEstimator(object):
+    '''Estimates dashboard costs, counting every glob once with
+    count_glob(glob). Template variable nodes are looked up as *, which
+    makes globs using them an upper bound.
+
+    '''
+    def __init__(self, count_glob):
+        self.count_glob = count_glob
+        self.glob_counts = {}
+
+    def _count(self, glob):
+        glob = '.'.join(['*' if x.startswith('$') else x for x in glob.split('.')])
+        if glob not in self.glob_counts:
+            self.glob_counts[glob] = self.count_glob(glob)
+        return self.glob_counts[glob]
+
+    def target_series(self, target):
+        '''Return (series returned, series fetched) of the target.
+
+        '''
+        try:
+            node = target_ast.parse(target)
+        except target_ast.TargetParseException:
+            return 1, 1
+        series = target_ast.estimate_series(node, self._count)
+        # Targets without paths, seriesByTag(...), read what they return.
+        return series, max(target_ast.estimate_fetched(node, self._count), series)
+
+    def dashboard_cost(self, slug, dashboard_obj):
+        '''Return the DASHBOARD_COST of the dashboard dict, its panels
+        sorted by decreasing cost.
+
+        '''
+        refreshes = refreshes_per_hour(dashboard_obj.get('refresh'))
+        hours = range_hours(dashboard_obj.get('time'))
+        panels = []
+        for row in dashboard_obj.get('rows') or []:
+            for panel in row.get('panels') or []:
+                counts = [self.target_series(x['target']) for x in panel.get('targets') or []
+                          if x.get('target') and not x.get('hide')]
+                fetched = sum([x[1] for x in counts])
+                if fetched:
+                    panels.append(PANEL_COST(slug, panel.get('title'), sum([x[0] for x in counts]),
+                                             fetched, fetched * refreshes * hours))
+        panels.sort(key=lambda x: -x.cost)
+        fetched = sum([x.fetched for x in panels])
+        return DASHBOARD_COST(slug, sum([x.series for x in panels]), fetched, refreshes, hours,
+                              fetched * refreshes * hours, panels)
+
+
+def get_estimator(snapshot_path=None):
+    '''Return a QueryCostEstimator counting globs in the namespace
+    snapshot at snapshot_path, or with graphite finds without one.
+
+    '''
+    if snapshot_path:
+        return QueryCostEstimator(MetricNamespace.from_file(snapshot_path).count)
+    validate_metrics.initialize()
+    return QueryCostEstimator(validate_metrics.count_series)
+
+
+def fleet_costs(dashboard_source, estimator):
+    '''Yield the DASHBOARD_COST of every dashboard of dashboard_source,
+    sql_connector or dashboard_mirror.
+
+    '''
+    for row in dashboard_source.get_dashboards():
+        dashboard = dashboard_source.DASHBOARD_RECORD(*row)
+        yield estimator.dashboard_cost(dashboard.slug, json_codec.loads(dashboard.data))
+
+
+def format_report(costs, top=20):
+    '''Return the report of the top dashboards and panels by cost.
+
+    '''
+    costs = sorted(costs, key=lambda x: -x.cost)
+    panels = sorted([x for dashboard in costs for x in dashboard.panels], key=lambda x: -x.cost)
+    lines = ['Total %.0f series hours per hour over %s dashboards.'
+             % (sum([x.cost for x in costs]), len(costs)), '',
+             '%12s %8s %8s %9s %7s  %s' % ('cost', 'fetched', 'series', 'refresh/h', 'range h',
+                                           'dashboard')]
+    lines += ['%12.0f %8d %8d %9.1f %7.1f  %s' % (x.cost, x.fetched, x.series,
+                                                  x.refreshes_per_hour, x.range_hours, x.slug)
+              for x in costs[:top]]
+    lines += ['', '%12s %8s %8s  %s' % ('cost', 'fetched', 'series', 'dashboard: panel')]
+    lines += ['%12.0f %8d %8d  %s: %s' % (x.cost, x.fetched, x.series, x.slug, x.title)
+              for x in panels[:top]]
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS,
+                                         description='Rank dashboards by graphite query cost.')
+    PARSER.add_argument('--snapshot', help=('File of metric paths, one per line, to count glob '
+                                            'fan-out with instead of graphite finds.'))
+    PARSER.add_argument('--top', type=int, default=20, help='Dashboards and panels to list.')
+    PARSER.add_argument('--use-mirror', action='store_true',
+                        help='Read dashboards from the local mirror.')
+    CONFIGS(PARSER.parse_args())
+    ESTIMATOR = get_estimator(CONFIGS.snapshot)
+    COSTS = list(fleet_costs(dashboard_mirror if CONFIGS.use_mirror else sql_connector,
+                             ESTIMATOR))
+    print(format_report(COSTS, CONFIGS.top))
+    print('\n%s unique globs counted.' % len(ESTIMATOR.glob_counts))
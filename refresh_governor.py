@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''Clamp the refresh and time range of expensive dashboards.
+
+A policy is a json file of rules. A rule applies to the dashboards
+matching all of its conditions, tag, datasource (used by any panel or
+target) and min_cost (query_cost estimate), a rule without conditions
+to every dashboard:
+
+    {"rules": [
+        {"tag": "wallboard", "min_refresh": "1m", "max_range": "1d"},
+        {"datasource": "Aggregate All Global", "min_refresh": "5m"},
+        {"min_cost": 100000, "min_refresh": "5m", "max_range": "2d"},
+        {"min_refresh": "30s", "max_range": "7d"}]}
+
+The strictest of the matching rules wins. Faster refreshes are raised
+to min_refresh, faster options are removed from the time picker
+(nav[].refresh_intervals) and time.from is capped to now-<max_range>.
+
+Run as a script to govern the whole fleet, changed dashboards are
+written in chunks with sql_connector.update_dashboards_data and the
+reduction of graphite render requests is reported.
+
+'''
+from lazy_import import lazy_module
+import json_codec
+import query_cost
+import triconf
+
+sql_connector = lazy_module('sql_connector')
+
+CONFIGS = None
+
+
+class RefreshGovernorException(Exception):
+    def __init__(self, msg=''):
+        super(RefreshGovernorException, self).__init__(msg)
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('refresh_governor', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+def _datasources(dashboard_obj):
+    datasources = set()
+    for row in dashboard_obj.get('rows') or []:
+        for panel in row.get('panels') or []:
+            datasources.add(panel.get('datasource'))
+            datasources.update([x.get('datasource') for x in panel.get('targets') or []])
+    datasources.discard(None)
+    return datasources
+
+
+def render_requests_per_hour(dashboard_obj):
+    '''Graphite render requests per hour of the dashboard, one per panel
+    with targets on every refresh.
+
+    '''
+    panels = len([x for row in dashboard_obj.get('rows') or [] for x in row.get('panels') or []
+                  if x.get('targets')])
+    return panels * query_cost.refreshes_per_hour(dashboard_obj.get('refresh'))
+
+
+class RefreshGovernor(object):
+    '''Applies a policy, see the module doc. estimator is the
+    query_cost.QueryCostEstimator min_cost rules are evaluated with, or
+    get_estimator() returns it when the first one is; building one may
+    need graphite.
+
+    '''
+    def __init__(self, policy, estimator=None, get_estimator=None):
+        self.rules = policy.get('rules') or []
+        for rule in self.rules:
+            for key in ('min_refresh', 'max_range'):
+                if key in rule and not query_cost.interval_seconds(rule[key]):
+                    raise RefreshGovernorException('Invalid %s "%s" in %s.'
+                                                   % (key, rule[key], rule))
+        if estimator is None and get_estimator is None \
+           and any('min_cost' in x for x in self.rules):
+            raise RefreshGovernorException('Rules with min_cost need a query cost estimator.')
+        self._estimator = estimator
+        self._get_estimator = get_estimator
+
+    @classmethod
+    def from_file(cls, policy_path, estimator=None, get_estimator=None):
+        with open(policy_path, 'rb') as policy_file:
+            return cls(json_codec.load(policy_file), estimator, get_estimator)
+
+    @property
+    def estimator(self):
+        if self._estimator is None:
+            self._estimator = self._get_estimator()
+        return self._estimator
+
+    def _matches(self, rule, dashboard_obj, dashboard_cost):
+        if 'tag' in rule and rule['tag'] not in (dashboard_obj.get('tags') or []):
+            return False
+        if 'datasource' in rule and rule['datasource'] not in _datasources(dashboard_obj):
+            return False
+        if 'min_cost' in rule and dashboard_cost() < rule['min_cost']:
+            return False
+        return True
+
+    def limits(self, slug, dashboard_obj):
+        '''Return the strictest (min_refresh, max_range) of the rules
+        matching the dashboard, either is None if no rule sets it.
+
+        '''
+        min_refresh = max_range = None
+        cost = []
+
+        def dashboard_cost():
+            # Once per dashboard, whatever the number of min_cost rules.
+            if not cost:
+                cost.append(self.estimator.dashboard_cost(slug, dashboard_obj).cost)
+            return cost[0]
+        for rule in self.rules:
+            if not self._matches(rule, dashboard_obj, dashboard_cost):
+                continue
+            if 'min_refresh' in rule and (
+                    min_refresh is None or query_cost.interval_seconds(rule['min_refresh'])
+                    > query_cost.interval_seconds(min_refresh)):
+                min_refresh = rule['min_refresh']
+            if 'max_range' in rule and (
+                    max_range is None or query_cost.interval_seconds(rule['max_range'])
+                    < query_cost.interval_seconds(max_range)):
+                max_range = rule['max_range']
+        return min_refresh, max_range
+
+    def apply(self, slug, dashboard_obj):
+        '''Apply the policy to the dashboard dict in place, returns the
+        list of changes made.
+
+        '''
+        changes = []
+        min_refresh, max_range = self.limits(slug, dashboard_obj)
+        if min_refresh:
+            min_seconds = query_cost.interval_seconds(min_refresh)
+            refresh = query_cost.interval_seconds(dashboard_obj.get('refresh'))
+            if refresh and refresh < min_seconds:
+                changes.append('refresh %s -> %s' % (dashboard_obj['refresh'], min_refresh))
+                dashboard_obj['refresh'] = min_refresh
+            for nav in dashboard_obj.get('nav') or []:
+                intervals = nav.get('refresh_intervals')
+                if not intervals:
+                    continue
+                kept = [x for x in intervals
+                        if (query_cost.interval_seconds(x) or min_seconds) >= min_seconds]
+                if min_refresh not in kept:
+                    kept.insert(0, min_refresh)
+                if kept != intervals:
+                    changes.append('refresh options %s -> %s' % (', '.join(intervals),
+                                                                  ', '.join(kept)))
+                    nav['refresh_intervals'] = kept
+        time_range = dashboard_obj.get('time') or {}
+        # Absolute ranges are left alone.
+        if max_range and str(time_range.get('from')).startswith('now-') \
+           and query_cost.range_hours(time_range) * 3600 > query_cost.interval_seconds(max_range):
+            changes.append('time from %s -> now-%s' % (time_range.get('from'), max_range))
+            time_range['from'] = 'now-%s' % max_range
+        return changes
+
+
+def govern_fleet(governor, dashboards, record_type, dry_run=False, chunk_size=100):
+    '''Apply the governor to every dashboard row. Changed dashboards are
+    written in chunks unless dry_run. Returns the list of
+    (slug, changes, render requests per hour before, after).
+
+    '''
+    report = []
+    updates = []
+    for row in dashboards:
+        dashboard = record_type(*row)
+        dashboard_obj = json_codec.loads(dashboard.data, ordered=True)
+        before = render_requests_per_hour(dashboard_obj)
+        changes = governor.apply(dashboard.slug, dashboard_obj)
+        if changes:
+            report.append((dashboard.slug, changes, before,
+                           render_requests_per_hour(dashboard_obj)))
+            updates.append((json_codec.dumps(dashboard_obj), dashboard.id))
+    if updates and not dry_run:
+        sql_connector.update_dashboards_data(updates, chunk_size=chunk_size)
+    return report
+
+
+def format_report(report):
+    lines = ['%s: %s' % (slug, '; '.join(changes)) for slug, changes, _, _ in report]
+    before = sum([x[2] for x in report])
+    after = sum([x[3] for x in report])
+    lines.append('%s dashboards changed, render requests per hour %.0f -> %.0f (-%.0f%%).'
+                 % (len(report), before, after, 100.0 * (before - after) / before if before
+                    else 0))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    CONFIGS = initialize()
+    PARSER = triconf.conf.ArgumentParser(CONFIGS,
+                                         description='Clamp dashboard refresh and time range.')
+    PARSER.add_argument('policy', help='Json policy file, see refresh_governor.')
+    PARSER.add_argument('--snapshot', help='Namespace snapshot for min_cost rules, see query_cost.')
+    PARSER.add_argument('--dry-run', action='store_true', help='Report without writing.')
+    PARSER.add_argument('--chunk-size', type=int, default=100,
+                        help='Dashboards written per transaction.')
+    CONFIGS(PARSER.parse_args())
+    GOVERNOR = RefreshGovernor.from_file(
+        CONFIGS.policy, get_estimator=lambda: query_cost.get_estimator(CONFIGS.snapshot))
+    print(format_report(govern_fleet(GOVERNOR, sql_connector.get_dashboards(),
+                                     sql_connector.DASHBOARD_RECORD, CONFIGS.dry_run,
+                                     CONFIGS.chunk_size)))
@@ -9,7 +9,7 @@ http://danishmujeeb.com/blog/2014/12/parsing-reverse-polish-notation-in-python
 '''
 from collections import namedtuple
 from copy import deepcopy
-import simplejson as json
+import json_codec
 import re
 
 GRAFANA_OPERATIONS = ['absolute',
@@ -262,7 +262,7 @@ def json_obj_to_grafana_target(json_object):
     grafana path string.
 
     '''
-    return json.dumps(json_object).replace('": [{"',
+    return json_codec.dumps(json_object).replace('": [{"',
                                            '(').replace(']}',
                                                         ')').replace('": ["',
                                                                      '(').replace('"',
@@ -5,15 +5,18 @@
 #TODO: should really be using an orm like sqlalchemy
 
 from collections import namedtuple
+import dashboard_handle
 import MySQLdb
 from getpass import getpass
 from random import randint
-import simplejson as json
+import json_codec
 import triconf
 
 CONFIGS = None
 DASHBOARD_RECORD = None
 DATASOURCE_RECORD = None
+UTF8_CHARSETS = ('utf8', 'utf8mb3', 'utf8mb4')  # MySQL names of utf-8.
+WRITE_PENDING = False  # Whether the connection has writes not committed yet.
 
 class SQLConnectionException(Exception):
     def __init__(self, msg=''):
@@ -33,13 +36,13 @@ def delete_dashboards():
         = "delete from dashboard where id in (select dashboard_id from dashboard_tag where term = 'quorra-conv')"
     delete_quorra_tags_sql \
         = "delete from dashboard_tag where term = 'quorra-conv'"
-    sql_cursor = _get_sql_cursor()
+    sql_cursor = _get_write_cursor()
     try:
         for sql_cmd in [delete_dashboards_sql, delete_quorra_tags_sql]:
             sql_cursor.execute(sql_cmd)
-        CONFIGS.sql_connection.commit()
+        _commit()
     except:
-        CONFIGS.sql_connection.rollback()
+        _rollback()
         raise
 
 def initialize(**kargs):
@@ -56,6 +59,8 @@ def initialize(**kargs):
                                              passwd=getpass(),
                                              db=CONFIGS.database)
     sql_cursor = CONFIGS.sql_connection.cursor()
+    json_codec.DATA_ENCODING = getattr(CONFIGS, 'data_encoding', None) \
+        or _get_data_encoding(sql_cursor)
     sql_cursor.execute('desc dashboard')
     DASHBOARD_RECORD = namedtuple('DashboardRecord',
                                          ' '.join([x[0] for x in sql_cursor.fetchall()]))
@@ -63,14 +68,58 @@ def initialize(**kargs):
     DATASOURCE_RECORD = namedtuple('DatasourceRecord',
                                    ' '.join([x[0] for x in sql_cursor.fetchall()]))
 
+def _get_data_encoding(sql_cursor):
+    '''Return the python codec of dashboard.data as read over the
+    connection, None if blobs may be in different encodings.
+
+    '''
+    sql_cursor.execute("select character_set_name from information_schema.columns "
+                       "where table_schema = database() and table_name = 'dashboard' "
+                       "and column_name = 'data'")
+    row = sql_cursor.fetchone()
+    # A utf8 column only holds valid utf-8 and the connection reads it as
+    # such. A latin1 one also takes the utf-8 of clients claiming
+    # latin1, its blobs are detected one by one.
+    if row and row[0] in UTF8_CHARSETS \
+            and CONFIGS.sql_connection.character_set_name() in UTF8_CHARSETS:
+        return 'utf-8'
+    return None
+
 def _get_sql_cursor():
-    '''Return a properly initialized sql cursor.
+    '''Return a properly initialized sql cursor, connecting on first use.
 
     '''
-    initialize()
+    if CONFIGS is None or getattr(CONFIGS, 'sql_connection', None) is None:
+        initialize()
+    else:
+        CONFIGS.sql_connection.ping(True)
+        if not WRITE_PENDING:
+            # Ends the read snapshot of earlier selects, as reconnecting
+            # used to. Not while a write is pending, a read in between
+            # would discard it.
+            CONFIGS.sql_connection.rollback()
     sql_cursor = CONFIGS.sql_connection.cursor()
     return sql_cursor
 
+def _get_write_cursor():
+    '''Return a cursor for writes, pending until _commit or _rollback.
+
+    '''
+    global WRITE_PENDING
+    sql_cursor = _get_sql_cursor()
+    WRITE_PENDING = True
+    return sql_cursor
+
+def _commit():
+    global WRITE_PENDING
+    CONFIGS.sql_connection.commit()
+    WRITE_PENDING = False
+
+def _rollback():
+    global WRITE_PENDING
+    CONFIGS.sql_connection.rollback()
+    WRITE_PENDING = False
+
 def get_dashboard(dashboard_slug):
     '''Find the dashboard with dashboard_slug in the database and return
     it.
@@ -86,16 +135,153 @@ def get_dashboard(dashboard_slug):
         ret = DASHBOARD_RECORD(*dashboards[0])
     return ret
 
-def get_dashboards():
-    '''Return all dashboards.
+def get_dashboards(required_terms=None):
+    '''Return all dashboards. With required_terms only the dashboards
+    whose data contains every term are returned, the filtering is done
+    by the server so other rows are never transferred.
 
     '''
     sql_cursor = _get_sql_cursor()
     dashboard_sql = ('SELECT * '
                      'FROM dashboard ')
-    sql_cursor.execute(dashboard_sql)
+    params = None
+    if required_terms:
+        # LOCATE follows the column collation, so it may match more
+        # loosely than the processors do but never excludes a match.
+        dashboard_sql += 'WHERE ' + ' AND '.join(['LOCATE(%s, data) > 0'] * len(required_terms))
+        params = tuple(required_terms)
+    sql_cursor.execute(dashboard_sql, params)
+    return sql_cursor.fetchall()
+
+def get_dashboard_handles(required_terms=None, batch_size=100):
+    '''Return a dashboard_handle.DashboardHandle of every dashboard,
+    only the ones whose data contains every term with required_terms.
+    The data lengths and target counts are computed by the server, data
+    is fetched batch_size dashboards at a time on access.
+
+    '''
+    sql_cursor = _get_sql_cursor()
+    dashboard_sql = ('SELECT id, slug, title, version, updated, LENGTH(data), '
+                     '(LENGTH(data) - LENGTH(REPLACE(data, \'"target"\', \'\'))) DIV 8 '
+                     'FROM dashboard ')
+    params = None
+    if required_terms:
+        dashboard_sql += 'WHERE ' + ' AND '.join(['LOCATE(%s, data) > 0'] * len(required_terms))
+        params = tuple(required_terms)
+    sql_cursor.execute(dashboard_sql + 'ORDER BY id', params)
+    return dashboard_handle.make_handles(sql_cursor.fetchall(), get_dashboards_data, batch_size)
+
+def get_dashboards_data(dashboard_ids):
+    '''Return (id, data) of the dashboards with the given ids.
+
+    '''
+    if not dashboard_ids:
+        return []
+    sql_cursor = _get_sql_cursor()
+    sql_cursor.execute('SELECT id, data FROM dashboard WHERE id IN (%s)'
+                       % ', '.join(['%s'] * len(dashboard_ids)), tuple(dashboard_ids))
+    return sql_cursor.fetchall()
+
+def get_dashboards_updated_since(updated=None):
+    '''Return all dashboards updated at or after updated, all dashboards
+    if updated is None.
+
+    '''
+    if updated is None:
+        return get_dashboards()
+    sql_cursor = _get_sql_cursor()
+    dashboard_sql = ('SELECT * '
+                     'FROM dashboard '
+                     'WHERE updated >= %s')
+    sql_cursor.execute(dashboard_sql, (updated,))
+    return sql_cursor.fetchall()
+
+def get_dashboard_versions(updated_since=None, dashboard_ids=None):
+    '''Return (id, slug, version, updated) of the dashboards updated at
+    or after updated_since, of all dashboards if it is None, only of
+    dashboard_ids if given. Only these columns are transferred.
+
+    '''
+    conditions = []
+    params = ()
+    if updated_since is not None:
+        conditions.append('updated >= %s')
+        params += (updated_since,)
+    if dashboard_ids is not None:
+        if not dashboard_ids:
+            return []
+        conditions.append('id IN (%s)' % ', '.join(['%s'] * len(dashboard_ids)))
+        params += tuple(dashboard_ids)
+    dashboard_sql = 'SELECT id, slug, version, updated FROM dashboard '
+    if conditions:
+        dashboard_sql += 'WHERE ' + ' AND '.join(conditions) + ' '
+    sql_cursor = _get_sql_cursor()
+    sql_cursor.execute(dashboard_sql + 'ORDER BY updated, id', params or None)
+    return sql_cursor.fetchall()
+
+def get_dashboard_ids():
+    '''Return the ids of all dashboards.
+
+    '''
+    sql_cursor = _get_sql_cursor()
+    sql_cursor.execute('SELECT id FROM dashboard')
+    return [x[0] for x in sql_cursor.fetchall()]
+
+def get_dashboards_by_id(dashboard_ids):
+    '''Return the dashboards with the given ids.
+
+    '''
+    if not dashboard_ids:
+        return []
+    sql_cursor = _get_sql_cursor()
+    sql_cursor.execute('SELECT * FROM dashboard WHERE id IN (%s)'
+                       % ', '.join(['%s'] * len(dashboard_ids)), tuple(dashboard_ids))
     return sql_cursor.fetchall()
 
+def _regex_escape(text):
+    '''Escape text for MySQL REGEXP.
+
+    '''
+    return ''.join(['\\' + x if x in '.^$*+?()[]{}|\\' else x for x in text])
+
+def get_datasource_references(datasource_name):
+    '''Return (id, slug, replaceable) of every dashboard whose data
+    refers to datasource_name. replaceable is true when all references
+    are written exactly as "datasource": "<datasource_name>", so a
+    REPLACE() of that text rewrites them all. Only ids and slugs are
+    transferred.
+
+    '''
+    quoted_name = json_codec.dumps(datasource_name)
+    reference = '"datasource": %s' % quoted_name
+    reference_regex = 'datasource"[[:space:]]*:[[:space:]]*' + _regex_escape(quoted_name)
+    sql_cursor = _get_sql_cursor()
+    sql_cursor.execute('SELECT id, slug, REPLACE(data, %s, \'\') NOT REGEXP BINARY %s '
+                       'FROM dashboard '
+                       'WHERE LOCATE(%s, data) > 0 AND data REGEXP BINARY %s',
+                       (reference, reference_regex, quoted_name, reference_regex))
+    return [(x[0], x[1], bool(x[2])) for x in sql_cursor.fetchall()]
+
+def replace_in_dashboards_data(dashboard_ids, old, new):
+    '''Replace the text old with new in the data of the dashboards with
+    dashboard_ids, on the server, in one transaction. Returns the number
+    of rows affected.
+
+    '''
+    if not dashboard_ids:
+        return 0
+    update_sql = ('UPDATE dashboard '
+                  'SET data=REPLACE(data, %%s, %%s), updated=NOW() '
+                  'WHERE id IN (%s)' % ', '.join(['%s'] * len(dashboard_ids)))
+    sql_cursor = _get_write_cursor()
+    try:
+        affected = sql_cursor.execute(update_sql, (old, new) + tuple(dashboard_ids))
+        _commit()
+    except:
+        _rollback()
+        raise
+    return affected
+
 def get_datasources():
     '''Gather all datasources.
 
@@ -110,68 +296,123 @@ def get_datasources():
             ret.append(DATASOURCE_RECORD(*datasource))
     return ret
 
+def _insert_dashboard(sql_cursor, title, original_title, json_string):
+    '''Insert the dashboard and its quorra-conv tag, without committing.
+
+    '''
+    # version and org_id are hard coded in grafana to be 2 and 1 respectively.
+    insert_dashboard_sql = ('INSERT INTO dashboard '
+                            '(version, slug, title, data, org_id, created, updated) '
+                            'VALUES (2, %s, %s, %s, 1, NOW(), NOW())')
+    dashboard_params = (original_title.replace(' ', '-'), title, json_string)
+    try:
+        affected = sql_cursor.execute(insert_dashboard_sql, dashboard_params)
+    except MySQLdb.IntegrityError:
+        try:
+            dashboard_params = (original_title.replace(' ', '-')+'-Dup-%s' % randint(0, 1000),
+                                title, json_string)
+            affected = sql_cursor.execute(insert_dashboard_sql, dashboard_params)
+        except MySQLdb.IntegrityError as exc:
+            raise SQLConnectionException('SQL Error: %s.' % exc)
+    if affected > 0:
+        new_id = CONFIGS.sql_connection.insert_id()
+    else:
+        raise SQLConnectionException('No row affected for given json.')
+    sql_cursor.execute('INSERT INTO dashboard_tag (dashboard_id, term) VALUES (%s, %s)',
+                       (new_id, 'quorra-conv'))
+
 def set_dashboard(dashboard_obj):
     '''Given dashboard dict object, insert the dashboard into the
     dashboard in the grafana database.
 
     '''
-    sql_cursor = _get_sql_cursor()
+    sql_cursor = _get_write_cursor()
 
     try:
         title = dashboard_obj['title']
         original_title = dashboard_obj['originalTitle']
-    except json.JSONDecodeError:
+    except json_codec.DecodeError:
         raise SQLConnectionException('Invalid json')
     except KeyError:
         raise SQLConnectionException('Json is not a conversion from a xaap file (missing title).')
-    json_string = json.dumps(dashboard_obj)
+    json_string = json_codec.dumps(dashboard_obj)
     try:
-        # version and org_id are hard coded in grafana to be 2 and 1 respectively.
-        insert_dashboard_sql = ('INSERT INTO dashboard '
-                                '(version, slug, title, data, org_id, created, updated) '
-                                'VALUES (2, %s, %s, %s, 1, NOW(), NOW())')
-        dashboard_params = (original_title.replace(' ', '-'), title, json_string)
-        try:
-            affected = sql_cursor.execute(insert_dashboard_sql, dashboard_params)
-        except MySQLdb.IntegrityError:
-            try:
-                dashboard_params = (original_title.replace(' ', '-')+'-Dup-%s' % randint(0, 1000),
-                                    title, json_string)
-                affected = sql_cursor.execute(insert_dashboard_sql, dashboard_params)
-            except MySQLdb.IntegrityError as exc:
-                raise SQLConnectionException('SQL Error: %s.' % exc)
-        if affected > 0:
-            new_id = CONFIGS.sql_connection.insert_id()
-        else:
-            raise SQLConnectionException('No row affected for given json.')
-        CONFIGS.sql_connection.commit()
-        sql_cursor.execute('INSERT INTO dashboard_tag (dashboard_id, term) VALUES (%s, %s)',
-                           (new_id, 'quorra-conv'))
-        CONFIGS.sql_connection.commit()
+        _insert_dashboard(sql_cursor, title, original_title, json_string)
+        _commit()
     except:
-        CONFIGS.sql_connection.rollback()
+        _rollback()
         raise
     return True
 
+def set_dashboards_json(dashboards, chunk_size=100):
+    '''Bulk insert already serialized dashboards, given as an iterable
+    of (title, original_title, json_string), committing every chunk_size
+    dashboards. Returns the number of dashboards inserted.
+
+    '''
+    sql_cursor = _get_write_cursor()
+    count = 0
+    try:
+        for title, original_title, json_string in dashboards:
+            _insert_dashboard(sql_cursor, title, original_title, json_string)
+            count += 1
+            if count % chunk_size == 0:
+                _commit()
+        _commit()
+    except:
+        _rollback()
+        raise
+    return count
+
 def update_dashboard_data(data_string, dashboard_id):
     '''Update dashboard data at dashboard_id with given
     data_string. Return data_string if successful.
 
     '''
     update_sql = ('UPDATE dashboard '
-                  'SET data=%s '
+                  'SET data=%s, updated=NOW() '
                   'WHERE id=%s')
-    sql_cursor = _get_sql_cursor()
+    sql_cursor = _get_write_cursor()
     affected = 0
     try:
         affected = sql_cursor.execute(update_sql,
-                                      (json.dumps(json.loads(data_string, encoding="latin-1")),
+                                      (json_codec.dumps(json_codec.loads(data_string, ordered=True)),
                                        dashboard_id))
     except MySQLdb.OperationalError:
+        _rollback()
         raise MySQLdb.OperationalError
     if affected == 0:
+        _rollback()
         raise SQLConnectionException('No row affected for dashboard %s' % dashboard_id)
     else:
-        CONFIGS.sql_connection.commit()
+        _commit()
     return data_string
 
+
+def update_dashboards_data(updates, chunk_size=100):
+    '''Update the data of many dashboards, updates is an iterable of
+    (data_string, dashboard_id). Every chunk_size updates are written
+    with one statement and committed. Returns the list of rows affected
+    per chunk.
+
+    '''
+    update_sql = ('UPDATE dashboard '
+                  'SET data=%s, updated=NOW() '
+                  'WHERE id=%s')
+    sql_cursor = _get_write_cursor()
+    affected = []
+    chunk = []
+    try:
+        for update in updates:
+            chunk.append(update)
+            if len(chunk) == chunk_size:
+                affected.append(sql_cursor.executemany(update_sql, chunk))
+                _commit()
+                chunk = []
+        if chunk:
+            affected.append(sql_cursor.executemany(update_sql, chunk))
+            _commit()
+    except:
+        _rollback()
+        raise
+    return affected
@@ -0,0 +1,245 @@
+'''Run a dashboard sweep over several nodes.
+
+The coordinator gathers the dashboards to process as a local iteration
+does, most expensive first, and cuts them into leases of lease_size
+dashboards. Workers on any number of nodes claim a lease, process its
+dashboards with their local process pool, heartbeat while doing so and
+report the results. A lease without a heartbeat for lease_timeout
+seconds goes back to the pending leases, to the next worker claiming
+one; whichever report of a lease comes first is kept. A worker whose
+heartbeat finds its lease handed to another worker, or the coordinator
+gone, stops the lease. The coordinator is done when every lease is.
+
+    python manip_grafana_db.py --iterator update_old_paths --coordinator 10.1.2.3:7300
+    python manip_grafana_db.py --worker 10.1.2.3:7300
+
+The lease table is served with multiprocessing.managers over tcp,
+authenticated with coordinator_authkey. The manager unpickles what
+authenticated peers send, anyone knowing the key runs code on the
+coordinator and the workers: bind to the address of a trusted network
+only and set a long random key, e.g. from openssl rand -hex 32. An
+empty or the shipped key is refused.
+
+'''
+import bisect
+from multiprocessing.managers import BaseManager
+import os
+import socket
+import threading
+from time import sleep, time
+
+DEFAULT_AUTHKEYS = (b'', b'change-me')  # Refused as coordinator_authkey.
+
+
+class SweepCoordinatorException(Exception):
+    def __init__(self, msg=''):
+        super(SweepCoordinatorException, self).__init__(msg)
+
+
+class LeaseLost(SweepCoordinatorException):
+    def __init__(self, msg=''):
+        super(LeaseLost, self).__init__(msg)
+
+
+class _CoordinatorServer(BaseManager):
+    pass
+
+
+class _CoordinatorClient(BaseManager):
+    pass
+
+
+_CoordinatorClient.register('lease_table')
+
+
+def _check_authkey(authkey):
+    if authkey.strip() in DEFAULT_AUTHKEYS:
+        raise SweepCoordinatorException('Set coordinator_authkey to a secret of your own, '
+                                        'anyone knowing it can run code on the sweep nodes.')
+
+
+def parse_address(address):
+    '''Return (host, port) of a host:port address.
+
+    '''
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise SweepCoordinatorException('Invalid address "%s", expected host:port.' % address)
+    return host or 'localhost', int(port)
+
+
+class LeaseTable(object):
+    '''The leases of a sweep. job is the dict of the processor settings
+    workers run with, slugs the dashboards to process in order and
+    aggregator the aggregations object worker aggregators are merged
+    into, if the processor has one. clock is for tests.
+
+    '''
+    def __init__(self, job, slugs, aggregator=None, lease_size=50, lease_timeout=120,
+                 clock=time):
+        self.job = job
+        self.leases = [slugs[x:x + lease_size] for x in range(0, len(slugs), lease_size)]
+        self.aggregator = aggregator
+        self.lease_timeout = lease_timeout
+        self.clock = clock
+        self.pending = list(range(len(self.leases)))
+        self.claimed = {}
+        self.done = set()
+        self.expired = 0
+        self.timed_out = []
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def get_job(self):
+        job = dict(self.job)
+        job['lease_timeout'] = self.lease_timeout
+        return job
+
+    def _expire(self):
+        now = self.clock()
+        for lease_id, (_, expires) in list(self.claimed.items()):
+            if expires < now:
+                del self.claimed[lease_id]
+                # Lease ids follow the dashboard order, most expensive first.
+                bisect.insort(self.pending, lease_id)
+                self.expired += 1
+
+    def claim(self, worker):
+        '''Return (lease id, slugs) of a lease for worker, (None, []) if
+        none is free now but some may expire, None once all are done.
+
+        '''
+        with self.lock:
+            self._expire()
+            if not self.pending:
+                return None if self.finished() else (None, [])
+            lease_id = self.pending.pop(0)
+            self.claimed[lease_id] = (worker, self.clock() + self.lease_timeout)
+            return lease_id, self.leases[lease_id]
+
+    def heartbeat(self, worker, lease_id):
+        '''Extend the lease of worker. Returns False if the lease isn't
+        worker's anymore.
+
+        '''
+        with self.lock:
+            if lease_id not in self.claimed or self.claimed[lease_id][0] != worker:
+                return False
+            self.claimed[lease_id] = (worker, self.clock() + self.lease_timeout)
+            return True
+
+    def complete(self, worker, lease_id, aggregator=None, timed_out=(), timings=None):
+        '''Record the results of lease_id. Returns False if the lease was
+        already reported, the results are then dropped.
+
+        '''
+        with self.lock:
+            if lease_id in self.done:
+                return False
+            self.claimed.pop(lease_id, None)
+            if lease_id in self.pending:
+                self.pending.remove(lease_id)
+            self.done.add(lease_id)
+            if self.aggregator is not None and aggregator is not None:
+                self.aggregator.merge(aggregator)
+            self.timed_out.extend(timed_out)
+            self.timings.update(timings or {})
+            return True
+
+    def finished(self):
+        return len(self.done) == len(self.leases)
+
+    def status(self):
+        '''Return (done, claimed, pending, expired) lease counts.
+
+        '''
+        with self.lock:
+            return len(self.done), len(self.claimed), len(self.pending), self.expired
+
+
+def serve(table, address, authkey):
+    '''Serve table at address, (host, port), in a daemon thread. Returns
+    the address served at, port 0 picks a free port.
+
+    '''
+    _check_authkey(authkey)
+    _CoordinatorServer.register('lease_table', callable=lambda: table)
+    server = _CoordinatorServer(address=address, authkey=authkey).get_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.address
+
+
+def wait(table, interval=1.0, report=None):
+    '''Wait for every lease of table to be done, calling report with
+    the status every interval seconds.
+
+    '''
+    while not table.finished():
+        sleep(interval)
+        if report:
+            report(table.status())
+    # Let workers waiting on expiring leases see the sweep is done.
+    sleep(2 * interval)
+
+
+def connect(address, authkey):
+    '''Return the lease table served at address.
+
+    '''
+    _check_authkey(authkey)
+    client = _CoordinatorClient(address=address, authkey=authkey)
+    client.connect()
+    return client.lease_table()
+
+
+def run_worker(address, authkey, process_lease, name=None, poll_interval=1.0):
+    '''Claim and process leases from the coordinator at address until
+    every lease is done. process_lease(job, slugs, heartbeat) processes
+    the dashboards of a lease, calling heartbeat() regularly, and
+    returns (aggregator, timed out slugs, timings). heartbeat raises
+    LeaseLost once the lease is another worker's or the coordinator is
+    gone, process_lease stops the lease then. Returns the number of
+    leases processed.
+
+    '''
+    table = connect(address, authkey)
+    name = name or '%s:%s' % (socket.gethostname(), os.getpid())
+    job = table.get_job()
+    heartbeat_interval = job['lease_timeout'] / 3.0
+    processed = 0
+    while True:
+        try:
+            lease = table.claim(name)
+        except (EOFError, IOError):
+            # The coordinator exits once every lease is done.
+            return processed
+        if lease is None:
+            return processed
+        lease_id, slugs = lease
+        if lease_id is None:
+            sleep(poll_interval)
+            continue
+        last_heartbeat = [time()]
+
+        def heartbeat():
+            if time() - last_heartbeat[0] < heartbeat_interval:
+                return
+            last_heartbeat[0] = time()
+            try:
+                kept = table.heartbeat(name, lease_id)
+            except (EOFError, IOError):
+                raise LeaseLost('The coordinator is gone.')
+            if not kept:
+                raise LeaseLost('Lease %s was handed to another worker.' % lease_id)
+        try:
+            result = process_lease(job, slugs, heartbeat)
+        except LeaseLost:
+            # The next claim finds out whether the coordinator is gone.
+            continue
+        try:
+            table.complete(name, lease_id, *result)
+        except (EOFError, IOError):
+            return processed
+        processed += 1
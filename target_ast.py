@@ -0,0 +1,280 @@
+'''Parse graphite targets into a tree and write them back.
+
+    >>> node = parse("alias(sumSeries(a.*.b), 'total')")
+    >>> node.args[0]
+    Call(name='sumSeries', args=(Path(path='a.*.b'),))
+    >>> serialize(node)
+    "alias(sumSeries(a.*.b), 'total')"
+
+Paths keep their globs and template variables as written, brace
+alternatives included (a.{b,c}.d is one Path). Strings keep their
+quote character, numbers and booleans are Literals holding the text,
+so serialize(parse(target)) only changes the spacing around commas.
+
+'''
+from collections import namedtuple
+import re
+
+Call = namedtuple('Call', 'name args')
+Path = namedtuple('Path', 'path')
+String = namedtuple('String', 'value quote')
+Literal = namedtuple('Literal', 'text')
+Keyword = namedtuple('Keyword', 'name value')
+
+GLOB_CHARACTERS = '*?[{'
+# Functions whose result is a single series whatever their input.
+AGGREGATE_FUNCTIONS = frozenset(['averageSeries', 'avg', 'countSeries', 'diffSeries',
+                                 'divideSeries', 'maxSeries', 'minSeries', 'multiplySeries',
+                                 'percentileOfSeries', 'rangeOfSeries', 'stddevSeries',
+                                 'sum', 'sumSeries', 'constantLine', 'randomWalk'])
+# Functions keeping at most n (their second argument) of their input series.
+LIMIT_FUNCTIONS = frozenset(['highestAverage', 'highestCurrent', 'highestMax', 'limit',
+                             'lowestAverage', 'lowestCurrent', 'mostDeviant'])
+# Functions transforming every input series on its own, keeping its name
+# or deriving the new name from it.
+PER_SERIES_FUNCTIONS = frozenset(['absolute', 'alias', 'aliasByMetric', 'aliasByNode',
+                                  'aliasSub', 'changed', 'color', 'consolidateBy', 'cumulative',
+                                  'dashed', 'delay', 'derivative', 'hitcount', 'integral',
+                                  'invert', 'isNonNull', 'keepLastValue', 'lineWidth', 'log',
+                                  'movingAverage', 'movingMedian', 'nonNegativeDerivative',
+                                  'offset', 'perSecond', 'removeAboveValue', 'removeBelowValue',
+                                  'scale', 'scaleToSeconds', 'secondYAxis', 'smartSummarize',
+                                  'summarize', 'timeShift', 'transformNull'])
+# Functions returning one series per distinct value of the given nodes.
+GROUP_FUNCTIONS = frozenset(['aggregateWithWildcards', 'averageSeriesWithWildcards',
+                             'groupByNode', 'groupByNodes', 'sumSeriesWithWildcards'])
+
+_TOKENS = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<punctuation>[(),=])
+  | (?P<word>(?:[^\s(),='"{}]|\{[^{}]*\})+)
+''', re.VERBOSE)
+_NUMBER = re.compile(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+_KEYWORDS = frozenset(['true', 'false', 'True', 'False', 'None', 'null'])
+
+
+class TargetParseException(Exception):
+    def __init__(self, msg=''):
+        super(TargetParseException, self).__init__(msg)
+
+
+def _tokenize(target):
+    tokens = []
+    pos = 0
+    while pos < len(target):
+        match = _TOKENS.match(target, pos)
+        if not match:
+            raise TargetParseException('Unexpected %r at %s in %s.' % (target[pos], pos, target))
+        if match.lastgroup != 'space':
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    tokens.append((None, None))
+    return tokens
+
+
+def _word_node(word):
+    if _NUMBER.match(word) or word in _KEYWORDS:
+        return Literal(word)
+    return Path(word)
+
+
+class _Parser(object):
+    def __init__(self, target):
+        self.target = target
+        self.tokens = _tokenize(target)
+        self.pos = 0
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expression(self):
+        kind, value = self._next()
+        if kind == 'string':
+            return String(value[1:-1], value[0])
+        if kind != 'word':
+            raise TargetParseException('Unexpected %r in %s.' % (value, self.target))
+        if self.tokens[self.pos][1] == '(':
+            self.pos += 1
+            return Call(value, self.arguments())
+        return _word_node(value)
+
+    def argument(self):
+        if self.tokens[self.pos][0] == 'word' and self.tokens[self.pos + 1][1] == '=':
+            name = self._next()[1]
+            self.pos += 1
+            return Keyword(name, self.expression())
+        return self.expression()
+
+    def arguments(self):
+        args = []
+        if self.tokens[self.pos][1] == ')':
+            self.pos += 1
+            return tuple(args)
+        while True:
+            args.append(self.argument())
+            kind, value = self._next()
+            if value == ')':
+                return tuple(args)
+            if value != ',':
+                raise TargetParseException('Expected "," or ")", got %r in %s.'
+                                           % (value, self.target))
+
+    def parse(self):
+        node = self.expression()
+        if self.tokens[self.pos][0] is not None:
+            raise TargetParseException('Trailing %r in %s.' % (self.tokens[self.pos][1],
+                                                                self.target))
+        return node
+
+
+def parse(target):
+    '''Return the tree of the graphite target string. Raises
+    TargetParseException if it isn't a valid target.
+
+    '''
+    return _Parser(target).parse()
+
+
+def serialize(node):
+    '''Return the graphite target string of the tree node.
+
+    '''
+    if isinstance(node, Call):
+        return '%s(%s)' % (node.name, ', '.join([serialize(x) for x in node.args]))
+    if isinstance(node, Path):
+        return node.path
+    if isinstance(node, String):
+        return '%s%s%s' % (node.quote, node.value, node.quote)
+    if isinstance(node, Keyword):
+        return '%s=%s' % (node.name, serialize(node.value))
+    return node.text
+
+
+def iter_paths(node):
+    '''Yield every Path in the tree, left to right.
+
+    '''
+    if isinstance(node, Path):
+        yield node
+    elif isinstance(node, Call):
+        for arg in node.args:
+            for path in iter_paths(arg):
+                yield path
+    elif isinstance(node, Keyword):
+        for path in iter_paths(node.value):
+            yield path
+
+
+def replace_paths(node, fun):
+    '''Return a copy of the tree with every Path replaced by
+    fun(Path).
+
+    '''
+    if isinstance(node, Path):
+        return fun(node)
+    if isinstance(node, Call):
+        return Call(node.name, tuple([replace_paths(x, fun) for x in node.args]))
+    if isinstance(node, Keyword):
+        return Keyword(node.name, replace_paths(node.value, fun))
+    return node
+
+
+def iter_path_calls(node, calls=()):
+    '''Yield (Path, names of the calls enclosing it, outermost first)
+    for every Path in the tree, left to right.
+
+    '''
+    if isinstance(node, Path):
+        yield node, calls
+    elif isinstance(node, Call):
+        for arg in node.args:
+            for path_calls in iter_path_calls(arg, calls + (node.name,)):
+                yield path_calls
+    elif isinstance(node, Keyword):
+        for path_calls in iter_path_calls(node.value, calls):
+            yield path_calls
+
+
+def is_glob(path):
+    return any(x in path for x in GLOB_CHARACTERS)
+
+
+def _int_literal(node):
+    if isinstance(node, Literal) and _NUMBER.match(node.text):
+        return int(float(node.text))
+    return None
+
+
+def estimate_series(node, count_glob=None):
+    '''Estimate the number of series the tree node returns. Globs count
+    as count_glob(path) series if it is given and knows the path (doesn't
+    return None), as one series otherwise. Template variables are taken
+    to select one value.
+
+    '''
+    if isinstance(node, Path):
+        if is_glob(node.path) and count_glob is not None:
+            count = count_glob(node.path)
+            if count is not None:
+                return count
+        return 1
+    if isinstance(node, Keyword):
+        return estimate_series(node.value, count_glob)
+    if not isinstance(node, Call):
+        return 0
+    series = sum([estimate_series(x, count_glob) for x in node.args
+                  if isinstance(x, (Path, Call))])
+    if node.name in AGGREGATE_FUNCTIONS or not series:
+        # Calls without series arguments (seriesByTag, ...) are unknown.
+        return 1
+    if node.name in LIMIT_FUNCTIONS and len(node.args) > 1:
+        limit = _int_literal(node.args[1])
+        if limit is not None:
+            return min(series, limit)
+    if node.name in GROUP_FUNCTIONS and node.args and isinstance(node.args[0], Path):
+        nodes = [_int_literal(x) for x in node.args[1:]]
+        nodes = [x for x in nodes if x is not None]
+        if node.name.endswith('WithWildcards'):
+            # These name the nodes to drop rather than to keep.
+            kept = [x for x in range(len(node.args[0].path.split('.'))) if x not in nodes]
+        else:
+            kept = nodes[:1] if node.name == 'groupByNode' else nodes
+        if kept:
+            return _estimate_groups(node.args[0].path, kept, count_glob, series)
+    return series
+
+
+def _estimate_groups(path, kept_nodes, count_glob, series):
+    '''Number of distinct values of kept_nodes among the series of glob
+    path, at most the fan-out of path cut after the last kept node, and
+    at most series.
+
+    '''
+    parts = path.split('.')
+    last = max(kept_nodes)
+    if last >= len(parts):
+        return series
+    if not any(is_glob(parts[x]) for x in kept_nodes):
+        return 1
+    count = None
+    if count_glob is not None:
+        count = count_glob('.'.join(parts[:last + 1]))
+    if count is None:
+        return series
+    return min(count, series)
+
+
+def estimate_fetched(node, count_glob=None):
+    '''Estimate the number of series graphite reads for the tree node,
+    the fan-out of its globs whatever the functions around them return,
+    counted as in estimate_series.
+
+    '''
+    fetched = 0
+    for path in iter_paths(node):
+        count = count_glob(path.path) if is_glob(path.path) and count_glob is not None else None
+        fetched += 1 if count is None else count
+    return fetched
@@ -0,0 +1,90 @@
+'''Fold sibling targets of a panel into brace globs.
+
+Panels often hold one target per host or colo, differing in a single
+path node:
+
+    scale(a.ca.requests.count, 60)
+    scale(a.lc.requests.count, 60)
+
+Graphite renders every target separately; folded into
+
+    scale(a.{ca,lc}.requests.count, 60)
+
+the panel shows the same series, each still named after its own path,
+from one render expression. Only nodes of plain names are folded, and
+only through functions in target_ast.PER_SERIES_FUNCTIONS, so results
+of functions combining series (sumSeries, highestMax, ...) are never
+merged. Targets differing in anything else, e.g. alias text, hide or
+datasource, are left alone, as are panels whose targets refer to each
+other (#A).
+
+'''
+from collections import OrderedDict
+import re
+import target_ast
+
+PLACEHOLDER = '\0'
+_PLAIN_NODE = re.compile(r'^[^*?\[\]{}$,\0]+$')
+
+
+def _sibling_keys(target):
+    '''Yield (key, node value) for every path node of target that can be
+    folded. Targets sharing a key only differ in the value of that node.
+
+    '''
+    try:
+        tree = target_ast.parse(target)
+    except target_ast.TargetParseException:
+        return
+    path_calls = list(target_ast.iter_path_calls(tree))
+    for path_number, (path, calls) in enumerate(path_calls):
+        if '{' in path.path or not all(x in target_ast.PER_SERIES_FUNCTIONS for x in calls):
+            continue
+        parts = path.path.split('.')
+        for node_number, part in enumerate(parts):
+            if not _PLAIN_NODE.match(part):
+                continue
+            blanked = '.'.join(parts[:node_number] + [PLACEHOLDER] + parts[node_number + 1:])
+            counter = [-1]
+
+            def blank(other):
+                counter[0] += 1
+                return target_ast.Path(blanked) if counter[0] == path_number else other
+            yield target_ast.serialize(target_ast.replace_paths(tree, blank)), part
+
+
+def consolidate(targets):
+    '''Return the grafana targets (dicts with 'target') with sibling
+    targets folded, and the number of targets removed. The folded target
+    takes the place and refId of the first of its siblings.
+
+    '''
+    if any('#' in (x.get('target') or '') for x in targets):
+        return targets, 0
+    groups = OrderedDict()
+    for index, target in enumerate(targets):
+        if not target.get('target'):
+            continue
+        other_fields = tuple(sorted([(k, repr(v)) for k, v in target.items()
+                                     if k not in ('target', 'refId')]))
+        for key, value in _sibling_keys(target['target']):
+            groups.setdefault((other_fields, key), []).append((index, value))
+    folded = {}
+    removed = set()
+    for (_, key), members in sorted(groups.items(), key=lambda x: -len(x[1])):
+        members = [x for x in members if x[0] not in removed and x[0] not in folded]
+        values = list(OrderedDict([(value, None) for _, value in members]))
+        if len(values) < 2:
+            continue
+        first = members[0][0]
+        folded[first] = key.replace(PLACEHOLDER, '{%s}' % ','.join(values))
+        removed.update([x[0] for x in members[1:]])
+    new_targets = []
+    for index, target in enumerate(targets):
+        if index in removed:
+            continue
+        if index in folded:
+            target = target.copy()
+            target['target'] = folded[index]
+        new_targets.append(target)
+    return new_targets, len(removed)
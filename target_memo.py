@@ -0,0 +1,225 @@
+'''Memoize the analysis of targets across dashboards and processes.
+
+Thousands of dashboards are clones, the -Dup- slugs set_dashboard
+creates, so the same targets recur across the fleet and processors
+repeat the same parsing, classification and graphite lookups for every
+copy. A Memo maps a key, the target string and whatever else the
+analysis depends on, to the result of the analysis. Keys are content
+addressed, by the sha1 of their json, so any json value (a panel too)
+can be a key. Results are shared, callers must not modify them.
+
+Persistent memos also append their results to target_memo_file, one
+json line each, and load the results of other processes on first use;
+the children of an iteration, one per dashboard, reuse each other's
+results that way. Results older than target_memo_ttl seconds are
+ignored, compact() drops them and the duplicates from the file. Appends
+hold a shared flock of target_memo_file + .lock and compact() an
+exclusive one, so processes may append while another compacts.
+
+    memo = get_memo('update_old_paths', persistent=True)
+    result = memo.get([target, program_id], lambda: analyze(target, program_id))
+
+'''
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json_codec
+import os
+import tempfile
+import threading
+from time import time
+import triconf
+
+CONFIGS = None
+MEMOS = {}  # Memos of this process by name, see get_memo.
+_MEMOS_LOCK = threading.Lock()
+
+
+def initialize(**kargs):
+    '''Module level CONFIGS initializer. Returns configurations object.
+
+    '''
+    global CONFIGS
+    CONFIGS = triconf.conf.initialize('target_memo', conf_file_names=['conf.ini'], **kargs)
+    return CONFIGS
+
+
+def digest(key):
+    return hashlib.sha1(json_codec.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _read_entries(memo_file, ttl=None, now=None):
+    '''Yield the entries of memo_file younger than ttl seconds, skipping
+    lines broken by a process killed while writing.
+
+    '''
+    for line in memo_file:
+        try:
+            entry = json_codec.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(entry, dict) or 'key' not in entry:
+            continue
+        if ttl and now - entry.get('time', 0) > ttl:
+            continue
+        yield entry
+
+
+@contextmanager
+def _locked(path, operation):
+    '''Hold the flock operation, fcntl.LOCK_SH or LOCK_EX, of the lock
+    file of the memo file path. The lock file stays, path is replaced by
+    compact().
+
+    '''
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), operation)
+        yield
+
+
+class Memo(object):
+    '''Results of compute by key, appended to path if given. Results
+    keep(result) is False for are returned but not memoized, e.g.
+    failures worth retrying. Results of another version are ignored.
+
+    '''
+    def __init__(self, name, path=None, ttl=None, version=1, keep=None, clock=time):
+        self.name = name
+        self.path = path
+        self.ttl = ttl
+        self.version = version
+        self.keep = keep
+        self.clock = clock
+        self.values = {}
+        self.counts = {'hits': 0, 'misses': 0, 'loaded': 0}
+        self.loaded = path is None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.loaded = True
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as memo_file:
+            for entry in _read_entries(memo_file, self.ttl, self.clock()):
+                if entry.get('memo') == self.name and entry.get('version') == self.version:
+                    self.values[entry['key']] = entry['value']
+        self.counts['loaded'] = len(self.values)
+
+    def _append(self, key_digest, value):
+        line = json_codec.dumps({'memo': self.name, 'version': self.version, 'key': key_digest,
+                                 'time': round(self.clock(), 3), 'value': value}) + '\n'
+        # One write of an O_APPEND file, lines of concurrent children
+        # don't interleave.
+        with _locked(self.path, fcntl.LOCK_SH):
+            memo_fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(memo_fd, line.encode('utf-8'))
+            finally:
+                os.close(memo_fd)
+
+    def get(self, key, compute):
+        '''Return the result for key, calling compute() if there is none.
+        Exceptions of compute are raised, nothing is memoized.
+
+        '''
+        key_digest = digest(key)
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if key_digest in self.values:
+                self.counts['hits'] += 1
+                return self.values[key_digest]
+            self.counts['misses'] += 1
+        value = compute()
+        if self.keep is None or self.keep(value):
+            with self.lock:
+                self.values[key_digest] = value
+                if self.path:
+                    self._append(key_digest, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def get_memo(name, persistent=False, version=1, keep=None):
+    '''Return the memo name of this process, creating it. Persistent
+    memos use target_memo_file, unless it is empty.
+
+    '''
+    with _MEMOS_LOCK:
+        if name not in MEMOS:
+            path = getattr(CONFIGS, 'target_memo_file', None) if persistent else None
+            ttl = getattr(CONFIGS, 'target_memo_ttl', None)
+            MEMOS[name] = Memo(name, path or None, float(ttl) if ttl else None, version, keep)
+        return MEMOS[name]
+
+
+def reset():
+    '''Drop the memos of this process. Results in memory never expire, a
+    long-running process resets every target_memo_ttl seconds; persistent
+    memos load target_memo_file again on next use.
+
+    '''
+    with _MEMOS_LOCK:
+        MEMOS.clear()
+
+
+def stats():
+    '''Return {memo name: counts} of the memos of this process used.
+
+    '''
+    with _MEMOS_LOCK:
+        memos = list(MEMOS.values())
+    counts = [(x.name, x.stats()) for x in memos]
+    return dict([(name, x) for name, x in counts if x['hits'] or x['misses']])
+
+
+def combine_stats(total, other):
+    '''Add the counts of the stats other to total, returns total.
+
+    '''
+    for name, counts in other.items():
+        memo_total = total.setdefault(name, {})
+        for count, value in counts.items():
+            memo_total[count] = memo_total.get(count, 0) + value
+    return total
+
+
+def format_stats(memo_stats):
+    return ', '.join(['%s: %s hits, %s misses (%.0f%% hit rate), %s loaded'
+                      % (name, x['hits'], x['misses'],
+                         100.0 * x['hits'] / max(x['hits'] + x['misses'], 1), x['loaded'])
+                      for name, x in sorted(memo_stats.items())])
+
+
+def compact(path=None, ttl=None, clock=time):
+    '''Rewrite the memo file path, target_memo_file by default, without
+    expired and duplicate results. Appends wait for it to finish.
+    Returns (results kept, lines dropped).
+
+    '''
+    path = path or getattr(CONFIGS, 'target_memo_file', None)
+    if ttl is None:
+        ttl = float(getattr(CONFIGS, 'target_memo_ttl', 0) or 0) or None
+    if not path or not os.path.isfile(path):
+        return 0, 0
+    with _locked(path, fcntl.LOCK_EX):
+        with open(path) as memo_file:
+            lines = sum(1 for _ in memo_file)
+            memo_file.seek(0)
+            latest = {}
+            for entry in _read_entries(memo_file, ttl, clock()):
+                latest[(entry.get('memo'), entry.get('version'), entry['key'])] = entry
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                              dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(temp_fd, 'w') as memo_file:
+                memo_file.write(''.join([json_codec.dumps(x) + '\n' for x in latest.values()]))
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+    return len(latest), lines - len(latest)
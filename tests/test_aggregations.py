@@ -0,0 +1,63 @@
+import aggregations
+from nose import tools
+
+
+def test_count():
+    count = aggregations.Count()
+    for partial in [1, 2, 0]:
+        count.combine(partial)
+    tools.assert_equal(count.result(), 3)
+
+
+def test_count_by():
+    count_by = aggregations.CountBy()
+    count_by.combine({'a': 1, 'b': 1})
+    count_by.combine({'a': 2})
+    tools.assert_equal(count_by.result(), [('a', 3), ('b', 1)])
+    tools.assert_equal(count_by.error, 0)
+
+
+def test_count_by_bounded():
+    count_by = aggregations.CountBy(capacity=5)
+    for number in range(200):
+        count_by.combine({'heavy': 10, 'x%s' % number: 1})
+    tools.assert_true(len(count_by.counts) <= 10)
+    key, count = count_by.result()[0]
+    tools.assert_equal(key, 'heavy')
+    # Counts are upper bounds within error of the true count.
+    tools.assert_true(2000 <= count <= 2000 + count_by.error)
+    tools.assert_true(0 < count_by.error < 100)
+
+
+def test_top_k():
+    top_k = aggregations.TopK(2)
+    top_k.combine({'a.b': 3, 'c.d': 1, 'e.f': 2})
+    tools.assert_equal(top_k.result(), [('a.b', 3), ('e.f', 2)])
+
+
+def test_distinct():
+    distinct = aggregations.Distinct()
+    distinct.combine(['a', ['b', 1]])
+    distinct.combine(['a', ['b', 1], 'c'])
+    tools.assert_equal(distinct.result(), 3)
+    estimated = aggregations.Distinct(capacity=256)
+    for number in range(0, 20000, 100):
+        estimated.combine(['%s' % x for x in range(number, number + 150)])
+    tools.assert_true(len(estimated.hashes) <= 256)
+    tools.assert_true(16000 < estimated.result() < 24000)
+
+
+def test_merge():
+    left = aggregations.TopK(2)
+    right = aggregations.TopK(2)
+    left.combine({'a': 3, 'b': 1})
+    right.combine({'b': 3, 'c': 1})
+    left.merge(right)
+    tools.assert_equal(left.result(), [('b', 4), ('a', 3)])
+    exact = aggregations.Distinct(capacity=100)
+    exact.combine(['a', 'b'])
+    estimated = aggregations.Distinct(capacity=100)
+    estimated.combine(['%s' % x for x in range(5000)])
+    exact.merge(estimated)
+    tools.assert_true(len(exact.hashes) <= 100)
+    tools.assert_true(3500 < exact.result() < 7000)
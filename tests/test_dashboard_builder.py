@@ -0,0 +1,51 @@
+import dashboard_builder
+import json_codec
+import layouts
+from nose import tools
+
+
+def test_rows_spec():
+    builder = dashboard_builder.DashboardBuilder(datasource='Datasource1', panels_per_row=2)
+    dashboard = json_codec.loads(builder.to_json({
+        'title': 'Broker',
+        'template_variables': {'colo': ['ca', 'lc']},
+        'rows': [{'title': 'row 0',
+                  'panels': [{'title': 'graph', 'fill': 0,
+                              'targets': ['a.b', {'target': 'c.d', 'hide': True}]},
+                             {'title': 'other', 'datasource': 'Datasource2', 'targets': []}]},
+                 {'title': 'row 1', 'panels': [{'title': 'last', 'targets': ['e.f']}]}]}),
+        ordered=True)
+    tools.assert_equal(dashboard['title'], 'Broker')
+    panels = [x for row in dashboard['rows'] for x in row['panels']]
+    tools.assert_equal(list(panels[0]), list(layouts.panel_layout()))
+    tools.assert_equal([(x['id'], x['datasource'], x['span']) for x in panels],
+                       [(1, 'Datasource1', 6), (2, 'Datasource2', 6), (3, 'Datasource1', 6)])
+    tools.assert_equal(panels[0]['fill'], 0)
+    tools.assert_equal([(x['refId'], x['target'], x['hide']) for x in panels[0]['targets']],
+                       [('A', 'a.b', False), ('B', 'c.d', True)])
+    variable = dashboard['templating']['list'][0]
+    tools.assert_equal((variable['name'], variable['query'], variable['current']['value']),
+                       ('colo', 'ca,lc', 'ca'))
+
+
+def test_metrics_spec_and_hooks():
+    def drop_first_panel(rows):
+        return [(title, panels[1:]) for title, panels in rows]
+
+    builder = dashboard_builder.DashboardBuilder(panels_per_row=2, hooks=[drop_first_panel])
+    dashboard = json_codec.loads(builder.to_json({
+        'title': 'Hosts', 'group_by_node': 1,
+        'metrics': ['a.h1.cpu', 'a.h2.cpu', 'a.h1.mem', 'a.h3.cpu', 'a.h4.cpu']}))
+    tools.assert_equal([[x['title'] for x in row['panels']] for row in dashboard['rows']],
+                       [['h2'], ['h4']])
+    tools.assert_equal(dashboard['rows'][0]['panels'][0]['id'], 1)
+
+
+@tools.raises(dashboard_builder.DashboardBuilderException)
+def test_empty_spec():
+    dashboard_builder.DashboardBuilder(panels_per_row=2).to_json({'title': 'Empty'})
+
+
+def test_ref_ids():
+    ref_ids = list(dashboard_builder.ref_ids())
+    tools.assert_equal(ref_ids[:2] + ref_ids[25:28], ['A', 'B', 'Z', 'AA', 'AB'])
@@ -0,0 +1,49 @@
+import dashboard_handle
+import mock
+from nose import tools
+import sys
+
+DATA = dict([(x, '{"id": %s, "padding": "%s"}' % (x, 'x' * 10000)) for x in range(10)])
+
+
+def _handles(batch_size=4):
+    fetch = mock.Mock(side_effect=lambda ids: [(x, DATA[x]) for x in ids if x in DATA])
+    rows = [(x, 'dash-%s' % x, 'Dash %s' % x, 1, None, len(DATA[x]), 0) for x in range(10)]
+    return dashboard_handle.make_handles(rows, fetch, batch_size), fetch
+
+
+def test_lazy_batches():
+    handles, fetch = _handles()
+    tools.assert_equal(fetch.call_count, 0)
+    tools.assert_equal(handles[0].data, DATA[0])
+    tools.assert_equal(handles[3].data, DATA[3])
+    tools.assert_equal(fetch.call_args_list, [mock.call([0, 1, 2, 3])])
+    tools.assert_equal(handles[5].data, DATA[5])
+    tools.assert_equal(fetch.call_args_list[-1], mock.call([5, 6, 7, 8]))
+    # Only the last batch is held.
+    tools.assert_equal([x._data is not None for x in handles],
+                       [False] * 5 + [True] * 4 + [False])
+    tools.assert_equal(handles[0].data, DATA[0])
+    tools.assert_equal(fetch.call_count, 3)
+
+
+def test_load_order():
+    handles, fetch = _handles(batch_size=3)
+    handles[0]._loader.track(list(reversed(handles)))
+    tools.assert_equal(handles[9].data, DATA[9])
+    tools.assert_equal(fetch.call_args_list, [mock.call([9, 8, 7])])
+
+
+def test_compact():
+    handle = dashboard_handle.DashboardHandle(1, 'slug', 'title', 1, None, 10)
+    tools.assert_false(hasattr(handle, '__dict__'))
+    tools.assert_true(sys.getsizeof(handle) < 200)
+
+
+def test_gone():
+    handles, fetch = _handles()
+    data = DATA.pop(2)
+    try:
+        tools.assert_raises(KeyError, getattr, handles[2], 'data')
+    finally:
+        DATA[2] = data
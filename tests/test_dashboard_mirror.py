@@ -0,0 +1,61 @@
+from collections import namedtuple
+from datetime import datetime
+import os
+import tempfile
+import dashboard_mirror
+from nose import tools
+import mock
+
+RECORD = namedtuple('DashboardRecord', 'id version slug title data org_id created updated')
+
+
+def _row(dashboard_id, slug, updated, data='{"rows": []}'):
+    return tuple(RECORD(dashboard_id, 2, slug, slug, data, 1, updated, updated))
+
+
+def _setup():
+    dashboard_mirror.CONFIGS = mock.Mock(mirror_path=tempfile.mktemp(suffix='.sqlite'))
+    dashboard_mirror.MIRROR_CONNECTION = None
+    dashboard_mirror.DASHBOARD_RECORD = None
+
+
+def _teardown():
+    dashboard_mirror.MIRROR_CONNECTION.close()
+    dashboard_mirror.MIRROR_CONNECTION = None
+    os.remove(dashboard_mirror.CONFIGS.mirror_path)
+
+
+@tools.with_setup(_setup, _teardown)
+def test_incremental_sync():
+    sql = mock.Mock(DASHBOARD_RECORD=RECORD)
+    dashboard_mirror.sql_connector = sql
+    sql.get_dashboards_updated_since.return_value = [_row(1, 'a', datetime(2016, 1, 1)),
+                                                     _row(2, 'b', datetime(2016, 1, 2))]
+    sql.get_dashboard_ids.return_value = [1, 2]
+    tools.assert_equal(dashboard_mirror.sync(), (2, 0))
+    sql.get_dashboards_updated_since.assert_called_with(None)
+
+    sql.get_dashboards_updated_since.return_value = [_row(1, 'a', datetime(2016, 1, 3), '{}')]
+    sql.get_dashboard_ids.return_value = [1]
+    tools.assert_equal(dashboard_mirror.sync(), (1, 1))
+    sql.get_dashboards_updated_since.assert_called_with('2016-01-02 00:00:00')
+
+    tools.assert_equal(dashboard_mirror.get_dashboard('a').data, '{}')
+    tools.assert_equal(dashboard_mirror.get_dashboard('b'), [])
+    tools.assert_equal([RECORD(*x).slug for x in dashboard_mirror.get_dashboards()], ['a'])
+
+
+@tools.with_setup(_setup, _teardown)
+def test_dashboard_handles():
+    sql = mock.Mock(DASHBOARD_RECORD=RECORD)
+    dashboard_mirror.sql_connector = sql
+    data = '{"rows": [{"panels": [{"targets": [{"target": "a.b"}, {"target": "a.c"}]}]}]}'
+    sql.get_dashboards_updated_since.return_value = [_row(1, 'a', datetime(2016, 1, 1), data),
+                                                     _row(2, 'b', datetime(2016, 1, 2))]
+    sql.get_dashboard_ids.return_value = [1, 2]
+    dashboard_mirror.sync()
+    handles = dashboard_mirror.get_dashboard_handles()
+    tools.assert_equal([(x.slug, x.data_length, x.target_count) for x in handles],
+                       [('a', len(data), 2), ('b', 12, 0)])
+    tools.assert_equal([x.slug for x in dashboard_mirror.get_dashboard_handles(['a.c'])], ['a'])
+    tools.assert_equal(handles[0].data, data)
@@ -0,0 +1,29 @@
+from collections import namedtuple
+import dashboard_pipeline
+import mock
+from nose import tools
+
+RECORD = namedtuple('DashboardRecord', 'id slug data')
+DASHBOARDS = {
+    1: RECORD(1, 'hosts', '{"rows": [{"panels": [{"title": "t", "targets": ['
+                          '{"refId": "A", "target": "a.ca.b"}, {"refId": "B", "target": "a.lc.b"}]}]}]}'),
+    2: RECORD(2, 'plain', '{"rows": [{"panels": [{"targets": [{"refId": "A", "target": "a.b"}]}]}]}'),
+    3: RECORD(3, 'broken', '{"rows": ')}
+
+
+def test_run():
+    sql_connector = mock.Mock(DASHBOARD_RECORD=RECORD)
+    sql_connector.get_dashboard_ids.return_value = [1, 2, 3]
+    sql_connector.get_dashboards_by_id.side_effect = lambda ids: [tuple(DASHBOARDS[x])
+                                                                  for x in ids]
+    sql_connector.update_dashboards_data.side_effect = lambda updates, chunk_size: [len(updates)]
+    with mock.patch.object(dashboard_pipeline, 'sql_connector', sql_connector), \
+         mock.patch.object(dashboard_pipeline, 'LOGGER') as logger:
+        changed = dashboard_pipeline.run('consolidate_targets', report_interval=0.1)
+    tools.assert_equal(changed, 1)
+    updates = sql_connector.update_dashboards_data.call_args[0][0]
+    tools.assert_equal([x[1] for x in updates], [1])
+    tools.assert_true('a.{ca,lc}.b' in updates[0][0])
+    tools.assert_equal(logger.error.call_args[0][1], 'decode')
+    tools.assert_raises(dashboard_pipeline.dashboard_processors.ProcessorException,
+                        dashboard_pipeline.run, 'update_old_paths')
@@ -0,0 +1,165 @@
+import dashboard_processors
+import json_codec
+import mock
+from nose import tools
+from time import time
+
+
+def test_prefilter_terms():
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('find_dashboards_with_datasource',
+                                                                'Datasource1'),
+                       ['datasource":', '"Datasource1"'])
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('find_dashboard_with_metric',
+                                                                'program.metric.host.gauge'),
+                       ['program.metric'])
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('find_dashboard_with_regex',
+                                                                r'ssrtb\.(md|agg)\.total_req'),
+                       ['ssrtb.', '.total_req'])
+    # Alternation and case insensitivity can't be pushed down.
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('find_dashboard_with_regex',
+                                                                'ssrtb|broker'), None)
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('find_dashboard_with_regex',
+                                                                '(?i)ssrtb'), None)
+    tools.assert_equal(dashboard_processors.get_prefilter_terms('update_datasource', 'a, b'), None)
+
+
+def test_check_deadline():
+    dashboard = mock.Mock(slug='slow')
+    with mock.patch.object(dashboard_processors, 'DASHBOARD_DEADLINE', None):
+        dashboard_processors._check_deadline(dashboard)
+    with mock.patch.object(dashboard_processors, 'DASHBOARD_DEADLINE', time() + 60):
+        dashboard_processors._check_deadline(dashboard)
+    with mock.patch.object(dashboard_processors, 'DASHBOARD_DEADLINE', time() - 1):
+        tools.assert_raises(dashboard_processors.DeadlineExceeded,
+                            dashboard_processors._check_deadline, dashboard)
+
+
+def test_aggregated_processors():
+    dashboard = mock.Mock(slug='dash', data=(
+        '{"rows": [{"panels": [{"datasource": "graphite1", "targets": ['
+        '{"target": "sumSeries(a.b.*)"}, {"target": "a.b.c", "datasource": "graphite2"}]}, '
+        '{"targets": [{"target": "divideSeries(a.b.c, a.b.c)"}]}]}]}'))
+    tools.assert_equal(dashboard_processors.count_datasources(dashboard),
+                       {'graphite1': 1, 'graphite2': 1, 'default': 1})
+    tools.assert_equal(dashboard_processors.top_metrics(dashboard), {'a.b.*': 1, 'a.b.c': 2})
+    aggregator = dashboard_processors.get_aggregator('top_metrics', '1')
+    aggregator.combine(dashboard_processors.top_metrics(dashboard))
+    tools.assert_equal(aggregator.result(), [('a.b.c', 2)])
+    tools.assert_equal(dashboard_processors.get_aggregator('update_old_paths'), None)
+
+
+def test_built_transforms():
+    factory = mock.Mock(side_effect=lambda processor_arg: mock.Mock(name=processor_arg))
+    with mock.patch.dict(dashboard_processors.TRANSFORMS, {'rename_metrics': factory}), \
+            mock.patch.dict(dashboard_processors.BUILT_TRANSFORMS, clear=True):
+        transform = dashboard_processors.get_transform('rename_metrics', 'a.map')
+        tools.assert_is(dashboard_processors.get_transform('rename_metrics', 'a.map'), transform)
+        tools.assert_is_not(dashboard_processors.get_transform('rename_metrics', 'b.map'),
+                            transform)
+        tools.assert_equal(factory.call_args_list, [mock.call('a.map'), mock.call('b.map')])
+    tools.assert_equal(dashboard_processors.get_transform('update_old_paths'), None)
+
+
+def test_cost_estimator():
+    estimator = mock.Mock()
+    estimator.dashboard_cost.return_value = mock.Mock(panels=[])
+    dashboard = mock.Mock(slug='dash', data='{"rows": []}')
+    with mock.patch('query_cost.get_estimator', return_value=estimator) as get_estimator, \
+            mock.patch.dict(dashboard_processors.COST_ESTIMATORS, clear=True), \
+            mock.patch.object(dashboard_processors, 'LOGGER'):
+        dashboard_processors.estimate_query_cost(dashboard, 'metrics.txt')
+        dashboard_processors.estimate_query_cost(dashboard, 'metrics.txt')
+    tools.assert_equal(get_estimator.call_args_list, [mock.call('metrics.txt')])
+    tools.assert_equal(estimator.dashboard_cost.call_count, 2)
+
+
+def test_memoized_targets():
+    dashboard = mock.Mock(slug='dash-Dup-1', data=(
+        '{"rows": [{"panels": [{"targets": [{"target": "sumSeries(prog.metric.host.gauge)"}, '
+        '{"target": "prog.md.metric.host.gauge"}]}, '
+        '{"targets": [{"target": "sumSeries(prog.metric.host.gauge)"}]}]}]}'))
+    with mock.patch.object(dashboard_processors, 'LOGGER') as logger, \
+            mock.patch.dict(dashboard_processors.target_memo.MEMOS, clear=True):
+        dashboard_processors.list_dashboards_with_old_metric_paths(dashboard)
+        dashboard_processors.list_dashboards_with_old_metric_paths(dashboard)
+        tools.assert_equal(logger.info.call_args_list,
+                           [mock.call('Old metric prog.metric.host.gauge in dash-Dup-1')] * 4)
+        dashboard_processors.find_dashboard_with_metric(dashboard, 'prog.metric.host.gauge')
+        tools.assert_equal(logger.info.call_args_list[-1],
+                           mock.call('"%s" graph "%s" contains %s: %s', 'dash-Dup-1',
+                                     'panelId=None, panelId=None', 'MATCH',
+                                     'prog.metric.host.gauge'))
+        tools.assert_equal(dashboard_processors.target_memo.stats(),
+                           {'list_dashboards_with_old_metric_paths':
+                            {'hits': 4, 'misses': 2, 'loaded': 0},
+                            'find_dashboard_with_metric': {'hits': 1, 'misses': 2, 'loaded': 0}})
+
+
+def test_find_stale_targets():
+    dashboard = mock.Mock(slug='dash', data=(
+        '{"rows": [{"panels": [{"title": "Requests", "targets": [{"target": "a.live"}, '
+        '{"target": "a.dead"}, {"target": "$colo.a.live"}]}, '
+        '{"id": 2, "targets": [{"target": "a.dead"}, {"target": "bad(a.x)"}]}]}]}'))
+    validate_metrics = mock.Mock()
+    validate_metrics.series_have_data.return_value = {'a.live': True, 'a.dead': False,
+                                                      'bad(a.x)': None}
+    with mock.patch.object(dashboard_processors, 'LOGGER') as logger, \
+            mock.patch.object(dashboard_processors, 'validate_metrics', validate_metrics):
+        counts = dashboard_processors.find_stale_targets(dashboard, '-30d')
+    validate_metrics.series_have_data.assert_called_once_with(['a.dead', 'a.live', 'bad(a.x)'],
+                                                              '-30d')
+    tools.assert_equal(counts, {'live': 1, 'stale': 2, 'failed': 1, 'unchecked': 1})
+    tools.assert_equal(logger.info.call_args_list,
+                       [mock.call('In %s graph "%s": stale target %s', 'dash', 'Requests',
+                                  'a.dead'),
+                        mock.call('In %s graph "%s": stale target %s', 'dash', 'panelId=2',
+                                  'a.dead')])
+    tools.assert_equal(logger.warn.call_count, 1)
+
+
+def test_update_old_paths():
+    dashboard = mock.Mock(slug='dash', title='Dash', data=(
+        '{"rows": [{"panels": [{"datasource": "graphite", "targets": ['
+        '{"target": "alias(prog.metric.h1.gauge.value, \'h1\')"}, '
+        '{"target": "prog.metric.h2.gauge.value", "refId": "A"}, '
+        '{"target": "prog.md.metric.host.h1.gauge.value", "refId": "B"}]}]}, '
+        '{"panels": [{"targets": [{"target": "prog.metric.h1.gauge.value"}]}]}]}'))
+    validate_metrics = mock.Mock()
+    validate_metrics.metric_exists.side_effect = \
+        lambda path: ('url', True) if 'h1' in path else (None, False)
+    written = []
+    with mock.patch.object(dashboard_processors, 'LOGGER'), \
+            mock.patch.object(dashboard_processors, 'validate_metrics', validate_metrics), \
+            mock.patch.object(dashboard_processors, 'DASHBOARD_DEADLINE', None), \
+            mock.patch.object(dashboard_processors, 'TARGET_CONCURRENCY', 4), \
+            mock.patch.object(dashboard_processors, '_write_dashboard',
+                              lambda dashboard, data: written.append(data)), \
+            mock.patch.dict(dashboard_processors.target_memo.MEMOS, clear=True):
+        dashboard_processors.update_old_paths(dashboard)
+    # The h1 path of both panels is resolved once.
+    tools.assert_equal(sorted([x[0][0] for x in validate_metrics.metric_exists.call_args_list]),
+                       ['prog.md.metric.host.h1.gauge.value', 'prog.md.metric.host.h2.gauge.value',
+                        'prog.metric.h2.gauge.value'])
+    targets = [[(x['target'], x.get('refId')) for x in panel['targets']]
+               for row in json_codec.loads(written[0])['rows'] for panel in row['panels']]
+    tools.assert_equal(targets, [
+        [("alias(prog.md.metric.host.h1.gauge.value, 'h1')", 'C'),
+         ('prog.metric.h2.gauge.value', 'A'), ('prog.md.metric.host.h1.gauge.value', 'B')],
+        [('prog.md.metric.host.h1.gauge.value', 'A')]])
+
+
+def test_new_metric_path_contexts():
+    children = {'prog.md.requests': ['region'],
+                'prog.md.requests.region.us': ['host'],
+                'prog.md.requests.region.us.host.h1': ['gauge'],
+                'prog.md.requests.region.us.host.h1.gauge': ['value']}
+    validate_metrics = mock.Mock()
+    validate_metrics.metric_children.side_effect = lambda path: children.get(path, [])
+    with mock.patch.object(dashboard_processors, 'LOGGER') as logger, \
+            mock.patch.object(dashboard_processors, 'validate_metrics', validate_metrics), \
+            mock.patch.object(dashboard_processors, 'DASHBOARD_DEADLINE', None):
+        tools.assert_equal(
+            dashboard_processors._new_metric_path(mock.Mock(slug='dash'),
+                                                  'prog.requests.region_us.h1.gauge.value'),
+            ('update', 'prog.md.requests.region.us.host.h1.gauge.value'))
+    tools.assert_false(logger.exception.called)
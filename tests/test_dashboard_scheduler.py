@@ -0,0 +1,49 @@
+from collections import namedtuple
+import dashboard_handle
+import dashboard_scheduler
+from nose import tools
+import os
+import shutil
+import tempfile
+
+RECORD = namedtuple('DashboardRecord', 'id slug data')
+
+
+def _row(slug, targets, padding=0):
+    return (slug, slug, '{"rows": [%s]}%s' % (', '.join(['{"target": "a.b"}'] * targets),
+                                              ' ' * padding))
+
+
+def test_largest_first():
+    rows = [_row('small', 1), _row('big', 10), _row('empty', 0, 100), _row('bare', 0)]
+    tools.assert_equal([x[1] for x in dashboard_scheduler.largest_first(rows, RECORD)],
+                       ['big', 'small', 'empty', 'bare'])
+    # 10 targets took 1s, so the untimed small one is expected at 0.1s.
+    tools.assert_equal([x[1] for x in dashboard_scheduler.largest_first(
+        rows, RECORD, {'big': 1.0, 'empty': 0.5})], ['big', 'empty', 'small', 'bare'])
+    tools.assert_equal([x[1] for x in dashboard_scheduler.largest_first(
+        iter(rows), RECORD, {'bare': 30.0})], ['bare', 'big', 'small', 'empty'])
+
+
+def test_timings_file():
+    directory = tempfile.mkdtemp()
+    try:
+        timings_path = os.path.join(directory, 'timings.json')
+        tools.assert_equal(dashboard_scheduler.load_timings(timings_path, 'update_old_paths'), {})
+        dashboard_scheduler.save_timings(timings_path, 'update_old_paths', {'a': 1.5, 'b': 2})
+        dashboard_scheduler.save_timings(timings_path, 'update_old_paths', {'b': 3})
+        dashboard_scheduler.save_timings(timings_path, 'update_datasource', {'a': 0.1})
+        tools.assert_equal(dashboard_scheduler.load_timings(timings_path, 'update_old_paths'),
+                           {'a': 1.5, 'b': 3})
+        tools.assert_equal(dashboard_scheduler.load_timings(timings_path, 'update_datasource'),
+                           {'a': 0.1})
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_handles():
+    handles = [dashboard_handle.DashboardHandle(x, 'dash-%s' % x, None, 1, None, 100 * x, 10 - x)
+               for x in range(4)]
+    # Target counts and sizes come from the handles, data is never loaded.
+    tools.assert_equal([x.slug for x in dashboard_scheduler.largest_first(handles)],
+                       ['dash-0', 'dash-1', 'dash-2', 'dash-3'])
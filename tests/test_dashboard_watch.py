@@ -0,0 +1,107 @@
+from collections import namedtuple
+import dashboard_watch
+import mock
+from nose import tools
+
+RECORD = namedtuple('DashboardRecord', 'id slug version updated data')
+
+
+class FakeSource(object):
+    '''Dashboard table of {id: RECORD}, updated a second ahead on every
+    write.
+
+    '''
+    DASHBOARD_RECORD = RECORD
+
+    def __init__(self, dashboards):
+        self.dashboards = dict([(x.id, x) for x in dashboards])
+
+    def get_dashboard_versions(self, updated_since=None, dashboard_ids=None):
+        return [(x.id, x.slug, x.version, x.updated)
+                for x in sorted(self.dashboards.values(), key=lambda x: (x.updated, x.id))
+                if (updated_since is None or x.updated >= updated_since)
+                and (dashboard_ids is None or x.id in dashboard_ids)]
+
+    def get_dashboards_by_id(self, dashboard_ids):
+        return [tuple(self.dashboards[x]) for x in dashboard_ids if x in self.dashboards]
+
+    def write(self, dashboard_id, data, version=None):
+        old = self.dashboards[dashboard_id]
+        self.dashboards[dashboard_id] = old._replace(
+            data=data, version=version or old.version,
+            updated=max([x.updated for x in self.dashboards.values()]) + 1)
+
+
+def test_parse_processors():
+    tools.assert_equal(dashboard_watch.parse_processors(
+        'update_old_paths; find_stale_targets:-6h ;'),
+        [('update_old_paths', None), ('find_stale_targets', '-6h')])
+    tools.assert_raises(dashboard_watch.DashboardWatchException,
+                        dashboard_watch.parse_processors, 'update_old_paths; unknown')
+    tools.assert_raises(dashboard_watch.DashboardWatchException,
+                        dashboard_watch.parse_processors, ' ; ')
+
+
+def test_watcher():
+    source = FakeSource([RECORD(1, 'one', 1, 10, 'old'), RECORD(2, 'two', 1, 10, 'old'),
+                         RECORD(3, 'three', 1, 9, 'old')])
+    calls = []
+
+    def fix(dashboard, argument):
+        calls.append(('fix', dashboard.slug, dashboard.data))
+        if dashboard.data == 'broken':
+            raise ValueError('broken json')
+        if dashboard.data != 'fixed':
+            source.write(dashboard.id, 'fixed')
+
+    def check(dashboard, argument):
+        calls.append(('check', dashboard.slug, dashboard.data, argument))
+    processors = {'update_old_paths': fix, 'find_stale_targets': check}
+    with mock.patch.object(dashboard_watch.processor_registry, 'get_processor',
+                           processors.get), \
+            mock.patch.object(dashboard_watch, 'LOGGER') as logger:
+        watcher = dashboard_watch.Watcher([('update_old_paths', None),
+                                           ('find_stale_targets', '-6h')], source)
+        tools.assert_equal(watcher.poll(), 0)
+        tools.assert_equal(watcher.poll(), 0)
+        # A save in the second of the last poll is a change too.
+        source.dashboards[2] = source.dashboards[2]._replace(version=2, data='edited')
+        source.dashboards[3] = source.dashboards[3]._replace(version=2, updated=11)
+        tools.assert_equal(watcher.poll(), 2)
+        tools.assert_equal(calls, [('fix', 'two', 'edited'), ('check', 'two', 'fixed', '-6h'),
+                                   ('fix', 'three', 'old'), ('check', 'three', 'fixed', '-6h')])
+        # The writes of the processors are not changes.
+        tools.assert_equal(watcher.poll(), 0)
+        source.write(1, 'broken', version=2)
+        del calls[:]
+        tools.assert_equal(watcher.poll(), 1)
+        tools.assert_equal(calls, [('fix', 'one', 'broken')])
+        tools.assert_equal(watcher.poll(), 0)
+    tools.assert_equal(watcher.counts, {'polls': 6, 'processed': 2, 'failed': 1})
+    tools.assert_equal(logger.error.call_args[0][1:], ('update_old_paths', 'one', mock.ANY))
+    tools.assert_equal(sorted(watcher.seen), [1])
+
+
+def test_run():
+    watcher = mock.Mock(counts={'polls': 0, 'processed': 0, 'failed': 0})
+
+    def poll():
+        watcher.counts['polls'] += 1
+        if watcher.counts['polls'] == 2:
+            raise IOError('connection lost')
+        return 1
+    watcher.poll.side_effect = poll
+    clock = [100.0]
+    waits = []
+
+    def wait(seconds):
+        waits.append(seconds)
+        clock[0] += seconds
+    with mock.patch.object(dashboard_watch, 'LOGGER') as logger, \
+            mock.patch.object(dashboard_watch, '_expire_caches') as expire_caches:
+        dashboard_watch.run(watcher, 5, cache_ttl=12, polls=4, clock=lambda: clock[0],
+                            wait=wait)
+    tools.assert_equal(waits, [5, 5, 5, 5])
+    tools.assert_equal(expire_caches.call_count, 1)
+    tools.assert_equal(logger.error.call_count, 1)
+    tools.assert_equal(logger.info.call_count, 3)
@@ -0,0 +1,44 @@
+from collections import namedtuple
+import datasource_migration
+import mock
+from nose import tools
+
+DATASOURCE = namedtuple('Datasource', 'name')
+RECORD = namedtuple('Record', 'id data')
+
+
+def test_rename_datasource_fields():
+    dashboard = {'rows': [{'panels': [{'datasource': 'old', 'targets': [{'datasource': 'old'},
+                                                                        {'datasource': 'other'}]},
+                                      {'datasource': 'older'}]}],
+                 'templating': {'list': [{'datasource': 'old'}]}}
+    tools.assert_equal(datasource_migration.rename_datasource_fields(dashboard, 'old', 'new'), 3)
+    tools.assert_equal(dashboard['rows'][0]['panels'][0]['targets'][1]['datasource'], 'other')
+    tools.assert_equal(dashboard['rows'][0]['panels'][1]['datasource'], 'older')
+
+
+def test_migrate():
+    with mock.patch.object(datasource_migration, 'sql_connector') as sql_connector:
+        sql_connector.get_datasources.return_value = [DATASOURCE('new')]
+        sql_connector.get_datasource_references.return_value = [
+            (1, 'a', True), (2, 'b', True), (3, 'c', False)]
+        sql_connector.replace_in_dashboards_data.side_effect = lambda ids, old, new: len(ids)
+        sql_connector.DASHBOARD_RECORD = RECORD
+        sql_connector.get_dashboards_by_id.return_value = [(3, '{"datasource":"old"}')]
+        sql_connector.update_dashboards_data.side_effect = lambda updates, chunk_size: [
+            len(list(updates))]
+        lines = []
+        tools.assert_equal(datasource_migration.migrate('old', 'new', chunk_size=1,
+                                                        report=lines.append), 3)
+    tools.assert_equal([x[0][0] for x in sql_connector.replace_in_dashboards_data.call_args_list],
+                       [[1], [2]])
+    tools.assert_equal(sql_connector.replace_in_dashboards_data.call_args[0][1:],
+                       ('"datasource": "old"', '"datasource": "new"'))
+    tools.assert_equal(len(lines), 4)
+
+
+@tools.raises(datasource_migration.DatasourceMigrationException)
+def test_unknown_datasource():
+    with mock.patch.object(datasource_migration, 'sql_connector') as sql_connector:
+        sql_connector.get_datasources.return_value = [DATASOURCE('other')]
+        datasource_migration.migrate('old', 'new')
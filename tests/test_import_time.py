@@ -0,0 +1,87 @@
+'''Import checks for the cli entry points. Heavy modules, and the
+modules only some processors use, must only be imported once a
+processor needs them.
+
+Importing manip_grafana_db must also stay within IMPORT_TIME_BUDGET
+seconds, the median of IMPORT_TIME_RUNS fresh interpreters; set the
+environment variable IMPORT_TIME_BUDGET on slow or loaded hosts.
+
+'''
+import os
+from subprocess import Popen, PIPE
+import sys
+from nose import tools
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('MySQLdb', 'multiprocessing', 'requests', 'rpn', 'sql_connector', 'triconf',
+                 'urllib3')
+# The modules of this package every entry point may import, any other
+# goes through lazy_module. (entry point, package modules, heavy
+# modules it needs itself)
+ENTRY_POINTS = (
+    ('processor_registry', ('processor_registry',), ()),
+    ('dashboard_processors', ('aggregations', 'dashboard_processors', 'json_codec', 'lazy_import',
+                              'panel_stream', 'processor_registry', 'target_ast',
+                              'target_consolidation'), ()),
+    ('validate_metrics', ('json_codec', 'lazy_import', 'validate_metrics'), ('triconf',)),
+    ('manip_grafana_db', ('aggregations', 'dashboard_processors', 'dashboard_scheduler',
+                          'json_codec', 'lazy_import', 'manip_grafana_db', 'panel_stream',
+                          'processor_registry', 'simple_logger', 'target_ast',
+                          'target_consolidation'), ('triconf',)))
+# Generous, the import takes about a tenth of it; eagerly importing
+# MySQLdb, requests and multiprocessing takes several times as long.
+IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET') or 0.5)
+IMPORT_TIME_RUNS = 5
+
+
+def _import_in_subprocess(module_name):
+    '''Import module_name in a fresh interpreter and return the modules
+    loaded afterwards, and those of them in this package.
+
+    '''
+    script = ('import os, sys\n'
+              'import %s\n'
+              'package = [x for x, y in sys.modules.items() if getattr(y, "__file__", None)\n'
+              '           and os.path.dirname(os.path.abspath(y.__file__)) == os.getcwd()]\n'
+              'print(repr((sorted(sys.modules), sorted(package))))\n' % module_name)
+    proc = Popen([sys.executable, '-c', script], cwd=PACKAGE_DIR, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    tools.assert_equal(proc.returncode, 0, stderr)
+    return eval(stdout.strip())
+
+
+def _check_import(module_name, package_modules, needed):
+    modules, imported = _import_in_subprocess(module_name)
+    for heavy in HEAVY_MODULES:
+        if heavy not in needed:
+            tools.assert_not_in(heavy, modules, '%s imports %s' % (module_name, heavy))
+    extra = sorted(set(imported) - set(package_modules))
+    tools.assert_equal(extra, [], '%s imports %s, use lazy_module' % (module_name, extra))
+
+
+def test_entry_point_imports():
+    for module_name, package_modules, needed in ENTRY_POINTS:
+        yield _check_import, module_name, package_modules, needed
+
+
+def _import_time(module_name):
+    '''Return the seconds importing module_name takes in a fresh
+    interpreter, interpreter startup excluded.
+
+    '''
+    script = ('import time\n'
+              'start = time.time()\n'
+              'import %s\n'
+              'print(time.time() - start)\n' % module_name)
+    proc = Popen([sys.executable, '-c', script], cwd=PACKAGE_DIR, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    tools.assert_equal(proc.returncode, 0, stderr)
+    return float(stdout.strip())
+
+
+def test_import_time():
+    times = sorted(_import_time('manip_grafana_db') for _ in range(IMPORT_TIME_RUNS))
+    median = times[len(times) // 2]
+    tools.assert_less(median, IMPORT_TIME_BUDGET,
+                      'importing manip_grafana_db takes %.3fs, budget %.3fs (IMPORT_TIME_BUDGET)'
+                      % (median, IMPORT_TIME_BUDGET))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import json_codec
+import mock
+from nose import tools
+
+
+def test_detect_encoding():
+    tools.assert_equal(json_codec.detect_encoding(b'{"title": "Debit"}'), 'ascii')
+    tools.assert_equal(json_codec.detect_encoding(u'{"title": "D\xe9bit"}'.encode('utf-8')), 'utf-8')
+    tools.assert_equal(json_codec.detect_encoding(u'{"title": "D\xe9bit"}'.encode('latin-1')),
+                       'latin-1')
+
+
+def test_loads():
+    for encoding in ('utf-8', 'latin-1'):
+        blob = u'{"title": "D\xe9bit", "rows": []}'.encode(encoding)
+        tools.assert_equal(json_codec.loads(blob), {'title': u'D\xe9bit', 'rows': []})
+        tools.assert_equal(json_codec.loads(blob, ordered=True)['title'], u'D\xe9bit')
+    ordered = json_codec.loads(b'{"b": 1, "a": 2, "c": 3}', ordered=True)
+    tools.assert_equal(list(ordered.keys()), ['b', 'a', 'c'])
+    tools.assert_raises(json_codec.DecodeError, json_codec.loads, b'{"title": ')
+    tools.assert_raises(json_codec.DecodeError, json_codec.loads, b'{"title": "D\xe9')
+
+
+def test_loads_detects_once():
+    blob = u'{"title": "D\xe9bit"}'.encode('latin-1')
+    # The latin-1 blob is not handed to the backend as utf-8 first.
+    with mock.patch.object(json_codec, '_loads', wraps=json_codec._loads) as loads:
+        tools.assert_equal(json_codec.loads(blob)['title'], u'D\xe9bit')
+    tools.assert_equal(loads.call_count, 1)
+    with mock.patch.object(json_codec, 'DATA_ENCODING', 'latin-1'), \
+            mock.patch.object(json_codec, '_is_ascii') as is_ascii:
+        tools.assert_equal(json_codec.loads(blob, ordered=True)['title'], u'D\xe9bit')
+    tools.assert_false(is_ascii.called)
+    with mock.patch.object(json_codec, 'DATA_ENCODING', 'utf-8'):
+        tools.assert_raises(json_codec.DecodeError, json_codec.loads, blob)
+
+
+def test_dumps_format():
+    # rpn.json_obj_to_grafana_target relies on the default separators.
+    tools.assert_equal(json_codec.dumps(OrderedDict((('a', [1, 2]), ('b', 'c')))),
+                       '{"a": [1, 2], "b": "c"}')
+
+
+def test_raw_decode():
+    tools.assert_equal(json_codec.raw_decode('{"a": [1, 2]}, 3', 0), ({'a': [1, 2]}, 13))
+    tools.assert_equal(json_codec.raw_decode('x, "b"', 3), ('b', 6))
+    tools.assert_raises(json_codec.DecodeError, json_codec.raw_decode, 'x', 0)
+    tools.assert_raises(json_codec.DecodeError, json_codec.raw_decode, '[1, ', 0)
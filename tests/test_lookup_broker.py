@@ -0,0 +1,74 @@
+import lookup_broker
+import mock
+from nose import tools
+import os
+import shutil
+import tempfile
+import threading
+
+
+def test_single_flight():
+    clock = [0]
+    flights = lookup_broker.SingleFlight(ttl=10, clock=lambda: clock[0])
+    release = threading.Event()
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        release.wait()
+        return ['url', {'metrics': []}]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.call('a.b', lookup)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flights.stats()['coalesced'] < 4:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    tools.assert_equal(len(calls), 1)
+    tools.assert_equal(results, [['url', {'metrics': []}]] * 5)
+    flights.call('a.b', lookup)
+    clock[0] = 11
+    flights.call('a.b', lookup)
+    tools.assert_equal(len(calls), 2)
+    stats = flights.stats()
+    tools.assert_equal([stats[x] for x in ('requests', 'hits', 'coalesced', 'upstream', 'errors')],
+                       [7, 1, 4, 2, 0])
+
+
+def test_single_flight_error():
+    flights = lookup_broker.SingleFlight()
+
+    def fail():
+        raise ValueError('graphite down')
+    tools.assert_raises(ValueError, flights.call, 'a', fail)
+    tools.assert_equal(flights.call('a', lambda: 1), 1)
+    tools.assert_equal(flights.stats()['errors'], 1)
+
+
+def test_broker_socket():
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'broker.sock')
+    metric_exists = mock.Mock(return_value=('http://graphite', {'metrics': [{'name': 'b'}]}))
+    try:
+        server = lookup_broker.make_server(socket_path, lookup_broker.LookupBroker())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        with mock.patch.object(lookup_broker, 'validate_metrics') as validate_metrics:
+            validate_metrics.metric_exists = metric_exists
+            client = lookup_broker.BrokerClient(socket_path)
+            for _ in range(3):
+                tools.assert_equal(client.call('metric_exists', 'a.*', None),
+                                   ['http://graphite', {'metrics': [{'name': 'b'}]}])
+            tools.assert_raises(lookup_broker.LookupBrokerException, client.call, 'unknown')
+        tools.assert_true(lookup_broker.is_serving(socket_path))
+        tools.assert_equal(metric_exists.call_count, 1)
+        tools.assert_equal(client.call('stats')['hits'], 2)
+        server.shutdown()
+        server.server_close()
+        tools.assert_false(lookup_broker.is_serving(os.path.join(directory, 'missing.sock')))
+    finally:
+        shutil.rmtree(directory)
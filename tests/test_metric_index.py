@@ -0,0 +1,65 @@
+import dashboard_handle
+import metric_index
+import mock
+from nose import tools
+import os
+import tempfile
+
+
+def _setup():
+    metric_index.CONFIGS = mock.Mock(metric_index_path=tempfile.mktemp(suffix='.sqlite'),
+                                     metric_index_candidates=50)
+    metric_index.INDEX_CONNECTION = None
+
+
+def _teardown():
+    metric_index.INDEX_CONNECTION.close()
+    metric_index.INDEX_CONNECTION = None
+    os.remove(metric_index.CONFIGS.metric_index_path)
+
+
+def _dashboard(*panels):
+    return ('{"rows": [{"panels": [%s]}]}'
+            % ', '.join(['{"title": "%s", "targets": [%s]}'
+                         % (title, ', '.join(['{"target": "%s"}' % x for x in targets]))
+                         for title, targets in panels]))
+
+
+def test_path_distance():
+    tools.assert_equal(metric_index.path_distance('prog.requests.count', 'prog.requests.count'), 0)
+    tools.assert_equal(metric_index.path_distance('prog.requets.count', 'prog.requests.count'),
+                       0.125)
+    tools.assert_equal(metric_index.path_distance('prog.md.requests.count',
+                                                  'prog.requests.count'), 1)
+    tools.assert_true('^re' in metric_index.node_grams('prog.requests'))
+
+
+@tools.with_setup(_setup, _teardown)
+def test_refresh_and_search():
+    data = {1: _dashboard(('Requests', ['sumSeries(prog.requests.count)', 'prog.errors.count'])),
+            2: _dashboard(('Latency', ['prog.latency.p99']), ('Copy', ['prog.requests.count'])),
+            3: _dashboard(('Other', ['other.cpu.idle']))}
+    fetched = []
+
+    def fetch(ids):
+        fetched.extend(ids)
+        return [(x, data[x]) for x in ids if x in data]
+
+    def handles(versions):
+        return dashboard_handle.make_handles([(x, 'dash-%s' % x, None, version, None, 0)
+                                              for x, version in versions], fetch)
+    tools.assert_raises(metric_index.MetricIndexException, metric_index.search, 'prog')
+    tools.assert_equal(metric_index.refresh(handles([(1, 1), (2, 1), (3, 1)]), fetch), (3, 0))
+    matches = metric_index.search('prog.requets.count', top=2)
+    tools.assert_equal([(x.path, x.distance) for x in matches],
+                       [('prog.requests.count', 0.125), ('prog.errors.count', 0.714)])
+    tools.assert_equal(matches[0].uses, [('dash-1', 'Requests'), ('dash-2', 'Copy')])
+    # Only dashboard 2 changed, 3 is gone.
+    del fetched[:]
+    data[2] = _dashboard(('Latency', ['prog.latency.p99']))
+    tools.assert_equal(metric_index.refresh(handles([(1, 1), (2, 2)]), fetch), (1, 1))
+    tools.assert_equal(fetched, [2])
+    tools.assert_equal(metric_index.search('prog.requests.count', top=1)[0].uses,
+                       [('dash-1', 'Requests')])
+    tools.assert_true('other.cpu.idle' not in [x.path for x in
+                                               metric_index.search('other.cpu.idle')])
@@ -0,0 +1,71 @@
+import metric_renames
+from nose import tools
+import os
+import shutil
+import tempfile
+
+MAPPING = '''# old new
+prog.metric.ca_1.host1.count    prog.md.metric.ca.1.host.host1.count
+prog.old_name                   prog.md.new_name
+prog.old_name.special           other.special
+'''
+
+
+def test_rename_path():
+    renamer = metric_renames.MetricRenamer(metric_renames.build_trie(MAPPING.splitlines()))
+    tools.assert_equal(renamer.rename_path('prog.old_name.ctx.value')[0],
+                       'prog.md.new_name.ctx.value')
+    tools.assert_equal(renamer.rename_path('prog.old_name.special.value')[0],
+                       'other.special.value')
+    tools.assert_equal(renamer.rename_path('prog.old_name'),
+                       ('prog.md.new_name', ['prog', 'old_name'], ['prog', 'md', 'new_name']))
+    tools.assert_equal(renamer.rename_path('prog.*.ctx'), None)
+    tools.assert_equal(renamer.rename_path('prog.metric.ca_1'), None)
+    tools.assert_raises(metric_renames.MetricRenameException, metric_renames.build_trie,
+                        ['just.one.path'])
+
+
+def test_rename_target():
+    renamer = metric_renames.MetricRenamer(metric_renames.build_trie(MAPPING.splitlines()))
+    tools.assert_equal(renamer.rename_target("alias(scale(prog.old_name.*.value,60),'req')"),
+                       "alias(scale(prog.md.new_name.*.value, 60), 'req')")
+    # Node 1 (old_name) is node 2 of the new prefix, node 2 shifts by one.
+    tools.assert_equal(renamer.rename_target('aliasByNode(prog.old_name.*.value, 1, 2, -1)'),
+                       'aliasByNode(prog.md.new_name.*.value, 2, 3, -1)')
+    tools.assert_equal(renamer.rename_target(
+        'aliasByNode(prog.metric.ca_1.host1.count, 3)'),
+        'aliasByNode(prog.md.metric.ca.1.host.host1.count, 6)')
+    tools.assert_equal(renamer.rename_target(
+        'sumSeriesWithWildcards(scale(prog.old_name.*.value, 2), 2)'),
+        'sumSeriesWithWildcards(scale(prog.md.new_name.*.value, 2), 3)')
+    # Node numbers of several series can't follow them.
+    tools.assert_equal(renamer.rename_target(
+        'aliasByNode(group(prog.old_name.a, prog.old_name.b), 2)'),
+        'aliasByNode(group(prog.md.new_name.a, prog.md.new_name.b), 2)')
+    tools.assert_equal(renamer.rename_target('other.path'), None)
+    tools.assert_equal(renamer.rename_target('unbalanced(prog.old_name'), None)
+
+
+def test_apply_and_cache():
+    mapping_dir = tempfile.mkdtemp()
+    try:
+        mapping_path = os.path.join(mapping_dir, 'renames.txt')
+        with open(mapping_path, 'w') as mapping_file:
+            mapping_file.write(MAPPING)
+        renamer = metric_renames.MetricRenamer.from_file(mapping_path)
+        tools.assert_true(os.path.isfile(mapping_path + '.trie'))
+        tools.assert_equal(metric_renames.load_trie(mapping_path), renamer.trie)
+        dashboard_obj = {'rows': [{'panels': [{'title': 'Requests', 'targets': [
+            {'target': 'prog.old_name.count', 'refId': 'A'}, {'target': 'other.count'}]}]}]}
+        tools.assert_equal(renamer.apply('dash', dashboard_obj),
+                           ['panel "Requests": prog.old_name.count -> prog.md.new_name.count'])
+        tools.assert_equal(dashboard_obj['rows'][0]['panels'][0]['targets'],
+                           [{'target': 'prog.md.new_name.count', 'refId': 'A'},
+                            {'target': 'other.count'}])
+        with open(mapping_path, 'a') as mapping_file:
+            mapping_file.write('other.count another.count\n')
+        tools.assert_equal(
+            metric_renames.MetricRenamer.from_file(mapping_path).rename_path('other.count')[0],
+            'another.count')
+    finally:
+        shutil.rmtree(mapping_dir)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import panel_limits
+from nose import tools
+
+COUNTS = {'a.*.c': 40, 'b.*.c': 20, 'd.*.c': 20}
+
+
+def _limits():
+    return panel_limits.PanelLimits(max_series_per_panel=30, max_series_per_row=50,
+                                    max_series_for_flot=100, max_data_points=500,
+                                    count_glob=COUNTS.get)
+
+
+def _panel(panel_id, title, targets, renderer='flot'):
+    return OrderedDict((('id', panel_id), ('renderer', renderer), ('title', title),
+                        ('targets', [{'refId': chr(65 + x), 'target': target}
+                                     for x, target in enumerate(targets)])))
+
+
+def test_apply_to_dashboard():
+    dashboard = {'rows': [{'title': 'row', 'height': '250px',
+                           'panels': [_panel(1, 'split', ['b.*.c', 'd.*.c', 'e.f']),
+                                      _panel(2, 'heavy', ['a.*.c']),
+                                      _panel(3, 'light', ['e.f'])]}]}
+    changes = _limits().apply_to_dashboard(dashboard)
+    tools.assert_equal(len(changes), 3)
+    rows = dashboard['rows']
+    tools.assert_equal([(x['title'], x['height']) for x in rows],
+                       [('row (1/2)', '250px'), ('row (2/2)', '250px')])
+    panels = [x for row in rows for x in row['panels']]
+    tools.assert_equal([(x['id'], x['title']) for x in panels],
+                       [(1, 'split (1/2)'), (4, 'split (2/2)'), (2, 'heavy'), (3, 'light')])
+    tools.assert_equal([x['target'] for x in panels[1]['targets']], ['d.*.c', 'e.f'])
+    tools.assert_equal(panels[2]['maxDataPoints'], 500)
+    tools.assert_equal(panels[2]['targets'][0]['target'], "consolidateBy(a.*.c, 'max')")
+    tools.assert_equal(set([x['renderer'] for x in panels]), set(['flot']))
+
+
+def test_renderer():
+    dashboard = {'rows': [{'title': str(x), 'panels': [_panel(x, 'p', ['b.*.c', 'e.f'])]}
+                          for x in range(5)]}
+    changes = _limits().apply_to_dashboard(dashboard)
+    tools.assert_equal([x['renderer'] for row in dashboard['rows'] for x in row['panels']],
+                       ['png'] * 5)
+    tools.assert_equal(len(changes), 5)
+    tools.assert_equal(_limits().apply_to_dashboard(dashboard), [])
+    text = {'id': 9, 'type': 'text', 'title': 'notes'}
+    singlestat = dict(_panel(10, 's', ['b.*.c']), type='singlestat')
+    singlestat.pop('renderer')
+    dashboard['rows'][0]['panels'].extend([text, singlestat])
+    tools.assert_equal(_limits().apply_to_dashboard(dashboard), [])
+    tools.assert_false('renderer' in text or 'renderer' in singlestat)
+
+
+def test_builder_hook():
+    changes = []
+    hook = _limits().builder_hook(changes)
+    targets = ['b.*.c', 'd.*.c']
+    rows = hook([('row', [{'title': 'p', 'targets': targets}])])
+    tools.assert_equal(rows, [('row', [{'title': 'p (1/2)', 'targets': ['b.*.c']},
+                                       {'title': 'p (2/2)', 'targets': ['d.*.c']}])])
+    tools.assert_equal(targets, ['b.*.c', 'd.*.c'])
+    tools.assert_equal(len(changes), 1)
+
+
+def test_builder_hook_ids():
+    hook = _limits().builder_hook()
+    rows = hook([('row', [{'id': 4, 'title': 'p', 'targets': ['b.*.c', 'd.*.c']},
+                          {'id': 7, 'title': 'q', 'targets': ['e.c']}])])
+    tools.assert_equal([(x['title'], x['id']) for x in rows[0][1]],
+                       [('p (1/2)', 4), ('p (2/2)', 8), ('q', 7)])
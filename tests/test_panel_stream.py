@@ -0,0 +1,38 @@
+import json_codec
+import panel_stream
+from nose import tools
+
+DASHBOARD = json_codec.dumps({
+    'title': 'Dashboard "panels": [',
+    'rows': [
+        {'title': 'row 0',
+         'panels': [{'id': 1, 'title': 'graph', 'datasource': 'Datasource1',
+                     'links': [{'title': 'not a panel'}],
+                     'targets': [{'refId': 'A', 'target': 'a.{b,c}.d'},
+                                 {'refId': 'B', 'target': 'alias(e.f, "g\\"h")', 'hide': True}]},
+                    {'id': 2, 'title': 'text', 'type': 'text'}]},
+        {'title': 'row 1', 'panels': []},
+        {'title': 'row 2',
+         'panels': [{'id': 3, 'title': 'graph', 'targets': [{'refId': 'A'}]}]}]})
+
+
+def test_iter_panels():
+    panels = list(panel_stream.iter_panels(DASHBOARD))
+    tools.assert_equal([(x.row_index, x.panel_index, x.id) for x in panels],
+                       [(0, 0, 1), (0, 1, 2), (2, 0, 3)])
+    tools.assert_equal(panels[0].datasource, 'Datasource1')
+    tools.assert_equal([x.target for x in panels[0].targets],
+                       ['a.{b,c}.d', 'alias(e.f, "g\\"h")'])
+    tools.assert_equal(panels[1].targets, None)
+
+
+def test_iter_targets():
+    tools.assert_equal([(x.panel_number, x.ref_id, x.target, x.hide)
+                        for x in panel_stream.iter_targets(DASHBOARD)],
+                       [(0, 'A', 'a.{b,c}.d', None), (0, 'B', 'alias(e.f, "g\\"h")', True)])
+
+
+def test_keys_without_list():
+    data = '{"panels" : {"targets": "a.b"}, "rows": [{"panels" : [ {"id": 1} ]}]}'
+    tools.assert_equal([(x.row_index, x.id) for x in panel_stream.iter_panels(data)], [(0, 1)])
+    tools.assert_equal(list(panel_stream.iter_targets(data)), [])
@@ -0,0 +1,50 @@
+from nose import tools
+import pipeline
+import threading
+from time import sleep
+
+
+def test_pipeline():
+    errors = []
+    written = []
+
+    def write(batch):
+        written.append(len(batch))
+        return sum(batch)
+
+    def check(number):
+        if number == 13:
+            raise ValueError('unlucky')
+        return number if number % 2 else None
+    pipe = pipeline.Pipeline([pipeline.Stage('split', lambda x: range(x, x + 10), expand=True),
+                              pipeline.Stage('check', check, workers=4, queue_size=5),
+                              pipeline.Stage('write', write, batch_size=4, queue_size=5)],
+                             on_error=lambda stage, error: errors.append(stage))
+    results = pipe.run([0, 10, 20])
+    tools.assert_equal(sum(results), sum(range(1, 30, 2)) - 13)
+    tools.assert_equal(sum(written), 14)
+    tools.assert_true(max(written) <= 4)
+    tools.assert_equal(errors, ['check'])
+    stats = pipe.stats()
+    tools.assert_equal([(x.name, x.processed, x.errors) for x in stats],
+                       [('split', 3, 0), ('check', 30, 1), ('write', 14, 0)])
+    tools.assert_true(all(x.queue_depth == 0 for x in stats))
+
+
+def test_backpressure():
+    release = threading.Event()
+
+    def slow(item):
+        release.wait()
+        return item
+    pipe = pipeline.Pipeline([pipeline.Stage('fast', lambda x: x, queue_size=2),
+                              pipeline.Stage('slow', slow, queue_size=3)])
+    runner = threading.Thread(target=pipe.run, args=(range(50),))
+    runner.start()
+    sleep(0.2)
+    depths = [x.queue_depth for x in pipe.stats()]
+    release.set()
+    runner.join(10)
+    # One item waits in each stage worker, the rest fills the queues only.
+    tools.assert_equal(depths, [2, 3])
+    tools.assert_equal(sorted(pipe.results), list(range(50)))
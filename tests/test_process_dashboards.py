@@ -0,0 +1,46 @@
+import manip_grafana_db
+import mock
+from nose import tools
+from subprocess import Popen
+import sys
+from tempfile import TemporaryFile
+from time import sleep, time
+
+
+def _child(slug, code):
+    output_file = TemporaryFile()
+    return (slug, Popen([sys.executable, '-c', 'import sys; sys.exit(%s)' % code],
+                        stderr=output_file), time(), output_file, None)
+
+
+def test_reap():
+    proc_pool = [_child('done', 0), _child('late', manip_grafana_db.DEADLINE_EXIT),
+                 _child('failed', 1)]
+    timed_out = []
+    timings = {}
+    with mock.patch.object(manip_grafana_db, 'CONFIGS', mock.Mock(dashboard_timeout='30')):
+        while proc_pool:
+            manip_grafana_db._reap(proc_pool, timed_out, timings)
+            sleep(0.01)
+    # The child past its deadline stopped itself, it is retried too.
+    tools.assert_equal(timed_out, ['late'])
+    tools.assert_equal(sorted(timings), ['done', 'failed', 'late'])
+
+
+def test_lost_lease():
+    procs = []
+
+    def popen(cmd, **kargs):
+        procs.append(Popen([sys.executable, '-c', 'import time; time.sleep(60)'], **kargs))
+        return procs[-1]
+
+    def heartbeat():
+        raise manip_grafana_db.sweep_coordinator.LeaseLost('gone')
+    job = {'processor': 'top_metrics', 'processor_argument': None, 'use_mirror': False,
+           'dry_run': False}
+    with mock.patch.object(manip_grafana_db, 'CONFIGS', mock.Mock(
+            dashboard_timeout='30', process_count_limit='1')), \
+            mock.patch.object(manip_grafana_db, 'Popen', popen):
+        tools.assert_raises(manip_grafana_db.sweep_coordinator.LeaseLost,
+                            manip_grafana_db._run_children, job, ['a', 'b'], None, heartbeat, {})
+    tools.assert_equal([x.returncode for x in procs], [-9])
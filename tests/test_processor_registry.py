@@ -0,0 +1,18 @@
+import dashboard_processors
+import processor_registry
+from nose import tools
+
+
+def test_registry_matches_processors():
+    tools.assert_equal(sorted(processor_registry.PROCESSORS),
+                       sorted(dashboard_processors.PROCESSORS))
+    for name, info in processor_registry.PROCESSORS.items():
+        tools.assert_equal(info.description,
+                           dashboard_processors.PROCESSORS[name].__doc__.strip(),
+                           'registry description for %s is out of date' % name)
+
+
+def test_get_processor():
+    tools.assert_equal(processor_registry.get_processor('update_datasource'),
+                       dashboard_processors.update_datasource)
+    tools.assert_raises(KeyError, processor_registry.get_processor, 'not_a_processor')
@@ -0,0 +1,46 @@
+import query_cost
+from nose import tools
+
+NAMESPACE = query_cost.MetricNamespace(['a.ca.host1.cpu', 'a.ca.host2.cpu', 'a.lc.host3.cpu',
+                                        'a.lc.host3.mem', 'b.ca.host1.cpu'])
+
+
+def test_namespace_count():
+    tools.assert_equal(NAMESPACE.count('a.*.*.cpu'), 3)
+    tools.assert_equal(NAMESPACE.count('a.{ca,xa}.host[12].cpu'), 2)
+    tools.assert_equal(NAMESPACE.count('*.ca.host?.*'), 3)
+    tools.assert_equal(NAMESPACE.count('a.lc'), 1)
+    tools.assert_equal(NAMESPACE.count('c.*'), 0)
+
+
+def test_intervals():
+    tools.assert_equal(query_cost.refreshes_per_hour('10s'), 360)
+    tools.assert_equal(query_cost.refreshes_per_hour(False), query_cost.LOADS_PER_HOUR)
+    tools.assert_equal(query_cost.range_hours({'from': 'now-2d', 'to': 'now'}), 48)
+    tools.assert_equal(query_cost.range_hours({'from': '2015-01-01T00:00:00Z'}),
+                       query_cost.DEFAULT_RANGE_HOURS)
+
+
+def test_dashboard_cost():
+    counted = []
+
+    def count_glob(glob):
+        counted.append(glob)
+        return NAMESPACE.count(glob)
+    estimator = query_cost.QueryCostEstimator(count_glob)
+    dashboard = {'refresh': '1m', 'time': {'from': 'now-1h', 'to': 'now'},
+                 'rows': [{'panels': [{'title': 'cpu',
+                                       'targets': [{'target': 'a.$colo.*.cpu'},
+                                                   {'target': 'a.*.*.cpu', 'hide': True}]},
+                                      {'title': 'sum',
+                                       'targets': [{'target': 'sumSeries(a.*.*.cpu)'}]},
+                                      {'title': 'text'}]}]}
+    cost = estimator.dashboard_cost('slug', dashboard)
+    # sumSeries returns one series but reads all it sums.
+    tools.assert_equal([(x.title, x.series, x.fetched, x.cost) for x in cost.panels],
+                       [('cpu', 3, 3, 180), ('sum', 1, 3, 180)])
+    tools.assert_equal((cost.series, cost.fetched, cost.cost), (4, 6, 360))
+    tools.assert_equal(estimator.target_series('seriesByTag("name=cpu")'), (1, 1))
+    estimator.dashboard_cost('other', dashboard)
+    tools.assert_equal(counted, ['a.*.*.cpu'])
+    tools.assert_true('slug: cpu' in query_cost.format_report([cost]))
@@ -0,0 +1,81 @@
+from collections import namedtuple
+import json_codec
+import layouts
+import mock
+import refresh_governor
+from nose import tools
+
+POLICY = {'rules': [{'tag': 'wallboard', 'min_refresh': '1m', 'max_range': '1d'},
+                    {'datasource': 'Global', 'min_refresh': '5m'},
+                    {'min_refresh': '10s', 'max_range': '7d'}]}
+
+
+def _dashboard(refresh='5s', time_from='now-30d', tags=(), datasource='Datasource1'):
+    dashboard = layouts.main_layout()
+    dashboard['refresh'] = refresh
+    dashboard['time']['from'] = time_from
+    dashboard['tags'] = list(tags)
+    dashboard['rows'] = [{'panels': [{'datasource': datasource, 'targets': [{'target': 'a.b'}]},
+                                     {'datasource': datasource, 'targets': [{'target': 'c.d'}]}]}]
+    return dashboard
+
+
+def test_limits():
+    governor = refresh_governor.RefreshGovernor(POLICY)
+    tools.assert_equal(governor.limits('slug', _dashboard()), ('10s', '7d'))
+    tools.assert_equal(governor.limits('slug', _dashboard(tags=['wallboard'])), ('1m', '1d'))
+    tools.assert_equal(governor.limits('slug', _dashboard(tags=['wallboard'],
+                                                          datasource='Global')),
+                       ('5m', '1d'))
+
+
+def test_apply():
+    governor = refresh_governor.RefreshGovernor(POLICY)
+    dashboard = _dashboard(tags=['wallboard'])
+    tools.assert_equal(len(governor.apply('slug', dashboard)), 3)
+    tools.assert_equal(dashboard['refresh'], '1m')
+    tools.assert_equal(dashboard['nav'][0]['refresh_intervals'],
+                       ['1m', '5m', '15m', '30m', '1h', '2h', '1d'])
+    tools.assert_equal(dashboard['time']['from'], 'now-1d')
+    tools.assert_equal(governor.apply('slug', dashboard), [])
+    absolute = _dashboard(refresh='', time_from='2015-01-01T00:00:00Z')
+    tools.assert_equal(len(governor.apply('slug', absolute)), 1)
+    tools.assert_equal((absolute['refresh'], absolute['time']['from']),
+                       ('', '2015-01-01T00:00:00Z'))
+
+
+def test_min_cost():
+    policy = {'rules': [{'tag': 'wallboard', 'min_cost': 10, 'min_refresh': '1m'},
+                        {'min_cost': 100, 'min_refresh': '5m'},
+                        {'min_cost': 1, 'max_range': '1d'}]}
+    estimator = mock.Mock()
+    estimator.dashboard_cost.return_value = mock.Mock(cost=50)
+    get_estimator = mock.Mock(return_value=estimator)
+    governor = refresh_governor.RefreshGovernor({'rules': policy['rules'][:1]},
+                                                get_estimator=get_estimator)
+    # The tag doesn't match, no cost is needed.
+    tools.assert_equal(governor.limits('slug', _dashboard()), (None, None))
+    tools.assert_false(get_estimator.called)
+    governor = refresh_governor.RefreshGovernor(policy, get_estimator=get_estimator)
+    tools.assert_equal(governor.limits('slug', _dashboard(tags=['wallboard'])), ('1m', '1d'))
+    tools.assert_equal(get_estimator.call_count, 1)
+    tools.assert_equal(estimator.dashboard_cost.call_count, 1)
+
+
+@tools.raises(refresh_governor.RefreshGovernorException)
+def test_invalid_policy():
+    refresh_governor.RefreshGovernor({'rules': [{'min_refresh': 'often'}]})
+
+
+def test_govern_fleet():
+    record = namedtuple('Record', 'id slug data')
+    rows = [(1, 'fast', json_codec.dumps(_dashboard())),
+            (2, 'slow', json_codec.dumps(_dashboard(refresh='1m', time_from='now-1h')))]
+    with mock.patch.object(refresh_governor, 'sql_connector') as sql_connector:
+        report = refresh_governor.govern_fleet(refresh_governor.RefreshGovernor(POLICY), rows,
+                                               record, chunk_size=10)
+    tools.assert_equal([(x[0], x[2], x[3]) for x in report],
+                       [('fast', 1440, 720), ('slow', 120, 120)])
+    updates = sql_connector.update_dashboards_data.call_args[0][0]
+    tools.assert_equal([x[1] for x in updates], [1, 2])
+    tools.assert_true('-46%' in refresh_governor.format_report(report))
@@ -0,0 +1,128 @@
+import aggregations
+import itertools
+import mock
+import multiprocessing
+from nose import tools
+import sweep_coordinator
+import threading
+from time import time
+
+AUTHKEY = b'test'
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _table(slugs, clock=None, aggregator=None):
+    return sweep_coordinator.LeaseTable({'processor': 'top_metrics'}, slugs, aggregator,
+                                        lease_size=2, lease_timeout=10, clock=clock or _Clock())
+
+
+def test_leases():
+    clock = _Clock()
+    table = _table(['a', 'b', 'c', 'd', 'e'], clock)
+    tools.assert_equal(table.get_job()['lease_timeout'], 10)
+    tools.assert_equal(table.claim('w1'), (0, ['a', 'b']))
+    tools.assert_equal(table.claim('w2'), (1, ['c', 'd']))
+    tools.assert_equal(table.claim('w1'), (2, ['e']))
+    tools.assert_equal(table.claim('w3'), (None, []))
+    clock.now = 8
+    tools.assert_true(table.heartbeat('w1', 0))
+    tools.assert_false(table.heartbeat('w2', 0))
+    clock.now = 15
+    # w2 and w1's lease 2 expired, lease 0 was heartbeated.
+    tools.assert_equal(table.claim('w3'), (1, ['c', 'd']))
+    tools.assert_equal(table.status(), (0, 2, 1, 2))
+    tools.assert_false(table.heartbeat('w2', 1))
+    tools.assert_true(table.complete('w2', 1, timed_out=['c'], timings={'d': 1.0}))
+    tools.assert_false(table.complete('w3', 1, timed_out=['d']))
+    tools.assert_true(table.complete('w1', 0))
+    tools.assert_false(table.finished())
+    tools.assert_equal(table.claim('w3'), (2, ['e']))
+    tools.assert_true(table.complete('w3', 2))
+    tools.assert_true(table.finished())
+    tools.assert_equal(table.claim('w3'), None)
+    tools.assert_equal((table.timed_out, table.timings), (['c'], {'d': 1.0}))
+
+
+def test_parse_address():
+    tools.assert_equal(sweep_coordinator.parse_address('host:7300'), ('host', 7300))
+    tools.assert_equal(sweep_coordinator.parse_address(':7300'), ('localhost', 7300))
+    tools.assert_raises(sweep_coordinator.SweepCoordinatorException,
+                        sweep_coordinator.parse_address, 'host')
+
+
+def test_default_authkeys():
+    for authkey in (b'', b'change-me'):
+        tools.assert_raises(sweep_coordinator.SweepCoordinatorException, sweep_coordinator.serve,
+                            _table(['a']), ('127.0.0.1', 0), authkey)
+        tools.assert_raises(sweep_coordinator.SweepCoordinatorException,
+                            sweep_coordinator.connect, ('127.0.0.1', 1), authkey)
+
+
+def test_lost_lease():
+    clock = _Clock()
+    table = _table(['a', 'b', 'c'], clock)
+    leases = []
+
+    def process_lease(job, slugs, heartbeat):
+        leases.append(slugs)
+        if slugs == ['a', 'b']:
+            # Lease 0 expired and went to w2, which reported it.
+            clock.now = 15
+            tools.assert_equal(table.claim('w2'), (0, ['a', 'b']))
+            table.complete('w2', 0)
+        heartbeat()
+        return None, [], dict([(x, 0.1) for x in slugs])
+    ticks = itertools.count(0, 60)
+    with mock.patch.object(sweep_coordinator, 'connect', return_value=table), \
+            mock.patch.object(sweep_coordinator, 'time', lambda: next(ticks)):
+        tools.assert_equal(sweep_coordinator.run_worker(('host', 1), AUTHKEY, process_lease,
+                                                        name='w1'), 1)
+    tools.assert_equal(leases, [['a', 'b'], ['c']])
+    tools.assert_equal(table.timings, {'c': 0.1})
+    tools.assert_true(table.finished())
+
+
+def test_coordinator_gone():
+    table = mock.Mock(get_job=mock.Mock(return_value={'lease_timeout': 0}),
+                      claim=mock.Mock(side_effect=[(0, ['a']), EOFError()]),
+                      heartbeat=mock.Mock(side_effect=EOFError()))
+    with mock.patch.object(sweep_coordinator, 'connect', return_value=table):
+        tools.assert_equal(sweep_coordinator.run_worker(
+            ('host', 1), AUTHKEY, lambda job, slugs, heartbeat: heartbeat()), 0)
+    tools.assert_equal(table.complete.call_count, 0)
+
+
+def _process_lease(job, slugs, heartbeat):
+    heartbeat()
+    aggregator = aggregations.CountBy()
+    aggregator.combine(dict([(x, 1) for x in slugs]))
+    return aggregator, [], dict([(x, 0.1) for x in slugs])
+
+
+def _worker(address):
+    sweep_coordinator.run_worker(address, AUTHKEY, _process_lease, poll_interval=0.01)
+
+
+def test_workers():
+    slugs = ['dashboard-%s' % x for x in range(25)]
+    table = _table(slugs, clock=time, aggregator=aggregations.CountBy())
+    address = sweep_coordinator.serve(table, ('127.0.0.1', 0), AUTHKEY)
+    workers = [multiprocessing.Process(target=_worker, args=(address,)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    waiter = threading.Thread(target=sweep_coordinator.wait, args=(table, 0.01))
+    waiter.start()
+    waiter.join(30)
+    for worker in workers:
+        worker.join(30)
+        tools.assert_equal(worker.exitcode, 0)
+    tools.assert_true(table.finished())
+    tools.assert_equal(sorted(table.aggregator.counts.items()), [(x, 1) for x in sorted(slugs)])
+    tools.assert_equal(sorted(table.timings), sorted(slugs))
@@ -0,0 +1,52 @@
+import target_ast
+from nose import tools
+
+
+def test_round_trip():
+    for target in ["aliasByNode(sortByMaxima(highestCurrent(scale("
+                   "routers.*_in_Uplink_ae*.xva{[h-j]*,g[d-g]}-rs-01.counter.value, 8), 5)), 2)",
+                   "alias(offset(scale(sumSeries(a.b.*.counter.value), 0.001), 60), 'Spend')",
+                   'groupByNode(a.$colo.*.b, 2, "sumSeries")',
+                   "summarize(a.b, '1h', 'sum', false)",
+                   "seriesByTag('name=a.b')",
+                   "f(x=1, y='a')"]:
+        tools.assert_equal(target_ast.serialize(target_ast.parse(target)), target)
+
+
+def test_parse():
+    node = target_ast.parse("alias(a.{b,c}.d, 'e, f')")
+    tools.assert_equal(node, target_ast.Call('alias', (target_ast.Path('a.{b,c}.d'),
+                                                       target_ast.String('e, f', "'"))))
+    tools.assert_equal([x.path for x in target_ast.iter_paths(
+        target_ast.parse('divideSeries(a.b, sumSeries(c.*, d.e))'))], ['a.b', 'c.*', 'd.e'])
+
+
+def test_parse_errors():
+    for target in ['a(b', 'a)b', 'a(b,)', "a('b)"]:
+        tools.assert_raises(target_ast.TargetParseException, target_ast.parse, target)
+
+
+def test_estimate_series():
+    counts = {'a.*.c': 10, 'a.*': 4}
+
+    def estimate(target):
+        return target_ast.estimate_series(target_ast.parse(target), counts.get)
+    tools.assert_equal(estimate('a.b.c'), 1)
+    tools.assert_equal(estimate('a.*.c'), 10)
+    tools.assert_equal(estimate('x.*'), 1)
+    tools.assert_equal(estimate('sumSeries(a.*.c)'), 1)
+    tools.assert_equal(estimate('highestMax(a.*.c, 3)'), 3)
+    tools.assert_equal(estimate('groupByNode(a.*.c, 1, "sum")'), 4)
+    tools.assert_equal(estimate('group(a.*.c, a.b.c)'), 11)
+
+
+def test_estimate_fetched():
+    counts = {'a.*.c': 10, 'a.*': 4}
+
+    def estimate(target):
+        return target_ast.estimate_fetched(target_ast.parse(target), counts.get)
+    tools.assert_equal(estimate('a.b.c'), 1)
+    tools.assert_equal(estimate('sumSeries(a.*.c)'), 10)
+    tools.assert_equal(estimate('highestMax(a.*.c, 3)'), 10)
+    tools.assert_equal(estimate('divideSeries(sumSeries(a.*.c), x.*)'), 11)
+    tools.assert_equal(estimate('seriesByTag("name=cpu")'), 0)
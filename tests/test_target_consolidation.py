@@ -0,0 +1,29 @@
+import target_consolidation
+from nose import tools
+
+
+def _targets(*targets):
+    return [{'refId': chr(65 + x), 'target': target} for x, target in enumerate(targets)]
+
+
+def test_consolidate():
+    targets, removed = target_consolidation.consolidate(_targets(
+        'scale(a.ca.requests.count, 60)',
+        'a.ca.errors.count',
+        'scale(a.lc.requests.count, 60)',
+        'scale(a.xa.requests.count, 60)',
+        'a.lc.errors.count'))
+    tools.assert_equal(removed, 3)
+    tools.assert_equal([(x['refId'], x['target']) for x in targets],
+                       [('A', 'scale(a.{ca,lc,xa}.requests.count, 60)'),
+                        ('B', 'a.{ca,lc}.errors.count')])
+
+
+def test_not_folded():
+    for targets in [_targets('sumSeries(a.ca.b)', 'sumSeries(a.lc.b)'),
+                    _targets("alias(a.ca.b, 'ca')", "alias(a.lc.b, 'lc')"),
+                    _targets('a.ca.b', 'a.lc.c'),
+                    _targets('a.*.b', 'a.ca.b.c'),
+                    _targets('a.ca.b', 'diffSeries(#A, a.lc.b)'),
+                    [{'target': 'a.ca.b'}, {'target': 'a.lc.b', 'hide': True}]]:
+        tools.assert_equal(target_consolidation.consolidate(targets), (targets, 0))
@@ -0,0 +1,88 @@
+import fcntl
+from nose import tools
+import os
+import shutil
+import target_memo
+import tempfile
+import threading
+
+
+def test_memo():
+    memo = target_memo.Memo('test', keep=lambda x: x != 'failed')
+    calls = []
+
+    def analyze(result):
+        calls.append(result)
+        return result
+    tools.assert_equal(memo.get(['a.b', None], lambda: analyze('good')), 'good')
+    tools.assert_equal(memo.get(['a.b', None], lambda: analyze('other')), 'good')
+    tools.assert_equal(memo.get(['a.b', '$x'], lambda: analyze('failed')), 'failed')
+    tools.assert_equal(memo.get(['a.b', '$x'], lambda: analyze('failed')), 'failed')
+    tools.assert_equal(calls, ['good', 'failed', 'failed'])
+    tools.assert_equal(memo.stats(), {'hits': 1, 'misses': 3, 'loaded': 0})
+
+
+def test_persistent_memo():
+    memo_dir = tempfile.mkdtemp()
+    try:
+        memo_path = os.path.join(memo_dir, 'memo.jsonl')
+        clock = [1000.0]
+        first = target_memo.Memo('test', memo_path, ttl=60, clock=lambda: clock[0])
+        first.get('a.b', lambda: ['update', 'a.md.b'])
+        first.get('c.d', lambda: ['good', None])
+        with open(memo_path, 'a') as memo_file:
+            memo_file.write('{"memo": "test", "ke\n')  # A child killed while writing.
+        clock[0] = 1030.0
+        first.get('a.b', lambda: ['update', 'a.md.b'])
+        # Another process, or another version of the analysis.
+        second = target_memo.Memo('test', memo_path, ttl=60, clock=lambda: clock[0])
+        tools.assert_equal(second.get('a.b', lambda: None), ['update', 'a.md.b'])
+        tools.assert_equal(second.stats(), {'hits': 1, 'misses': 0, 'loaded': 2})
+        other_version = target_memo.Memo('test', memo_path, ttl=60, version=2)
+        tools.assert_equal(other_version.get('a.b', lambda: 'new'), 'new')
+        clock[0] = 1100.0
+        expired = target_memo.Memo('test', memo_path, ttl=60, clock=lambda: clock[0])
+        tools.assert_equal(expired.get('a.b', lambda: 'again'), 'again')
+        tools.assert_equal(target_memo.compact(memo_path, 60, clock=lambda: clock[0]), (2, 3))
+        compacted = target_memo.Memo('test', memo_path, ttl=60, clock=lambda: clock[0])
+        tools.assert_equal(compacted.get('a.b', lambda: None), 'again')
+    finally:
+        shutil.rmtree(memo_dir)
+
+
+def test_compact_locked():
+    memo_dir = tempfile.mkdtemp()
+    try:
+        memo_path = os.path.join(memo_dir, 'memo.jsonl')
+        memo = target_memo.Memo('test', memo_path)
+        memo.get('a.b', lambda: 'good')
+        memo.get('c.d', lambda: 'good')
+        results = []
+        # An append in progress, compact waits for it.
+        with target_memo._locked(memo_path, fcntl.LOCK_SH):
+            compacting = threading.Thread(target=lambda: results.append(
+                target_memo.compact(memo_path, 60)))
+            compacting.start()
+            compacting.join(0.2)
+            tools.assert_true(compacting.is_alive())
+        compacting.join()
+        tools.assert_equal(results, [(2, 0)])
+        tools.assert_equal(sorted(os.listdir(memo_dir)), ['memo.jsonl', 'memo.jsonl.lock'])
+    finally:
+        shutil.rmtree(memo_dir)
+
+
+def test_stats():
+    total = target_memo.combine_stats({}, {'m': {'hits': 3, 'misses': 1, 'loaded': 0}})
+    target_memo.combine_stats(total, {'m': {'hits': 5, 'misses': 1, 'loaded': 2}})
+    tools.assert_equal(target_memo.format_stats(total),
+                       'm: 8 hits, 2 misses (80% hit rate), 2 loaded')
+
+
+def test_reset():
+    memo = target_memo.get_memo('test_reset')
+    memo.get('a.b', lambda: 'good')
+    tools.assert_true('test_reset' in target_memo.stats())
+    target_memo.reset()
+    tools.assert_equal(target_memo.stats(), {})
+    tools.assert_false(target_memo.get_memo('test_reset') is memo)
@@ -1,3 +1,4 @@
+import json
 import validate_metrics
 from nose import tools
 import mock
@@ -25,3 +26,74 @@ def test_metric_children():
     expected = ['value']
     ret = validate_metrics.metric_children(search_metric)
     assert ret == expected
+
+
+def test_pack_queries():
+    paths = ['a.b.count', 'a.c.count', 'a.d.count', 'a.b.rate', 'x.y', 'a.*.count', 'solo.path.z']
+    queries = dict(validate_metrics.pack_queries(paths))
+    tools.assert_equal(queries['a.b.{count,rate}'], ['a.b.count', 'a.b.rate'])
+    tools.assert_equal(queries['a.{c,d}.count'], ['a.c.count', 'a.d.count'])
+    tools.assert_equal(queries['a.*.count'], ['a.*.count'])
+    tools.assert_equal(sorted(sum(queries.values(), [])), sorted(paths))
+    many = ['metric.host%03d.count' % x for x in range(300)]
+    queries = validate_metrics.pack_queries(many, max_length=200)
+    tools.assert_true(all(len(x[0]) <= 200 for x in queries))
+    tools.assert_true(len(queries) < 30)
+    tools.assert_equal(sorted(sum([x[1] for x in queries], [])), many)
+
+
+def test_metric_exists_many():
+    def post(url, data, timeout):
+        matches = {'first/find': ['a.b.count', 'a.x.y'], 'second/find': ['a.c.count']}[url]
+        query = data['query']
+        if '{' in query:
+            head, rest = query.split('{')
+            nodes, tail = rest.split('}')
+            candidates = [head + x + tail for x in nodes.split(',')]
+        else:
+            candidates = [x for x in matches if x.startswith(query.rstrip('*'))]
+        return mock.Mock(status_code=200, text=json.dumps(
+            [{'id': x, 'leaf': 1} for x in candidates if x in matches]))
+    configs = mock.Mock(datasources=[mock.Mock(url='first'), mock.Mock(url='second')],
+                        graphite_find_endpoint='/find', find_query_max_length=2000)
+    requests = mock.Mock()
+    requests.post.side_effect = post
+    with mock.patch.object(validate_metrics, 'CONFIGS', configs), \
+         mock.patch.object(validate_metrics, 'requests', requests):
+        found = validate_metrics.metric_exists_many(['a.b.count', 'a.c.count', 'a.d.count',
+                                                     'a.x.*'])
+    tools.assert_equal(found, {'a.b.count': 'first', 'a.c.count': 'second', 'a.d.count': None,
+                               'a.x.*': 'first'})
+    # One packed find of the counts per datasource, the second only for
+    # the paths the first doesn't have.
+    tools.assert_equal(requests.post.call_count, 3)
+
+
+def test_series_have_data():
+    series = {'first': {'a.live': [[None, 1], [3.0, 2]], 'a.dead': [[None, 1]]},
+              'second': {'a.dead': [[1.0, 1]], 'b.glob.*': [[None, 1]]}}
+
+    def post(url, data, timeout):
+        targets = [x[1] for x in data if x[0] == 'target']
+        if any(['bad(' in x for x in targets]):
+            return mock.Mock(status_code=500, text='')
+        rendered = []
+        for target in targets:
+            path, alias = target[len('alias('):-len("')")].split(",'")
+            if path in series[url.split('/')[0]]:
+                rendered.append({'target': alias,
+                                 'datapoints': series[url.split('/')[0]][path]})
+        return mock.Mock(status_code=200, text=json.dumps(rendered))
+    configs = mock.Mock(datasources=[mock.Mock(url='first'), mock.Mock(url='second')],
+                        graphite_render_endpoint='/render', stale_series_window='-7d',
+                        render_targets_per_request=3, render_concurrency=2)
+    requests = mock.Mock()
+    requests.post.side_effect = post
+    with mock.patch.object(validate_metrics, 'CONFIGS', configs), \
+         mock.patch.object(validate_metrics, 'requests', requests):
+        found = validate_metrics.series_have_data(['a.live', 'a.dead', 'bad(a.x)', 'b.glob.*',
+                                                   'a.gone'])
+    tools.assert_equal(found, {'a.live': True, 'a.dead': True, 'bad(a.x)': None,
+                               'b.glob.*': False, 'a.gone': False})
+    tools.assert_true(all([('from', '-7d') in x[1]['data'] and ('maxDataPoints', 1) in x[1]['data']
+                           for x in requests.post.call_args_list]))
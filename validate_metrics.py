@@ -2,13 +2,26 @@
 '''Check if metric is valid against datasources.
 
 '''
-import requests
-import simplejson as json
+from lazy_import import lazy_module
+import json_codec
+import os
+import re
 import triconf
-from urllib3.exceptions import LocationParseError
 
+lookup_broker = lazy_module('lookup_broker')
+multiprocessing_pool = lazy_module('multiprocessing.pool')
+requests = lazy_module('requests')
+urllib3 = lazy_module('urllib3')
+
+BROKER = None  # lookup_broker.BrokerClient lookups go through, see initialize.
 CONFIGS = ''
 KNOWN_METRICS = {}
+MAX_FIND_QUERY_LENGTH = 2000  # Default length of the find queries metric_exists_many sends.
+RENDER_CONCURRENCY = 8  # Default render requests series_have_data sends at once.
+RENDER_TARGETS_PER_REQUEST = 20  # Default targets series_have_data packs into a render.
+SERIES_COUNTS = {}
+STALE_SERIES_WINDOW = '-1d'  # Default graphite from= window series_have_data checks.
+_GLOB = re.compile(r'[*?\[\]{},]')
 
 
 class ValidateMetricsError(Exception):
@@ -16,6 +29,23 @@ class ValidateMetricsError(Exception):
         super(ValidateMetricsError, self).__init__(msg)
 
 
+def _broker_lookup(function, *args):
+    '''Return the result of the lookup through the broker, None if the
+    broker is gone; lookups then go to graphite directly.
+
+    '''
+    global BROKER
+    try:
+        return BROKER.call(function, *args)
+    except lookup_broker.LookupBrokerException as exc:
+        raise ValidateMetricsError(str(exc))
+    except (IOError, EOFError):
+        print('Lookup broker at %s unavailable, querying graphite directly.'
+              % BROKER.socket_path)
+        BROKER = None
+        return None
+
+
 def metric_children(metric, all_datasources=False):
     '''Display potential sub values for a given metric. Note that if the
     metric ends with a name, the actual children will be returned. If
@@ -62,12 +92,16 @@ def metric_exists(metric, query=None):
     '''
     if metric in KNOWN_METRICS:
         return reduce(lambda x, y: ['', x[1] or y[1]], KNOWN_METRICS[metric])[1]
+    if BROKER is not None:
+        found = _broker_lookup('metric_exists', metric, query)
+        if found is not None:
+            return tuple(found)
     query = query or {'query': metric}
     for datasource in CONFIGS.datasources:
         try:
             resp = requests.post(datasource.url+CONFIGS.graphite_find_endpoint,
                                  data=query, timeout=10)
-        except (LocationParseError, requests.exceptions.InvalidSchema):
+        except (urllib3.exceptions.LocationParseError, requests.exceptions.InvalidSchema):
             print('Unable to connect to datasource: %s. Must be a complete url.'
                   % CONFIGS.graphite_server+CONFIGS.graphite_find_endpoint)
         except requests.exceptions.Timeout:
@@ -78,10 +112,21 @@ def metric_exists(metric, query=None):
         if resp.text == '[]' or resp.text == '{"metrics": []}':
             continue
         else:
-            return (datasource.url, json.loads(resp.text))
+            return (datasource.url, json_codec.loads(resp.text))
     return (None, False)
 
 
+def count_series(metric):
+    '''Return the number of series the glob metric matches in the first
+    datasource having any, 0 if none does.
+
+    '''
+    if metric not in SERIES_COUNTS:
+        machine, resp = metric_exists(metric)
+        SERIES_COUNTS[metric] = len(resp) if resp else 0
+    return SERIES_COUNTS[metric]
+
+
 def metric_exists_all(metric, fetch_response=False, query=None):
     '''Returns list structure indicating whether a metric exists for each
     datasource.
@@ -90,11 +135,16 @@ def metric_exists_all(metric, fetch_response=False, query=None):
     ret = []
     if metric in KNOWN_METRICS:
         return KNOWN_METRICS[metric]
+    if BROKER is not None:
+        found = _broker_lookup('metric_exists_all', metric, fetch_response, query)
+        if found is not None:
+            KNOWN_METRICS[metric] = [tuple(x) for x in found]
+            return KNOWN_METRICS[metric]
     query = query or {'query': metric}
     for datasource in CONFIGS.datasources:
         try:
             resp = requests.post(datasource.url+CONFIGS.graphite_find_endpoint, data=query)
-        except (LocationParseError, requests.exceptions.InvalidSchema):
+        except (urllib3.exceptions.LocationParseError, requests.exceptions.InvalidSchema):
             print('Unable to connect to datasource: %s. Must be a complete url.'
                   % CONFIGS.graphite_server+CONFIGS.graphite_find_endpoint)
         if resp.status_code == 400:
@@ -103,25 +153,183 @@ def metric_exists_all(metric, fetch_response=False, query=None):
         if resp.text == '[]' or resp.text == '{"metrics": []}':
             ret.append((datasource.name, False))
         else:
-            ret.append((datasource.name, json.loads(resp.text) if fetch_response else True))
+            ret.append((datasource.name, json_codec.loads(resp.text) if fetch_response else True))
     KNOWN_METRICS[metric] = ret
     return ret
 
 
+def pack_queries(paths, max_length=MAX_FIND_QUERY_LENGTH):
+    '''Pack paths into find queries of at most max_length characters.
+    Paths differing in one node only become one brace glob query, e.g.
+    a.b.c and a.d.c become a.{b,d}.c; siblings are packed first, then
+    paths differing in earlier nodes. Paths with globs are queried on
+    their own. Returns the list of (query, [paths]).
+
+    '''
+    queries = []
+    remaining = []
+    for path in sorted(set(paths)):
+        if _GLOB.search(path):
+            queries.append((path, [path]))
+        else:
+            remaining.append(path.split('.'))
+    position = max([len(x) for x in remaining] or [0]) - 1
+    while position >= 0 and remaining:
+        groups = {}
+        for parts in remaining:
+            if position < len(parts):
+                key = (tuple(parts[:position]), tuple(parts[position + 1:]))
+                groups.setdefault(key, []).append(parts)
+        remaining = [x for x in remaining
+                     if position >= len(x) or len(groups[(tuple(x[:position]),
+                                                          tuple(x[position + 1:]))]) < 2]
+        for (head, tail), members in sorted(groups.items()):
+            if len(members) < 2:
+                continue
+            fixed = len('.'.join(head + ('{}',) + tail))
+            chunk = []
+            for parts in members:
+                if chunk and fixed + len(','.join([x[position] for x in chunk + [parts]])) \
+                   > max_length:
+                    queries.append(_brace_query(head, tail, position, chunk))
+                    chunk = []
+                chunk.append(parts)
+            queries.append(_brace_query(head, tail, position, chunk))
+        position -= 1
+    queries += [('.'.join(x), ['.'.join(x)]) for x in remaining]
+    return queries
+
+
+def _brace_query(head, tail, position, members):
+    paths = ['.'.join(x) for x in members]
+    if len(members) == 1:
+        return paths[0], paths
+    node = '{%s}' % ','.join([x[position] for x in members])
+    return '.'.join(head + (node,) + tail), paths
+
+
+def _matched_paths(found):
+    '''Return the set of paths in a find response, either format.
+
+    '''
+    if isinstance(found, dict):
+        return set([x['path'].rstrip('.') for x in found.get('metrics') or []])
+    return set([x['id'] for x in found or []])
+
+
+def metric_exists_many(paths, max_length=None):
+    '''Check many metric paths with few find requests, see pack_queries.
+    Returns {path: url of the first datasource having it, or None}.
+    Paths with globs exist if they match anything.
+
+    '''
+    max_length = max_length or int(getattr(CONFIGS, 'find_query_max_length', 0)
+                                   or MAX_FIND_QUERY_LENGTH)
+    found = dict([(x, None) for x in paths])
+    for datasource in CONFIGS.datasources:
+        missing = [x for x in found if found[x] is None]
+        if not missing:
+            break
+        for query, members in pack_queries(missing, max_length):
+            try:
+                resp = requests.post(datasource.url+CONFIGS.graphite_find_endpoint,
+                                     data={'query': query}, timeout=10)
+            except requests.exceptions.Timeout:
+                continue
+            if resp.status_code == 400:
+                print("Got bad status code from find call: %s." % resp.text)
+                raise ValidateMetricsError
+            matched = _matched_paths(json_codec.loads(resp.text))
+            for path in members:
+                if matched and (path in matched or len(members) == 1):
+                    found[path] = datasource.url
+    return found
+
+
+def _render_has_data(datasource_url, targets, window):
+    '''Return {target: whether it has a datapoint in window} of one
+    render request, None for the targets graphite fails to render. A
+    request failing for a bad target is split in halves until the bad
+    target fails alone.
+
+    '''
+    # Every series is aliased to the index of its target, globs expand
+    # to several series and functions rename theirs.
+    data = [('target', "alias(%s,'%s')" % (x, number)) for number, x in enumerate(targets)]
+    data += [('format', 'json'), ('from', window), ('maxDataPoints', 1)]
+    try:
+        resp = requests.post(datasource_url+CONFIGS.graphite_render_endpoint, data=data,
+                             timeout=30)
+    except requests.exceptions.RequestException:
+        return dict([(x, None) for x in targets])
+    if resp.status_code != 200:
+        if len(targets) == 1:
+            return {targets[0]: None}
+        half = len(targets) // 2
+        found = _render_has_data(datasource_url, targets[:half], window)
+        found.update(_render_has_data(datasource_url, targets[half:], window))
+        return found
+    found = dict([(x, False) for x in targets])
+    for series in json_codec.loads(resp.text):
+        if any([x[0] is not None for x in series.get('datapoints') or []]):
+            found[targets[int(series['target'])]] = True
+    return found
+
+
+def series_have_data(targets, window=None, per_request=None, concurrency=None):
+    '''Check which render targets have datapoints since window, a
+    graphite from= value, with few render requests: per_request targets
+    are packed into one maxDataPoints=1 request, concurrency requests
+    are sent at once. Targets without data in a datasource are checked
+    in the next one. Returns {target: True, False, or None if no
+    datasource could render it}.
+
+    '''
+    window = window or getattr(CONFIGS, 'stale_series_window', None) or STALE_SERIES_WINDOW
+    per_request = per_request or int(getattr(CONFIGS, 'render_targets_per_request', 0)
+                                     or RENDER_TARGETS_PER_REQUEST)
+    concurrency = concurrency or int(getattr(CONFIGS, 'render_concurrency', 0)
+                                     or RENDER_CONCURRENCY)
+    found = dict([(x, None) for x in targets])
+    pool = multiprocessing_pool.ThreadPool(concurrency)
+    try:
+        for datasource in CONFIGS.datasources:
+            remaining = sorted([x for x in found if not found[x]])
+            if not remaining:
+                break
+            chunks = [remaining[x:x + per_request] for x in range(0, len(remaining), per_request)]
+            for rendered in pool.map(lambda x: _render_has_data(datasource.url, x, window),
+                                     chunks):
+                for target, has_data in rendered.items():
+                    if has_data or found[target] is None:
+                        found[target] = has_data
+    finally:
+        pool.terminate()
+    return found
+
+
 def initialize(**kargs):
+    global BROKER
     global CONFIGS
     CONFIGS = triconf.conf.initialize('validate_metrics',
                                       conf_file_names=['conf.ini', 'datasources.ini'],
                                       **kargs)
+    socket_path = getattr(CONFIGS, 'lookup_broker_socket', None)
+    BROKER = lookup_broker.BrokerClient(socket_path) \
+        if socket_path and os.path.exists(socket_path) else None
     return CONFIGS
 
 
 if __name__ == '__main__':
     from pprint import pprint
+    import sys
     CONFIGS = initialize()
     PARSER = triconf.conf.ArgumentParser(CONFIGS)
     RESPONSE = None
-    PARSER.add_argument('metric')
+    PARSER.add_argument('metric', nargs='?')
+    PARSER.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help=('Check the metric paths in FILE, one per line, or stdin, with '
+                              'brace glob packed finds.'))
     PARSER.add_argument('--all-datasources', action='store_true',
                         help='Check metric against all datasources.')
     PARSER.add_argument('--children', action='store_true',
@@ -131,13 +339,23 @@ if __name__ == '__main__':
                               '(provide url or name of datasource in datasources.ini.'))
     CONFIGS(PARSER.parse_args())  # CONFIGS({'cli': parser.parse_args()})
     if CONFIGS.specific_datasource:
+        BROKER = None  # The broker queries every datasource.
         if hasattr(CONFIGS.datasources, CONFIGS.specific_datasource):
             CONFIGS.datasources = [getattr(CONFIGS.datasources, CONFIGS.specific_datasource)]
         else:
             CONFIGS.datasources = [triconf.conf.Namespace(url=CONFIGS.specific_datasource,
                                                           name='User specified datasource')]
     try:
-        if CONFIGS.all_datasources and CONFIGS.children:
+        if CONFIGS.batch:
+            PATH_FILE = sys.stdin if CONFIGS.batch == '-' else open(CONFIGS.batch)
+            PATHS = [x.strip() for x in PATH_FILE if x.strip()]
+            FOUND = metric_exists_many(PATHS)
+            for path in PATHS:
+                print('%s %s' % (path, FOUND[path] or 'MISSING'))
+            sys.stderr.write('%s paths, %s missing, checked with %s finds per datasource at '
+                             'most.\n' % (len(FOUND), len([x for x in FOUND.values() if not x]),
+                                          len(pack_queries(FOUND))))
+        elif CONFIGS.all_datasources and CONFIGS.children:
             RESPONSE = metric_children(CONFIGS.metric, all_datasources=True)
             RESPONSE.sort(key=lambda x: x[1])  # Put most relevant results at the bottom
             pprint(RESPONSE)